@@ -0,0 +1,181 @@
+import json
+import time
+import bisect
+import functools
+import threading
+import contextlib
+from typing import Dict, Callable, Any, Optional
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+_lock = threading.Lock()
+_stages: Dict[str, "Histogram"] = {}
+_enabled: Optional[bool] = None
+
+
+class Histogram:
+    def __init__(self):
+        """
+        Aggregated wall time of one pipeline stage: call and item counts, total, minimum and maximum
+        milliseconds, and the number of calls per latency bucket.
+        """
+        self.count = 0
+        self.items = 0
+        self.total_ms = 0.0
+        self.min_ms = float("inf")
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, elapsed_ms: float, items: int = 0) -> None:
+        self.count += 1
+        self.items += items
+        self.total_ms += elapsed_ms
+        self.min_ms = min(self.min_ms, elapsed_ms)
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed_ms)] += 1
+
+    def percentile(self, q: float) -> float:
+        """
+        Estimates a latency percentile as the upper bound of the bucket it falls in.
+        """
+        _rank, _seen = q / 100 * self.count, 0
+        for _bound, _count in zip(BUCKETS + (self.max_ms,), self.buckets):
+            _seen += _count
+            if _count and _seen >= _rank:
+                return min(_bound, self.max_ms)
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count,
+                "items": self.items,
+                "total_ms": self.total_ms,
+                "mean_ms": self.total_ms / self.count if self.count else 0.0,
+                "min_ms": self.min_ms if self.count else 0.0,
+                "max_ms": self.max_ms,
+                "p50_ms": self.percentile(50),
+                "p95_ms": self.percentile(95),
+                "p99_ms": self.percentile(99),
+                "buckets": dict(zip([str(_bound) for _bound in BUCKETS] + ["+Inf"], self.buckets))}
+
+
+def is_enabled() -> bool:
+    global _enabled
+    if _enabled is None:
+        from _config import _config as _config_
+        _enabled = bool(_config_.PGConfigSingleton().config.get("metrics_enabled"))
+    return _enabled
+
+
+def enable(flag: bool = True) -> None:
+    """
+    Turns metrics collection on or off, overriding `metrics_enabled` from the config file.
+    """
+    global _enabled
+    _enabled = flag
+
+
+def observe(stage: str, elapsed_ms: float, items: int = 0) -> None:
+    with _lock:
+        _histogram = _stages.get(stage)
+        if _histogram is None:
+            _histogram = _stages[stage] = Histogram()
+        _histogram.observe(elapsed_ms, items)
+
+
+@contextlib.contextmanager
+def _span(stage: str, items: int):
+    _started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, (time.perf_counter() - _started) * 1000, items)
+
+
+def span(stage: str, items: int = 0):
+    """
+    A context manager recording the wall time of a block as one call of a stage.
+
+    Args:
+        stage: The name of the stage, e.g. "embedding".
+        items: The number of items processed by the block. Defaults to 0.
+
+    Returns:
+        A context manager, which does nothing if metrics are disabled.
+    """
+    return _span(stage, items) if is_enabled() else contextlib.nullcontext()
+
+
+def timed(stage: str, items: Callable[[Any], int] = None):
+    """
+    A decorator recording the wall time of every call of a function as one call of a stage.
+
+    It can be stacked with `_common.exception_handler`; put it below the handler so that failed calls,
+    which exit the process, are not recorded. If metrics are disabled the cost is one flag check per call.
+
+    Args:
+        stage: The name of the stage, e.g. "load_document".
+        items: A function mapping the return value to the number of items processed, e.g. `len`.
+            Defaults to None, in which case no items are counted.
+
+    Returns:
+        Callable: The decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (_enabled if _enabled is not None else is_enabled()):
+                return func(*args, **kwargs)
+            _started = time.perf_counter()
+            result = func(*args, **kwargs)
+            observe(stage, (time.perf_counter() - _started) * 1000, items(result) if items else 0)
+            return result
+        return wrapper
+    return decorator
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the aggregated metrics of every stage recorded since start-up or the last `reset`.
+
+    Returns:
+        Dict: For each stage, its call and item counts, total, mean, min and max milliseconds, estimated
+        p50/p95/p99 and the calls per latency bucket.
+    """
+    with _lock:
+        return {stage: histogram.to_dict() for stage, histogram in sorted(_stages.items())}
+
+
+def to_json() -> str:
+    return json.dumps(snapshot(), indent=2)
+
+
+def to_prometheus(prefix: str = "rag") -> str:
+    """
+    Renders the metrics snapshot in the Prometheus text exposition format.
+
+    Args:
+        prefix: The prefix of the metric names. Defaults to "rag".
+
+    Returns:
+        str: A `{prefix}_stage_duration_milliseconds` histogram and a `{prefix}_stage_items_total` counter,
+        both labelled by stage.
+    """
+    _duration, _items = f"{prefix}_stage_duration_milliseconds", f"{prefix}_stage_items_total"
+    lines = [f"# HELP {_duration} Wall time of the RAG pipeline stages.", f"# TYPE {_duration} histogram"]
+    _snapshot = snapshot()
+    for stage, metrics in _snapshot.items():
+        _cumulative = 0
+        for _bound, _count in metrics["buckets"].items():
+            _cumulative += _count
+            lines.append(f'{_duration}_bucket{{stage="{stage}",le="{_bound}"}} {_cumulative}')
+        lines.append(f'{_duration}_sum{{stage="{stage}"}} {metrics["total_ms"]}')
+        lines.append(f'{_duration}_count{{stage="{stage}"}} {metrics["count"]}')
+    lines += [f"# HELP {_items} Items processed by the RAG pipeline stages.", f"# TYPE {_items} counter"]
+    lines += [f'{_items}{{stage="{stage}"}} {metrics["items"]}' for stage, metrics in _snapshot.items()]
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    with _lock:
+        _stages.clear()
@@ -0,0 +1,323 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from logging import Logger as Log
+from queue import Queue
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from _config import _config as _config_
+from _common import _common as _common_
+from _common import _metrics as _metrics_
+from _data import _data_load
+from _util import _util_file as _util_file_
+from _vectordb import _manifest as _manifest_
+
+_MANIFEST_SAVE_INTERVAL = 30
+
+
+def _base_metadata(filepath: str, tags: Optional[List[str]]) -> Dict:
+    # the metadata every chunk of a file is stored with, extended by the chunk's own offset or record id
+    _config = _config_.PGConfigSingleton()
+    tags = _config.config.get("ingest_tags") if tags is None else tags
+    metadata = {"source": filepath, "ingested_at": int(time.time())}
+    if tags:
+        metadata["tags"] = list(tags)
+    return metadata
+
+
+@_common_.exception_handler
+@_metrics_.timed("ingest_file")
+def ingest_file(vector_db, filepath: str, logger: Log = None, tags: Optional[List[str]] = None,
+                progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Ingests a file into the vector database incrementally and idempotently.
+
+    The file is compared against the ingestion manifest. If its size and modification time are unchanged,
+    or its content hash is unchanged, nothing is done. Otherwise the file is re-chunked as it is read and
+    only the chunks that are not already stored are embedded and inserted, in batches of
+    `ingest_embedding_batch_size`, while the rows of chunks that disappeared from the file are removed.
+    CSV, JSON Lines and JSON files are chunked record by record when `ingest_record_text_field` is set, see
+    `_data_load.iter_source`, so multi-GB exports are ingested with bounded memory.
+
+    Every new chunk is stored with its `source` path, its `offset` (and `record_id` for records), the
+    `ingested_at` time in epoch seconds and, if any, the `tags`, which can all be used as search filters.
+    Chunks that did not change keep the metadata they were stored with.
+
+    Args:
+        vector_db: The vector database the chunks are written to.
+        filepath: The path of the file to be ingested.
+        logger: A logger object for logging messages. Defaults to None.
+        tags: The tags of the file's chunks. Defaults to `ingest_tags` from the config file.
+        progress: Called with the number of chunks read and added so far after every inserted batch.
+            Defaults to None.
+
+    Returns:
+        Dict: The number of chunks added, removed and kept for the file.
+
+    """
+    filepath = os.path.abspath(filepath)
+    manifest = _manifest_.load_manifest(_manifest_.manifest_location(vector_db))
+    entry = manifest["files"].get(filepath, {})
+    stat = os.stat(filepath)
+
+    if _manifest_.is_unchanged(entry, stat):
+        return {"added": 0, "removed": 0, "kept": len(entry["chunks"])}
+
+    content_hash = _manifest_.file_hash(filepath)
+    if entry and entry.get("hash") == content_hash:
+        entry.update({"size": stat.st_size, "mtime": stat.st_mtime})
+        _manifest_.save_manifest(manifest, _manifest_.manifest_location(vector_db))
+        return {"added": 0, "removed": 0, "kept": len(entry["chunks"])}
+
+    # chunks are matched and inserted in batches as they are read, so the file is never held in memory
+    _config = _config_.PGConfigSingleton()
+    batch_size = int(_config.config.get("ingest_embedding_batch_size") or 256)
+    _existing, chunks, _batch = _manifest_.chunk_rowids(entry), [], []
+    _metadata = _base_metadata(filepath, tags)
+
+    def _insert():
+        _rowids = vector_db.add_texts([text for _, text, _ in _batch],
+                                      metadatas=[{**_metadata, **metadata} for _, _, metadata in _batch])
+        for (position, _, _), _rowid in zip(_batch, _rowids):
+            chunks[position][1] = _rowid
+        _batch.clear()
+
+    added = 0
+    for text, metadata in _data_load.iter_source(filepath):
+        chunks.append(_manifest_.match_chunk(_existing, text))
+        if chunks[-1][1] is None:
+            _batch.append((len(chunks) - 1, text, metadata))
+            added += 1
+        if len(_batch) >= batch_size:
+            _insert()
+            if progress:
+                progress({"chunks": len(chunks), "added": added})
+    if _batch:
+        _insert()
+    removed = [_rowid for _rowids in _existing.values() for _rowid in _rowids]
+    if removed:
+        vector_db.delete(removed)
+
+    manifest["files"][filepath] = {"size": stat.st_size,
+                                   "mtime": stat.st_mtime,
+                                   "hash": content_hash,
+                                   "chunks": chunks}
+    manifest["version"] += 1
+    _manifest_.save_manifest(manifest, _manifest_.manifest_location(vector_db))
+    _common_.info_logger(f"ingested {filepath}: {added} chunks added, {len(removed)} removed",
+                         logger=logger)
+    return {"added": added, "removed": len(removed), "kept": len(chunks) - added}
+
+
+def _pop_deleted(manifest: Dict, dirpath: str = "") -> Tuple[List[str], List[int]]:
+    # removes the entries of files under dirpath that no longer exist on disk, returning them and their rows
+    _prefix = os.path.join(os.path.abspath(dirpath), "") if dirpath else ""
+    _deleted = [filepath for filepath in manifest["files"]
+                if filepath.startswith(_prefix) and not os.path.exists(filepath)]
+    return _deleted, [_rowid for filepath in _deleted for _, _rowid in manifest["files"].pop(filepath)["chunks"]]
+
+
+@_common_.exception_handler
+def prune_deleted(vector_db, logger: Log = None, dirpath: str = "") -> int:
+    """
+    Removes the rows of files that were ingested but no longer exist on disk.
+
+    Args:
+        vector_db: The vector database the rows are removed from.
+        logger: A logger object for logging messages. Defaults to None.
+        dirpath: Only files under this directory are considered. Defaults to "", all ingested files.
+
+    Returns:
+        int: The number of rows removed.
+
+    """
+    manifest = _manifest_.load_manifest(_manifest_.manifest_location(vector_db))
+    _deleted, _rowids = _pop_deleted(manifest, dirpath)
+    if not _deleted:
+        return 0
+
+    vector_db.delete(_rowids)
+    manifest["version"] += 1
+    _manifest_.save_manifest(manifest, _manifest_.manifest_location(vector_db))
+    _common_.info_logger(f"removed {len(_rowids)} rows of {len(_deleted)} deleted files", logger=logger)
+    return len(_rowids)
+
+
+def _load_file(filepath: str) -> Tuple[str, str, List[Tuple[str, Dict]], str]:
+    # runs in a worker process; load_source is called undecorated so a bad file is reported, not fatal
+    try:
+        return filepath, _manifest_.file_hash(filepath), _data_load.load_source.__wrapped__(filepath), ""
+    except Exception as err:
+        return filepath, "", [], str(err)
+
+
+def _map_bounded(executor: Executor, func: Callable, items: Iterable, window: int) -> Iterator[Any]:
+    # like Executor.map, but with at most `window` calls submitted ahead of the results taken, so the
+    # workers wait for a slow consumer instead of piling up their results in memory
+    futures = deque()
+    for item in items:
+        if len(futures) >= window:
+            yield futures.popleft().result()
+        futures.append(executor.submit(func, item))
+    while futures:
+        yield futures.popleft().result()
+
+
+@_common_.exception_handler
+@_metrics_.timed("ingest_directory")
+def ingest_directory(vector_db, embedding, dirpath: str, logger: Log = None,
+                     tags: Optional[List[str]] = None, progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Ingests every file of a directory tree into the vector database with a parallel pipeline.
+
+    Files that are unchanged according to the ingestion manifest are skipped, and the rows of files under
+    `dirpath` that were ingested before but no longer exist are removed. The remaining files are
+    read and split into chunks with `_data_load.load_source` by a pool of `ingest_workers` processes, at
+    most twice as many files as there are workers ahead of the embedding, so the loaded chunks waiting in
+    memory do not grow with the corpus. Files that cannot be read, or that vanish during the run, are
+    counted as failed. New chunks are collected into
+    embedding batches of `ingest_embedding_batch_size` chunks, and a separate writer thread deletes
+    vanished chunks and bulk-inserts the embedded batches while the next batch is being embedded.
+    Progress is logged every `ingest_progress_interval` files.
+
+    Args:
+        vector_db: The vector database the chunks are written to.
+        embedding: The embedding model used to embed the chunks.
+        dirpath: The path of the directory to be ingested.
+        logger: A logger object for logging messages. Defaults to None.
+        tags: The tags of the chunks, see `ingest_file`. Defaults to `ingest_tags` from the config file.
+        progress: Called with the number of files to load and loaded so far and the running counts after
+            every loaded file. Defaults to None.
+
+    Returns:
+        Dict: The number of files seen, skipped, failed and deleted, and the number of chunks added and
+        removed.
+
+    """
+    _config = _config_.PGConfigSingleton()
+    workers = int(_config.config.get("ingest_workers") or os.cpu_count() or 1)
+    batch_size = int(_config.config.get("ingest_embedding_batch_size") or 256)
+    progress_interval = int(_config.config.get("ingest_progress_interval") or 100)
+
+    manifest = _manifest_.load_manifest(_manifest_.manifest_location(vector_db))
+    _deleted, _pruned = _pop_deleted(manifest, dirpath)
+    counts = {"files": 0, "skipped": 0, "failed": 0, "deleted": len(_deleted), "added": 0, "removed": len(_pruned)}
+    _filepaths = []
+    for filepath in _util_file_.files_in_dir(dirpath):
+        filepath = os.path.abspath(filepath)
+        counts["files"] += 1
+        if _manifest_.is_unchanged(manifest["files"].get(filepath), os.stat(filepath)):
+            counts["skipped"] += 1
+        else:
+            _filepaths.append(filepath)
+
+    # the writer owns every change to the vector database; a file's manifest entry is only published
+    # once all of its new chunks are written, so an interrupted run never records rows it did not insert
+    writes, pending, entries, manifest_lock = Queue(maxsize=4), {}, {}, threading.Lock()
+
+    # a failed writer records its error and drains the queue, so the producer never blocks on it and
+    # stops at its next write; the error is raised once the writer has stopped
+    _writer_errors = []
+
+    def _writer():
+        _saved = time.time()
+        while (item := writes.get()) is not None:
+            if _writer_errors:
+                continue
+            try:
+                _op, _payload = item
+                if _op == "delete":
+                    vector_db.delete(_payload)
+                    continue
+                _batch_refs, _batch_texts, _batch_metadatas, _embeddings = _payload
+                _rowids = vector_db.add_embeddings(_batch_texts, _embeddings, _batch_metadatas)
+                with manifest_lock:
+                    for (_path, _position), _rowid in zip(_batch_refs, _rowids):
+                        entries[_path]["chunks"][_position][1] = _rowid
+                        pending[_path] -= 1
+                        if not pending[_path]:
+                            manifest["files"][_path] = entries.pop(_path)
+                    counts["added"] += len(_rowids)
+                    if time.time() - _saved > _MANIFEST_SAVE_INTERVAL:
+                        _manifest_.save_manifest(manifest, _manifest_.manifest_location(vector_db))
+                        _saved = time.time()
+            except BaseException as err:
+                # including the SystemExit of the decorated manifest helpers
+                _writer_errors.append(err)
+
+    def _check_writer():
+        if _writer_errors:
+            raise RuntimeError(f"writing to the vector database failed: {_writer_errors[0]!r}") from _writer_errors[0]
+
+    def _write(item):
+        _check_writer()
+        writes.put(item)
+
+    writer = threading.Thread(target=_writer, daemon=True)
+    writer.start()
+    try:
+        if _pruned:
+            _write(("delete", _pruned))
+
+        _refs, _texts, _metadatas, started = [], [], [], time.time()
+
+        def _flush(count: int):
+            _batch_refs, _batch_texts, _batch_metadatas = _refs[:count], _texts[:count], _metadatas[:count]
+            del _refs[:count], _texts[:count], _metadatas[:count]
+            with _metrics_.span("embedding", items=len(_batch_texts)):
+                _embeddings = embedding.embed_documents(_batch_texts)
+            _write(("insert", (_batch_refs, _batch_texts, _batch_metadatas, _embeddings)))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for done, (filepath, content_hash, sources, error) in \
+                    enumerate(_map_bounded(executor, _load_file, _filepaths, 2 * workers), start=1):
+                removed = []
+                try:
+                    stat = os.stat(filepath)
+                except OSError as err:
+                    error = error or str(err)
+                with manifest_lock:
+                    entry = manifest["files"].get(filepath, {})
+                    if error:
+                        counts["failed"] += 1
+                        _common_.error_logger("ingest_directory", error, logger=logger, mode="error",
+                                              addition_msg=filepath)
+                    elif entry and entry.get("hash") == content_hash:
+                        entry.update({"size": stat.st_size, "mtime": stat.st_mtime})
+                        counts["skipped"] += 1
+                    else:
+                        chunks, added, removed = _manifest_.diff_chunks(entry, [text for text, _ in sources])
+                        counts["removed"] += len(removed)
+                        _entry = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": content_hash, "chunks": chunks}
+                        if added:
+                            entries[filepath], pending[filepath] = _entry, len(added)
+                        else:
+                            manifest["files"][filepath] = _entry
+                        _refs.extend((filepath, position) for position in added)
+                        _texts.extend(sources[position][0] for position in added)
+                        _metadata = _base_metadata(filepath, tags)
+                        _metadatas.extend({**_metadata, **sources[position][1]} for position in added)
+                if removed:
+                    _write(("delete", removed))
+                while len(_texts) >= batch_size:
+                    _flush(batch_size)
+                if progress:
+                    with manifest_lock:
+                        progress({"loaded": done, "total": len(_filepaths), **counts})
+                if not done % progress_interval:
+                    _common_.info_logger(f"ingest progress: {done}/{len(_filepaths)} files loaded, "
+                                         f"{counts['added']} chunks written, "
+                                         f"{counts['added'] / max(time.time() - started, 1e-9):.1f} chunks/sec",
+                                         logger=logger)
+        if _texts:
+            _flush(len(_texts))
+    finally:
+        writes.put(None)
+        writer.join()
+    _check_writer()
+
+    manifest["version"] += 1
+    _manifest_.save_manifest(manifest, _manifest_.manifest_location(vector_db))
+    _common_.info_logger(f"ingested {dirpath}: {counts}", logger=logger)
+    return counts
@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from logging import Logger as Log
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+from _config import _config as _config_
+from _common import _common as _common_
+from _data import _data_ingest
+from _vectordb import _manifest as _manifest_
+
+_PROGRESS_INTERVAL = 1.0
+_FINISHED = ("done", "failed")
+_COLUMNS = ["id", "path", "tags", "state", "progress", "result", "error", "version",
+            "submitted_at", "started_at", "finished_at"]
+
+
+def jobs_location(vector_db=None) -> str:
+    """
+    Returns the location of the job database of a vector database: `ingest_jobs_location` if set, otherwise
+    next to its ingestion manifest.
+    """
+    _location = _config_.PGConfigSingleton().config.get("ingest_jobs_location")
+    if _location:
+        return os.path.expanduser(_location)
+    _manifest = _manifest_.manifest_location(vector_db)
+    return f"{_manifest[:-len('.manifest.json')] if _manifest.endswith('.manifest.json') else _manifest}.jobs.db"
+
+
+class _SnapshotLock:
+    # shared by searches, exclusive while a job takes its watermark or is published; a waiting publish
+    # goes before new searches, so it is never starved
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers, self._writing, self._waiting = 0, False, 0
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._writing and not self._waiting)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting += 1
+            self._condition.wait_for(lambda: not self._writing and not self._readers)
+            self._waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class _StagedStore:
+    # the vector database as seen by a running job: inserts go through and the ids they return are
+    # recorded, deletes are only recorded and applied when the job is published
+    def __init__(self, vector_db, record):
+        self._vector_db = vector_db
+        self._record = record
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._vector_db, name)
+
+    def add_texts(self, texts, metadatas=None, **kwargs) -> List[int]:
+        ids = self._vector_db.add_texts(texts, metadatas=metadatas, **kwargs)
+        self._record(ids)
+        return ids
+
+    def add_embeddings(self, texts, embeddings, metadatas=None) -> List[int]:
+        ids = self._vector_db.add_embeddings(texts, embeddings, metadatas)
+        self._record(ids)
+        return ids
+
+    def delete(self, ids=None, **kwargs) -> bool:
+        if not ids:
+            return False
+        self._record(ids)
+        return True
+
+
+class IngestJobQueue:
+    def __init__(self, vector_db, embedding, location: str = "", logger: Log = None):
+        """
+        A persistent queue of ingest jobs, run in the background while searches keep being served from the
+        last published index version.
+
+        Jobs and their state (queued, running, done or failed), progress and result are stored in a SQLite
+        database, see `jobs_location`. A worker thread runs them one at a time with `ingest_file`, or with
+        `ingest_directory` and its `ingest_workers` loader processes for a directory.
+
+        When a job starts, the store's `watermark` (the highest row id) is taken, and searches made through
+        `snapshot` are restricted to it until the job is published, so rows the job inserts stay invisible.
+        The rows a job deletes are only recorded, in the job database, so replaced chunks stay visible too.
+        Publishing a job records a new index version, lifts the watermark and hides every row the job touched
+        that the ingestion manifest no longer references from searches, which `snapshot` passes as `exclude`;
+        only these swaps hold searches back, so a search sees either the old or the new version of the index.
+        The hidden rows are then deleted while searches go on, and stop being excluded once they are gone. A
+        job that fails is published the same way, leaving the index as its manifest describes it, and a job
+        interrupted by a crash is cleaned up and queued again when the queue is next opened. If publishing
+        itself fails, the job is marked failed and the worker goes on with the next job; the rows of a job
+        that could not be deleted, whether it was published or not, are cleaned up when the queue is next
+        opened.
+
+        Args:
+            vector_db: The vector database the jobs write to.
+            embedding: The embedding model used to embed the chunks of directory jobs.
+            location: The job database file. Defaults to `jobs_location(vector_db)`.
+            logger: A logger object for logging messages. Defaults to None.
+        """
+        self.vector_db = vector_db
+        self.embedding = embedding
+        self.location = location or jobs_location(vector_db)
+        self.logger = logger
+        self._db_lock = threading.Lock()
+        self._connection = sqlite3.connect(self.location, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, "
+            "tags TEXT, state TEXT NOT NULL, progress TEXT, result TEXT, error TEXT, version INTEGER, "
+            "submitted_at REAL, started_at REAL, finished_at REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS job_rows (job_id INTEGER NOT NULL, id INTEGER NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS job_rows_job_id ON job_rows (job_id)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS index_versions (version INTEGER PRIMARY KEY "
+                                 "AUTOINCREMENT, job_id INTEGER, published_at REAL)")
+        self._connection.commit()
+        self.version = self._connection.execute("SELECT coalesce(max(version), 0) FROM index_versions").fetchone()[0]
+
+        self._lock = _SnapshotLock()
+        self._watermark = None
+        self._hidden: FrozenSet[int] = frozenset()
+        self._finished = threading.Condition()
+        self._wakeup = threading.Event()
+        self._closed = False
+        for job_id, in self._connection.execute("SELECT DISTINCT job_id FROM job_rows WHERE job_id NOT IN "
+                                                "(SELECT id FROM jobs WHERE state = 'running')").fetchall():
+            # left by a job whose publishing failed
+            self._release(job_id)
+        for job_id, in self._connection.execute("SELECT id FROM jobs WHERE state = 'running'").fetchall():
+            self._release(job_id)
+            self._execute("UPDATE jobs SET state = 'queued', started_at = NULL WHERE id = ?", (job_id,))
+            _common_.info_logger(f"ingest job {job_id} was interrupted and is queued again", logger=self.logger)
+        self._worker = threading.Thread(target=self._work, name="ingest-jobs", daemon=True)
+        self._worker.start()
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._db_lock, self._connection:
+            return self._connection.execute(sql, params)
+
+    def _job(self, row) -> Dict:
+        job = dict(zip(_COLUMNS, row))
+        for key in ("tags", "progress", "result"):
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+    def submit(self, path: str, tags: Optional[List[str]] = None) -> int:
+        """
+        Queues a file or directory to be ingested.
+
+        Args:
+            path: The path of the file or directory.
+            tags: The tags stored with the chunks. Defaults to `ingest_tags` from the config file.
+
+        Returns:
+            int: The id of the job.
+        """
+        job_id = self._execute("INSERT INTO jobs (path, tags, state, submitted_at) VALUES (?, ?, 'queued', ?)",
+                               (os.path.abspath(path), None if tags is None else json.dumps(list(tags)),
+                                time.time())).lastrowid
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: int) -> Optional[Dict]:
+        """
+        Returns a job with its state, progress, result or error and the index version it published, or None
+        if there is no such job.
+        """
+        with self._db_lock:
+            row = self._connection.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?",
+                                           (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def jobs(self, limit: int = 100) -> List[Dict]:
+        """
+        Returns the `limit` most recently submitted jobs, newest first.
+        """
+        with self._db_lock:
+            rows = self._connection.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs ORDER BY id DESC LIMIT ?",
+                                            (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def wait(self, job_id: int, timeout: Optional[float] = None) -> Optional[Dict]:
+        """
+        Waits until a job is done or failed, the timeout expires or the queue is closed, and returns it.
+        """
+        with self._finished:
+            self._finished.wait_for(lambda: self._closed or (self.get(job_id) or {}).get("state", "done") in _FINISHED,
+                                    timeout)
+        return self.get(job_id)
+
+    @contextmanager
+    def snapshot(self) -> Iterator[Dict]:
+        """
+        Holds the published index version for the duration of a search.
+
+        Returns:
+            Iterator: The keyword arguments the search is to be given: the `watermark`, None while no job is
+            running, and the ids to `exclude`, those of a published job waiting to be deleted.
+        """
+        with self._lock.shared():
+            yield {"watermark": self._watermark, "exclude": self._hidden}
+
+    def _work(self) -> None:
+        while not self._closed:
+            self._wakeup.clear()
+            with self._db_lock:
+                row = self._connection.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE state = 'queued' "
+                                               f"ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                self._wakeup.wait()
+                continue
+            job = self._job(row)
+            try:
+                self._run(job)
+            except BaseException as err:
+                # publishing failed: the job is marked failed and the worker goes on with the next one, the rows
+                # the job touched are released when the queue is next opened
+                _common_.error_logger("IngestJobQueue", err, logger=self.logger, mode="error", ignore_flag=True,
+                                      addition_msg=job["path"])
+                with self._lock.exclusive():
+                    self._watermark = None
+                try:
+                    self._execute("UPDATE jobs SET state = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                                  (f"publishing failed: {err!r}", time.time(), job["id"]))
+                except sqlite3.Error:
+                    # the job database cannot be written, so the worker stops and waiting for a job returns
+                    self._closed = True
+                with self._finished:
+                    self._finished.notify_all()
+
+    def _run(self, job: Dict) -> None:
+        self._execute("UPDATE jobs SET state = 'running', started_at = ? WHERE id = ?", (time.time(), job["id"]))
+        _reported = [time.time()]
+
+        def _record(ids: List[int]):
+            with self._db_lock, self._connection:
+                self._connection.executemany("INSERT INTO job_rows (job_id, id) VALUES (?, ?)",
+                                             [(job["id"], _id) for _id in ids])
+
+        def _progress(progress: Dict):
+            if time.time() - _reported[0] >= _PROGRESS_INTERVAL:
+                self._execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job["id"]))
+                _reported[0] = time.time()
+
+        staged, result, error = _StagedStore(self.vector_db, _record), None, ""
+        try:
+            with self._lock.exclusive():
+                self._watermark = self.vector_db.watermark()
+            # searches are restricted to the watermark, so the store's readers need not catch up with each
+            # batch the job commits, only with the version it publishes
+            _hold = getattr(self.vector_db, "hold_readers", None)
+            with _hold() if _hold is not None else nullcontext():
+                # the undecorated functions, so a failure is recorded with the job instead of only logged
+                if os.path.isdir(job["path"]):
+                    result = _data_ingest.ingest_directory.__wrapped__(staged, self.embedding, job["path"],
+                                                                       logger=self.logger, tags=job["tags"],
+                                                                       progress=_progress)
+                else:
+                    result = _data_ingest.ingest_file.__wrapped__(staged, job["path"], logger=self.logger,
+                                                                  tags=job["tags"], progress=_progress)
+        except BaseException as err:
+            # the decorated helpers of the ingest functions stop with SystemExit, which must not end the worker
+            error = (str(err) if isinstance(err, Exception) else repr(err)) or type(err).__name__
+            _common_.error_logger("IngestJobQueue", err, logger=self.logger, mode="error", ignore_flag=True,
+                                  addition_msg=job["path"])
+        finally:
+            self._publish(job["id"], result, error)
+
+    def _stale(self, job_id: int) -> Tuple[int, Set[int]]:
+        # the number of rows a job inserted or deleted, and those of them that the manifest does not reference,
+        # i.e. the chunks it replaced and those it inserted without recording them before it failed
+        with self._db_lock:
+            _touched = {_id for _id, in self._connection.execute("SELECT id FROM job_rows WHERE job_id = ?",
+                                                                  (job_id,))}
+        if not _touched:
+            return 0, set()
+        manifest = _manifest_.load_manifest(_manifest_.manifest_location(self.vector_db))
+        return len(_touched), _touched - {_rowid for entry in manifest["files"].values()
+                                          for _, _rowid in entry["chunks"]}
+
+    def _release(self, job_id: int, stale: Optional[Set[int]] = None) -> None:
+        # deletes the stale rows of a job, see `_stale`, and forgets the rows it touched
+        if stale is None:
+            _, stale = self._stale(job_id)
+        if stale:
+            self.vector_db.delete(sorted(stale))
+        self._execute("DELETE FROM job_rows WHERE job_id = ?", (job_id,))
+
+    def _publish(self, job_id: int, result: Optional[Dict], error: str) -> None:
+        _changed, _stale = self._stale(job_id)
+        with self._lock.exclusive():
+            with self._db_lock, self._connection:
+                if _changed:
+                    self.version = self._connection.execute(
+                        "INSERT INTO index_versions (job_id, published_at) VALUES (?, ?)",
+                        (job_id, time.time())).lastrowid
+                self._connection.execute(
+                    "UPDATE jobs SET state = ?, result = ?, error = ?, version = ?, finished_at = ? WHERE id = ?",
+                    ("failed" if error else "done", json.dumps(result) if result is not None else None,
+                     error or None, self.version, time.time(), job_id))
+            self._watermark = None
+            self._hidden = self._hidden | _stale
+        with self._finished:
+            self._finished.notify_all()
+        _common_.info_logger(f"ingest job {job_id} {'failed' if error else 'done'}, index version {self.version}",
+                             logger=self.logger)
+        # the stale rows are already hidden, so they are deleted without holding searches back
+        try:
+            self._release(job_id, _stale)
+        except Exception as err:
+            # the job stays published and its stale rows hidden, they are deleted when the queue is next opened
+            _common_.error_logger("IngestJobQueue", err, logger=self.logger, mode="error", ignore_flag=True,
+                                  addition_msg=f"ingest job {job_id}")
+        else:
+            self._hidden = self._hidden - _stale
+
+    def close(self) -> None:
+        """
+        Stops the worker once the running job, if any, is published. Queued jobs stay queued and are run
+        when the queue is opened again.
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._worker.join()
+        with self._finished:
+            self._finished.notify_all()
+        with self._db_lock:
+            self._connection.close()
@@ -1,17 +1,201 @@
-from typing import List
-from langchain.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import io
+import os
+import mmap
+import codecs
+from typing import List, Iterator, Tuple, Dict
+from _config import _config as _config_
 from _common import _common as _common_
+from _common import _metrics as _metrics_
+from _data import _data_split as _data_split_
+from _util import _util_file as _util_file_
+
+_SEPARATORS = ["\n\n", "\n", " "]
+
+
+def _read_blocks(filepath: str, block_size: int, use_mmap: bool, encoding: str) -> Iterator[str]:
+    if not use_mmap:
+        with open(filepath, encoding=encoding) as file:
+            yield from iter(lambda: file.read(block_size), "")
+        return
+
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
+    with open(filepath, "rb") as file:
+        if not file.seek(0, io.SEEK_END):
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as _mapped:
+            for offset in range(0, len(_mapped), block_size):
+                yield decoder.decode(_mapped[offset: offset + block_size])
+            yield decoder.decode(b"", final=True)
+
+
+def iter_chunks(filepath: str,
+                chunk_size: int = 1000,
+                chunk_overlap: int = 80,
+                block_size: int = 1 << 20,
+                use_mmap: bool = False,
+                encoding: str = "utf-8") -> Iterator[Tuple[str, int]]:
+    """
+    Loads and splits a document incrementally like `iter_document`, yielding every chunk together with its
+    character offset in the decoded text of the file.
+
+    Returns:
+        Iterator[Tuple[str, int]]: The document chunks and their offsets, in document order.
+
+    """
+    buffer, offset = "", 0
+    for block in _read_blocks(filepath, block_size, use_mmap, encoding):
+        buffer += block
+        if len(buffer) <= block_size + chunk_size:
+            continue
+        _cut = next((_position for _position in (buffer.rfind(separator, chunk_size) for separator in _SEPARATORS)
+                     if _position > 0), len(buffer))
+        _text, _last = buffer[:_cut], 0
+        for start, end in _data_split_.split_offsets(_text, chunk_size, chunk_overlap):
+            yield _text[start: end], offset + start
+            _last = start
+        # the carried text starts with the tail of the last chunk, from its first separator within
+        # chunk_overlap characters of the cut, so the chunks on either side of the cut overlap as well
+        _keep = min((_position for _position in (buffer.find(separator, max(_cut - chunk_overlap, _last), _cut)
+                                                 for separator in _SEPARATORS) if _position != -1), default=_cut)
+        buffer, offset = buffer[_keep:], offset + _keep
+    for start, end in _data_split_.split_offsets(buffer, chunk_size, chunk_overlap):
+        yield buffer[start: end], offset + start
+
+
+def iter_document(filepath: str,
+                  chunk_size: int = 1000,
+                  chunk_overlap: int = 80,
+                  block_size: int = 1 << 20,
+                  use_mmap: bool = False,
+                  encoding: str = "utf-8") -> Iterator[str]:
+    """
+    Loads and splits a document incrementally, yielding chunks as the file is read.
+
+    The file is read in blocks of `block_size` characters (or bytes, when memory mapped). Whenever the
+    buffered text exceeds a block, it is cut at its last paragraph break (or line break, or space), the
+    part before the cut is split with `_data_split.split_offsets`, which produces the same chunks as
+    LangChain's RecursiveCharacterTextSplitter, and the resulting chunks are yielded while the rest of the
+    buffer is carried over, together with up to `chunk_overlap` characters of the last chunk so that the
+    chunks on either side of a cut overlap like any other consecutive chunks. Memory use is therefore
+    bounded by the block size, not the file size. Documents smaller than a block are split exactly as
+    `load_document` splits them.
+
+    Args:
+        filepath: The path to the file containing the document to be loaded.
+        chunk_size: The maximum number of characters in a chunk. Defaults to 1000.
+        chunk_overlap: The number of characters shared by consecutive chunks. Defaults to 80.
+        block_size: The size of the blocks the file is read in. Defaults to 1 MiB.
+        use_mmap: Whether to read the file through a memory map. Defaults to False.
+        encoding: The encoding of the file. Defaults to utf-8.
+
+    Returns:
+        Iterator[str]: The document chunks, in document order.
+
+    """
+    for chunk, _ in iter_chunks(filepath, chunk_size, chunk_overlap, block_size, use_mmap, encoding):
+        yield chunk
+
+
+def iter_records(filepath: str,
+                 text_field: str,
+                 id_field: str = "",
+                 chunk_size: int = 1000,
+                 chunk_overlap: int = 80,
+                 batch_size: int = 1000) -> Iterator[Tuple[str, Dict]]:
+    """
+    Loads and splits the records of a CSV, JSON Lines or JSON array file incrementally.
+
+    The records are streamed in batches of `batch_size` with `_util_file.iter_records`, so the file is never
+    held in memory as a whole. The `text_field` column or field of every record is split into chunks like a
+    document, and each chunk carries the id of its record and its character offset in the record's text as
+    metadata. Records without text are skipped.
+
+    Args:
+        filepath: The path of the file, ending in .csv, .jsonl, .ndjson or .json.
+        text_field: The column or field holding the text to be chunked.
+        id_field: The column or field holding the record id. Defaults to "", in which case the position of
+            the record in the file is used.
+        chunk_size: The maximum number of characters in a chunk. Defaults to 1000.
+        chunk_overlap: The number of characters shared by consecutive chunks. Defaults to 80.
+        batch_size: The number of records read at a time. Defaults to 1000.
+
+    Returns:
+        Iterator[Tuple[str, Dict]]: The chunks, each with a {"record_id": ..., "offset": ...} metadata dict, in
+        file order.
+
+    """
+    position = 0
+    for batch in _util_file_.iter_records(filepath, batch_size=batch_size):
+        for record in batch:
+            _text = record.get(text_field) if isinstance(record, dict) else None
+            _record_id = record.get(id_field, position) if id_field and isinstance(record, dict) else position
+            position += 1
+            if _text is None or _text == "":
+                continue
+            _text = str(_text)
+            for start, end in _data_split_.split_offsets(_text, chunk_size, chunk_overlap):
+                yield _text[start: end], {"record_id": _record_id, "offset": start}
+
+
+def is_record_file(filepath: str) -> bool:
+    """
+    Checks whether a file is ingested record by record, i.e. `ingest_record_text_field` is set and the file
+    is a CSV, JSON Lines or JSON file.
+    """
+    return bool(_config_.PGConfigSingleton().config.get("ingest_record_text_field")) and \
+        os.path.splitext(filepath)[1].lower() in _util_file_.RECORD_FORMATS
+
+
+def iter_source(filepath: str) -> Iterator[Tuple[str, Dict]]:
+    """
+    Loads and splits a file incrementally into chunks with their metadata.
+
+    Record files, see `is_record_file`, are split record by record with `iter_records`, using the
+    `ingest_record_text_field`, `ingest_record_id_field` and `ingest_record_batch_size` settings. Any other
+    file is split as a document with `iter_chunks`, with the chunk's character offset as metadata.
+
+    Args:
+        filepath: The path of the file.
+
+    Returns:
+        Iterator[Tuple[str, Dict]]: The chunks and their metadata, in file order.
+
+    """
+    if not is_record_file(filepath):
+        return ((chunk, {"offset": offset}) for chunk, offset in iter_chunks(filepath))
+    _config = _config_.PGConfigSingleton()
+    return iter_records(filepath,
+                        _config.config.get("ingest_record_text_field"),
+                        id_field=_config.config.get("ingest_record_id_field") or "",
+                        batch_size=int(_config.config.get("ingest_record_batch_size") or 1000))
+
+
+@_common_.exception_handler
+@_metrics_.timed("load_source", items=len)
+def load_source(filepath: str) -> List[Tuple[str, Dict]]:
+    """
+    Loads and splits a file into chunks with their metadata, see `iter_source`.
+
+    Args:
+        filepath: The path of the file.
+
+    Returns:
+        List[Tuple[str, Dict]]: The chunks and their metadata.
+
+    """
+    return list(iter_source(filepath))
 
 
 @_common_.exception_handler
+@_metrics_.timed("load_document", items=len)
 def load_document(filepath: str) -> List:
     """
     Loads and processes a document from a given file path.
 
     This function reads a document from the specified file path and splits it into
     smaller chunks. Each chunk is a part of the document, divided based on character count,
-    with a specified overlap between consecutive chunks.
+    with a specified overlap between consecutive chunks. The file is read and split
+    incrementally with `iter_document`, so it is never held in memory as a whole.
 
     Args:
         filepath: The path to the file containing the document to be loaded.
@@ -21,6 +205,4 @@ def load_document(filepath: str) -> List:
 
 
     """
-    documents = TextLoader(filepath).load()
-    return [doc.page_content for doc in
-            RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=80).split_documents(documents)]
+    return list(iter_document(filepath))
@@ -0,0 +1,110 @@
+import re
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import List, Tuple
+import numpy as np
+
+SEPARATORS = ["\n\n", "\n", " ", ""]
+
+
+class _Splitter:
+    def __init__(self, text: str, chunk_size: int, chunk_overlap: int, separators: List[str]):
+        self.text = text
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators
+        self.patterns = {separator: re.compile(f"({re.escape(separator)})") for separator in separators if separator}
+        self.chunks: List[Tuple[int, int]] = []
+
+    def _bounds(self, separator: str, start: int, end: int) -> List[int]:
+        # the boundaries of the pieces the span is split into, each piece starting with its separator, from
+        # the lengths of the parts of one re.split call; empty pieces are dropped like the splitter drops them
+        if not separator:
+            return list(range(start, end + 1))
+        _offsets = list(accumulate(map(len, self.patterns[separator].split(self.text[start: end])), initial=start))
+        bounds = _offsets[0:1] + _offsets[1::2] + [end]
+        return bounds[1:] if bounds[0] == bounds[1] else bounds
+
+    def _emit(self, start: int, end: int) -> None:
+        while start < end and self.text[start].isspace():
+            start += 1
+        while end > start and self.text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            self.chunks.append((start, end))
+
+    def _merge(self, bounds: List[int], first: int, last: int) -> None:
+        # merges the pieces first..last-1, i.e. [bounds[i], bounds[i + 1]), into chunks of at most chunk_size
+        # characters; a chunk takes as many pieces as fit, and the next one starts with the longest tail of
+        # them that is within chunk_overlap and still leaves room for the piece that did not fit
+        i = first
+        while True:
+            j = max(bisect_right(bounds, bounds[i] + self.chunk_size, i, last + 1) - 1, i + 1)
+            self._emit(bounds[i], bounds[j])
+            if j >= last:
+                return
+            i = min(max(bisect_left(bounds, bounds[j] - self.chunk_overlap, i, j + 1),
+                        bisect_left(bounds, bounds[j + 1] - self.chunk_size, i, j + 1)), j)
+
+    def split(self, start: int, end: int, level: int) -> None:
+        separator, _next_level = self.separators[-1], len(self.separators)
+        for i in range(level, len(self.separators)):
+            if not self.separators[i]:
+                separator = ""
+                break
+            if self.text.find(self.separators[i], start, end) != -1:
+                separator, _next_level = self.separators[i], i + 1
+                break
+
+        bounds = self._bounds(separator, start, end)
+        first = 0
+        for i in np.flatnonzero(np.diff(bounds) >= self.chunk_size).tolist():
+            if i > first:
+                self._merge(bounds, first, i)
+            if _next_level >= len(self.separators):
+                self.chunks.append((bounds[i], bounds[i + 1]))
+            else:
+                self.split(bounds[i], bounds[i + 1], _next_level)
+            first = i + 1
+        if first < len(bounds) - 1:
+            self._merge(bounds, first, len(bounds) - 1)
+
+
+def split_offsets(text: str, chunk_size: int = 1000, chunk_overlap: int = 80,
+                  separators: List[str] = None) -> List[Tuple[int, int]]:
+    """
+    Splits a text into chunks and returns their (start, end) offsets instead of copies of the text.
+
+    The chunks are the same as those of LangChain's RecursiveCharacterTextSplitter with its default
+    settings: the text is split at the first separator that occurs in it, pieces shorter than `chunk_size`
+    are merged into chunks of at most `chunk_size` characters that share up to `chunk_overlap` characters,
+    longer pieces are split again with the next separator, and chunks are stripped of surrounding
+    whitespace. Every piece boundary is found by one regex pass per separator level, and chunks are cut by
+    bisecting the cumulative piece offsets, so the Python work grows with the number of chunks rather than
+    the number of pieces, and no piece is copied.
+
+    Args:
+        text: The text to be split.
+        chunk_size: The maximum number of characters in a chunk. Defaults to 1000.
+        chunk_overlap: The maximum number of characters shared by consecutive chunks. Defaults to 80.
+        separators: The separators, tried in order. Defaults to paragraph, line, space and character.
+
+    Returns:
+        List[Tuple[int, int]]: The start and end offset of each chunk, in document order.
+    """
+    if chunk_overlap > chunk_size:
+        raise ValueError(f"chunk_overlap {chunk_overlap} is larger than chunk_size {chunk_size}")
+    splitter = _Splitter(text, chunk_size, chunk_overlap, separators or SEPARATORS)
+    if text:
+        splitter.split(0, len(text), 0)
+    return splitter.chunks
+
+
+def split_text(text: str, chunk_size: int = 1000, chunk_overlap: int = 80, separators: List[str] = None) -> List[str]:
+    """
+    Splits a text into chunks, see `split_offsets`.
+
+    Returns:
+        List[str]: The chunks, in document order.
+    """
+    return [text[start: end] for start, end in split_offsets(text, chunk_size, chunk_overlap, separators)]
@@ -0,0 +1,113 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Callable, Optional
+from langchain.embeddings.base import Embeddings
+
+_CHARS_PER_TOKEN = 4
+_SPECIAL_TOKENS = 2
+
+_worker_embedding = None
+
+
+def _init_worker(factory: Callable[[], Embeddings], threads: int) -> None:
+    global _worker_embedding
+    import torch
+    _worker_embedding = factory()
+    # set after the factory, which may apply `embedding_intra_op_threads` meant for the parent process
+    torch.set_num_threads(threads)
+
+
+def _encode(texts: List[str]) -> List[List[float]]:
+    return _worker_embedding.embed_documents(texts)
+
+
+class BucketedEmbeddings(Embeddings):
+    def __init__(self, embedding: Embeddings, token_budget: int = 4096, max_batch_size: int = 256,
+                 max_tokens: int = 128, workers: int = 0, threads_per_worker: int = 1,
+                 factory: Optional[Callable[[], Embeddings]] = None):
+        """
+        Embedding front-end that batches texts by length instead of arrival order.
+
+        Texts are sorted by their estimated token count, longest first, and cut into batches whose padded size,
+        the batch length times the longest text in it, stays within `token_budget`, so short chunks are not
+        padded to the length of a long one and batches of short chunks hold more texts. The vectors are
+        returned in the order of the input texts.
+
+        With `workers` set, the batches are encoded in parallel by that many processes, each holding its own
+        model created by `factory` and limited to `threads_per_worker` torch threads, so the processes do not
+        oversubscribe the cores.
+
+        Args:
+            embedding: The embedding model used in this process.
+            token_budget: The maximum padded tokens per batch. Defaults to 4096.
+            max_batch_size: The maximum number of texts per batch. Defaults to 256.
+            max_tokens: The maximum sequence length of the model, longer texts are truncated by it.
+                Defaults to 128.
+            workers: The number of encoding processes, 0 to encode in this process. Defaults to 0.
+            threads_per_worker: The number of torch threads per encoding process. Defaults to 1.
+            factory: A picklable function creating the embedding model in an encoding process.
+                Required if `workers` is set.
+        """
+        self.embedding = embedding
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.workers = workers if factory is not None else 0
+        self.threads_per_worker = threads_per_worker
+        self.factory = factory
+        self._executor = None
+
+    def tokens(self, text: str) -> int:
+        """
+        Estimates the padded sequence length of a text, at about four characters per token.
+        """
+        return min(len(text) // _CHARS_PER_TOKEN + _SPECIAL_TOKENS, self.max_tokens)
+
+    def batches(self, texts: List[str]) -> List[List[int]]:
+        """
+        Groups the positions of texts into token-budgeted batches of similar length.
+
+        Args:
+            texts: The texts to be embedded.
+
+        Returns:
+            List[List[int]]: The positions of the texts of each batch.
+        """
+        _order = sorted(range(len(texts)), key=lambda i: self.tokens(texts[i]), reverse=True)
+        batches, batch, _longest = [], [], 0
+        for i in _order:
+            _longest = max(_longest, self.tokens(texts[i]))
+            if batch and (len(batch) >= self.max_batch_size or (len(batch) + 1) * _longest > self.token_budget):
+                batches.append(batch)
+                batch, _longest = [], self.tokens(texts[i])
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = self.batches(texts)
+        _texts = [[texts[i] for i in batch] for batch in batches]
+        if self.workers and len(batches) > 1:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=_init_worker,
+                                                     initargs=(self.factory, self.threads_per_worker))
+            _vectors = self._executor.map(_encode, _texts)
+        else:
+            _vectors = map(self.embedding.embed_documents, _texts)
+
+        vectors = [None] * len(texts)
+        for batch, _batch_vectors in zip(batches, _vectors):
+            for i, vector in zip(batch, _batch_vectors):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedding.embed_query(text)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
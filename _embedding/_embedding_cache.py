@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+from array import array
+from typing import List, Dict, Any
+from langchain.embeddings.base import Embeddings
+from _config import _config as _config_
+from _common import _common as _common_
+from _util import _util_directory as _util_directory_
+
+
+_LOOKUP_BATCH = 500
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embedding: Embeddings, model_name: str, cache_location: str, max_entries: int = 0):
+        """
+        Wraps an embedding model with a persistent, content-addressed vector cache.
+
+        Vectors are stored in a SQLite file keyed by (model name, sha256 of the chunk text), so the same
+        chunk embedded by the same model is only ever encoded once, across runs and processes. The cache
+        is bounded by `max_entries` and evicts the least recently used vectors first; the number of stored
+        vectors is counted once when the cache is opened and kept up to date as vectors are stored and
+        evicted, so vectors stored by other processes meanwhile are only counted when it is next opened.
+        Vectors are stored as float32, which is the native precision of the sentence-transformers models.
+
+        Args:
+            embedding: The embedding model whose results are cached.
+            model_name: The model name used as part of the cache key.
+            cache_location: The path of the SQLite file holding the cached vectors.
+            max_entries: The maximum number of cached vectors. 0 or less means unbounded.
+        """
+        self.embedding = embedding
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_location, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache "
+            "(model TEXT, text_hash TEXT, vector BLOB, last_access REAL, PRIMARY KEY (model, text_hash))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embedding_cache_last_access ON embedding_cache (last_access)"
+        )
+        self._connection.commit()
+        self._entries = self._connection.execute("SELECT count(*) FROM embedding_cache").fetchone()[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, self.model_name, self.embedding.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], f"{self.model_name}:query",
+                           lambda _texts: [self.embedding.embed_query(_text) for _text in _texts])[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the cache counters.
+
+        Returns:
+            Dict: The number of hits, misses and stored vectors, and the hit rate since the cache was created.
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT count(*) FROM embedding_cache").fetchone()[0]
+            hits, misses = self.hits, self.misses
+        return {"hits": hits,
+                "misses": misses,
+                "entries": entries,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+
+    def close(self) -> None:
+        self._connection.close()
+        if hasattr(self.embedding, "close"):
+            self.embedding.close()
+
+    def _embed(self, texts: List[str], model: str, embed_func) -> List[List[float]]:
+        keys = [_text_hash(text) for text in texts]
+        vectors = self._lookup(model, list(set(keys)))
+        _missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                _missing.setdefault(key, text)
+
+        if _missing:
+            for key, vector in zip(_missing.keys(), embed_func(list(_missing.values()))):
+                vectors[key] = vector
+            self._store(model, {key: vectors[key] for key in _missing})
+
+        with self._lock:
+            self.hits += len(keys) - len(_missing)
+            self.misses += len(_missing)
+        return [vectors[key] for key in keys]
+
+    def _lookup(self, model: str, keys: List[str]) -> Dict[str, List[float]]:
+        found, now = {}, time.time()
+        with self._lock:
+            for i in range(0, len(keys), _LOOKUP_BATCH):
+                _batch = keys[i: i + _LOOKUP_BATCH]
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embedding_cache "
+                    f"WHERE model = ? AND text_hash IN ({','.join('?' * len(_batch))})",
+                    [model, *_batch]
+                ).fetchall()
+                found.update({_hash: array("f", _vector).tolist() for _hash, _vector in rows})
+            if found:
+                self._connection.executemany(
+                    "UPDATE embedding_cache SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, _hash) for _hash in found]
+                )
+                self._connection.commit()
+        return found
+
+    def _store(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        now = time.time()
+        with self._lock:
+            # a vector stored meanwhile by another process is the same vector, so it is kept as it is
+            _changes = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO embedding_cache (model, text_hash, vector, last_access) VALUES (?, ?, ?, ?)",
+                [(model, _hash, array("f", _vector).tobytes(), now) for _hash, _vector in vectors.items()]
+            )
+            self._entries += self._connection.total_changes - _changes
+            if 0 < self.max_entries < self._entries:
+                self._entries -= self._connection.execute(
+                    "DELETE FROM embedding_cache WHERE rowid IN "
+                    "(SELECT rowid FROM embedding_cache ORDER BY last_access LIMIT ?)",
+                    (self._entries - self.max_entries,)
+                ).rowcount
+            self._connection.commit()
+
+
+@_common_.exception_handler
+def cached_embedding(embedding: Embeddings, model_name: str) -> Embeddings:
+    """
+    Wraps an embedding model with the persistent embedding cache configured in the config file.
+
+    The cache location is taken from `embedding_cache_location` and its size bound from
+    `embedding_cache_max_entries`. If no cache location is configured, the embedding model
+    is returned unchanged.
+
+    Args:
+        embedding: The embedding model to be wrapped.
+        model_name: The name of the model, used as part of the cache key.
+
+    Returns:
+        Embeddings: A CachedEmbeddings instance wrapping the model, or the model itself if caching is disabled.
+
+    """
+    _config = _config_.PGConfigSingleton()
+    _location = _config.config.get("embedding_cache_location")
+    if not _location:
+        return embedding
+    _location = os.path.expanduser(_location)
+    _util_directory_.create_directory(os.path.dirname(_location))
+    return CachedEmbeddings(embedding,
+                            model_name=model_name,
+                            cache_location=_location,
+                            max_entries=int(_config.config.get("embedding_cache_max_entries") or 0))
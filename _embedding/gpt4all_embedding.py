@@ -1,25 +1,79 @@
-from torch import cuda
-from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+import functools
+from typing import TYPE_CHECKING
+from _config import _config as _config_
 from _common import _common as _common_
 
+if TYPE_CHECKING:
+    from langchain.embeddings.base import Embeddings
+
+MODEL_NAME = "sentence-transformers/paraphrase-MiniLM-L6-v2"
+
 
 @_common_.exception_handler
-def gpt4all_embedding() -> HuggingFaceEmbeddings:
+def gpt4all_embedding(cache: bool = True, batching: bool = True, quantization: str = None) -> "Embeddings":
     """
     Creates an instance of HuggingFaceEmbeddings with a specified transformer model.
 
     This function initializes an embedding model specifically designed for paraphrase
     detection using the 'sentence-transformers/paraphrase-MiniLM-L6-v2' model. It
     automatically detects the available device (GPU or CPU) for running the model.
+    Unless disabled, the model is wrapped with the persistent embedding cache so chunks
+    that were already embedded are not encoded again.
+
+    If `embedding_token_budget` is set, documents are encoded in length-bucketed batches of at
+    most that many padded tokens, optionally spread over `embedding_workers` processes with
+    `embedding_worker_threads` torch threads each.
+
+    With quantization "int8", the linear layers of the model are dynamically quantized to int8 on
+    CPU hosts, and the vectors are cached under a separate model name. `embedding_intra_op_threads`
+    sets the number of torch threads used for encoding in this process.
+
+    Args:
+        cache: Whether to wrap the model with the persistent embedding cache. Defaults to True.
+        batching: Whether to encode documents in length-bucketed batches. Defaults to True.
+        quantization: "int8" or "none". Defaults to `embedding_quantization` from the config file.
 
     Returns:
-        HuggingFaceEmbeddings: An instance of the HuggingFaceEmbeddings class configured
-        with the paraphrase detection transformer model.
+        Embeddings: An instance of the HuggingFaceEmbeddings class configured with the
+        paraphrase detection transformer model, optionally wrapped by BucketedEmbeddings
+        and CachedEmbeddings.
 
     """
+    # torch and the model libraries take seconds to import, so they are only loaded once a model is needed
+    from torch import cuda
+    from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+    from _embedding import _embedding_cache as _embedding_cache_
+    from _embedding import _batching as _batching_
+    from _embedding import _quantized as _quantized_
+
+    _config = _config_.PGConfigSingleton()
+    if quantization is None:
+        quantization = _config.config.get("embedding_quantization") or "none"
+    if quantization not in ("none", "int8"):
+        raise ValueError(f"embedding quantization {quantization} not found, valid list is ['none', 'int8']")
+    if int(_config.config.get("embedding_intra_op_threads") or 0) > 0:
+        import torch
+        torch.set_num_threads(int(_config.config.get("embedding_intra_op_threads")))
+    _token_budget = int(_config.config.get("embedding_token_budget") or 0) if batching else 0
+    _max_batch_size = int(_config.config.get("embedding_max_batch_size") or 256)
     device = f"cuda: {cuda.current_device()}" if cuda.is_available() else "cpu"
-    return HuggingFaceEmbeddings(
-        model_name="sentence-transformers/paraphrase-MiniLM-L6-v2",
+    embedding = HuggingFaceEmbeddings(
+        model_name=MODEL_NAME,
         model_kwargs={"device": device},
-        encode_kwargs={"device": device, "batch_size": 32},
+        # a bucketed batch is encoded in one forward pass
+        encode_kwargs={"device": device, "batch_size": _max_batch_size if _token_budget else 32},
     )
+    _model_name = MODEL_NAME
+    if quantization == "int8" and device == "cpu":
+        embedding = _quantized_.quantize_dynamic(embedding)
+        _model_name = f"{MODEL_NAME}:int8"
+    if _token_budget:
+        embedding = _batching_.BucketedEmbeddings(
+            embedding,
+            token_budget=_token_budget,
+            max_batch_size=_max_batch_size,
+            max_tokens=embedding.client.max_seq_length,
+            workers=int(_config.config.get("embedding_workers") or 0),
+            threads_per_worker=int(_config.config.get("embedding_worker_threads") or 1),
+            factory=functools.partial(gpt4all_embedding, cache=False, batching=False, quantization=quantization))
+    return _embedding_cache_.cached_embedding(embedding, _model_name) if cache else embedding
@@ -1,20 +1,29 @@
-from langchain.embeddings import OpenAIEmbeddings
+from typing import TYPE_CHECKING
 from _common import _common as _common_
 
+if TYPE_CHECKING:
+    from langchain.embeddings.base import Embeddings
+
 
 @_common_.exception_handler
-def gpt4all_embedding() -> OpenAIEmbeddings:
+def gpt4all_embedding(cache: bool = True) -> "Embeddings":
     """
     Creates and returns an instance of OpenAIEmbeddings.
 
     This function is a simple factory method for creating an instance of the OpenAIEmbeddings class.
     The OpenAIEmbeddings class is assumed to be a part of a library that provides embedding functionalities,
-    possibly related to OpenAI's models like GPT-4. This function does not take any arguments and returns
-    a new instance of OpenAIEmbeddings with default settings.
+    possibly related to OpenAI's models like GPT-4. Unless disabled, the instance is wrapped with the
+    persistent embedding cache, keyed by the OpenAI model name.
+
+    Args:
+        cache: Whether to wrap the model with the persistent embedding cache. Defaults to True.
 
     Returns:
-        OpenAIEmbeddings: An instance of the OpenAIEmbeddings class.
+        Embeddings: An instance of the OpenAIEmbeddings class, optionally wrapped by CachedEmbeddings.
 
     """
-    return OpenAIEmbeddings()
+    from langchain.embeddings import OpenAIEmbeddings
+    from _embedding import _embedding_cache as _embedding_cache_
 
+    embedding = OpenAIEmbeddings()
+    return _embedding_cache_.cached_embedding(embedding, f"openai/{embedding.model}") if cache else embedding
@@ -0,0 +1,324 @@
+import time
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from logging import Logger as Log
+from typing import Any, Callable, Dict, List, Optional
+from langchain.llms.base import LLM
+from _config import _config as _config_
+from _common import _common as _common_
+
+_MAX_RETRIES = 1
+
+
+def _gpt4all_factory(threads: int):
+    from _llm import langchain
+    _config_.PGConfigSingleton().config["retrieval_qa_thread_count"] = threads
+    return langchain.gpt4all_llm()
+
+
+class _TokenSender:
+    # queue-like adapter so TokenQueueHandler sends the worker's tokens back to the scheduler
+    def __init__(self, connection, task_id: int):
+        self.connection, self.task_id = connection, task_id
+
+    def put(self, token: str) -> None:
+        self.connection.send(("token", self.task_id, token))
+
+
+def _worker_main(connection, factory: Callable, threads: int) -> None:
+    from _llm import langchain
+    try:
+        llm = factory(threads)
+    except BaseException as err:
+        connection.send(("failed", None, repr(err)))
+        return
+    connection.send(("ready", None, None))
+    while (message := connection.recv()) is not None:
+        task_id, prompt, stop = message
+        try:
+            text = llm(prompt, stop=stop, callbacks=[langchain.TokenQueueHandler(_TokenSender(connection, task_id))])
+            connection.send(("done", task_id, text))
+        except Exception as err:
+            connection.send(("error", task_id, repr(err)))
+
+
+class _Worker:
+    def __init__(self, process, connection):
+        self.process = process
+        self.connection = connection
+        self.ready = False
+        self.task_id = None
+        self.started = 0.0
+
+
+class _Task:
+    def __init__(self, prompt: str, stop: Optional[List[str]], on_token: Optional[Callable[[str], None]]):
+        self.prompt = prompt
+        self.stop = stop
+        self.on_token = on_token
+        self.future = Future()
+        self.attempts = 0
+
+
+class LLMWorkerPool:
+    def __init__(self, worker_count: int, threads_per_worker: int, timeout: float = 0,
+                 factory: Callable[[int], Any] = _gpt4all_factory, logger: Log = None):
+        """
+        A pool of language model worker processes, each holding its own model copy.
+
+        Every worker loads the model with `threads_per_worker` threads, so `worker_count` workers partition
+        the cores between them. A scheduler thread hands each prompt to an idle worker, forwards the tokens
+        it streams back, and replaces workers that crash or exceed `timeout` seconds on a prompt; the prompt
+        of a crashed worker is retried once on another worker before its future fails. If no worker can
+        load the model, every queued prompt fails and so does every prompt submitted afterwards.
+
+        Args:
+            worker_count: The number of worker processes.
+            threads_per_worker: The number of threads each worker's model generates with.
+            timeout: The maximum seconds a prompt may take before its worker is restarted, 0 for no limit.
+                Defaults to 0.
+            factory: A picklable function creating the model from a thread count. Defaults to GPT4All.
+            logger: A logger object for logging messages. Defaults to None.
+        """
+        self.worker_count = worker_count
+        self.threads_per_worker = threads_per_worker
+        self.timeout = timeout
+        self.factory = factory
+        self.logger = logger
+        self.restarts = 0
+        self.completed = 0
+        self.failed = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._tasks: Dict[int, _Task] = {}
+        self._pending = deque()
+        self._closed = False
+        self._error = ""
+        self._wakeup_reader, self._wakeup_writer = self._context.Pipe(duplex=False)
+        self._workers: List[Optional[_Worker]] = [self._start_worker() for _ in range(worker_count)]
+        self._scheduler = threading.Thread(target=self._schedule, daemon=True, name="llm-pool-scheduler")
+        self._scheduler.start()
+
+    def _start_worker(self) -> _Worker:
+        _parent, _child = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(_child, self.factory, self.threads_per_worker),
+                                        daemon=True)
+        process.start()
+        _child.close()
+        return _Worker(process, _parent)
+
+    def submit(self, prompt: str, stop: Optional[List[str]] = None,
+               on_token: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        Queues a prompt for the next idle worker.
+
+        Args:
+            prompt: The prompt to be completed.
+            stop: The stop sequences. Defaults to None.
+            on_token: Called from the scheduler thread with every generated token. Defaults to None.
+
+        Returns:
+            Future: Resolves to the generated text.
+
+        Raises:
+            RuntimeError: If the pool is closed or none of its workers could load the model.
+        """
+        task = _Task(prompt, stop, on_token)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("the language model pool is closed")
+            if self._error:
+                raise RuntimeError(self._error)
+            _task_id = next(self._ids)
+            self._tasks[_task_id] = task
+            self._pending.append(_task_id)
+            self._wakeup_writer.send(None)
+        return task.future
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"workers": sum(1 for worker in self._workers if worker is not None),
+                    "ready": sum(1 for worker in self._workers if worker is not None and worker.ready),
+                    "busy": sum(1 for worker in self._workers if worker is not None and worker.task_id is not None),
+                    "queued": len(self._pending),
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "restarts": self.restarts}
+
+    def _dispatch(self) -> None:
+        with self._lock:
+            for worker in self._workers:
+                if not self._pending:
+                    return
+                if worker is None or not worker.ready or worker.task_id is not None:
+                    continue
+                _task_id = self._pending.popleft()
+                _task = self._tasks[_task_id]
+                _task.attempts += 1
+                worker.task_id, worker.started = _task_id, time.monotonic()
+                try:
+                    worker.connection.send((_task_id, _task.prompt, _task.stop))
+                except OSError:
+                    # the worker died; its sentinel fires next and the prompt is retried on its replacement
+                    pass
+
+    def _finish(self, task_id: int, result: Any = None, error: BaseException = None) -> None:
+        with self._lock:
+            task = self._tasks.pop(task_id, None)
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        if task is not None and not task.future.done():
+            task.future.set_exception(error) if error is not None else task.future.set_result(result)
+
+    def _replace(self, index: int, error: BaseException) -> None:
+        worker = self._workers[index]
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.process.join(timeout=5)
+        worker.connection.close()
+        _task_id = worker.task_id
+        _common_.error_logger("LLMWorkerPool", error, logger=self.logger, mode="error", ignore_flag=True,
+                              addition_msg=f"worker {worker.process.pid}")
+        if not worker.ready:
+            # a worker that could not even load the model would fail again, so its slot is given up
+            self._workers[index] = None
+            if not any(self._workers):
+                with self._lock:
+                    # kept, so later prompts fail right away instead of waiting for a worker that never comes
+                    self._error = f"no language model worker could be started: {error}"
+                    _failed, self._pending = list(self._pending), deque()
+                for _pending_id in _failed:
+                    self._finish(_pending_id, error=RuntimeError(self._error))
+            return
+
+        with self._lock:
+            self.restarts += 1
+            _task = self._tasks.get(_task_id) if _task_id is not None else None
+            _retry = _task is not None and _task.attempts <= _MAX_RETRIES and not isinstance(error, TimeoutError)
+            if _retry:
+                self._pending.appendleft(_task_id)
+        if _task is not None and not _retry:
+            self._finish(_task_id, error=error)
+        self._workers[index] = self._start_worker()
+
+    def _receive(self, index: int) -> None:
+        worker = self._workers[index]
+        try:
+            kind, task_id, payload = worker.connection.recv()
+        except (EOFError, OSError):
+            self._replace(index, RuntimeError(f"worker exited with code {worker.process.exitcode}"))
+            return
+        if kind == "token":
+            _task = self._tasks.get(task_id)
+            if _task is not None and _task.on_token is not None:
+                _task.on_token(payload)
+        elif kind == "ready":
+            worker.ready = True
+        elif kind == "failed":
+            self._replace(index, RuntimeError(f"worker could not load the model: {payload}"))
+        else:
+            worker.task_id = None
+            self._finish(task_id, result=payload) if kind == "done" else \
+                self._finish(task_id, error=RuntimeError(payload))
+
+    def _schedule(self) -> None:
+        while not self._closed:
+            self._dispatch()
+            _handles = {self._wakeup_reader: None}
+            for index, worker in enumerate(self._workers):
+                if worker is not None:
+                    _handles[worker.connection] = index
+                    _handles[worker.process.sentinel] = index
+            for handle in wait(list(_handles), timeout=1):
+                if handle is self._wakeup_reader:
+                    while self._wakeup_reader.poll():
+                        self._wakeup_reader.recv()
+                    continue
+                index = _handles[handle]
+                worker = self._workers[index]
+                if worker is None or (handle is not worker.connection and handle != worker.process.sentinel):
+                    continue
+                if handle is worker.connection or worker.connection.poll():
+                    self._receive(index)
+                elif not worker.process.is_alive():
+                    self._replace(index, RuntimeError(f"worker exited with code {worker.process.exitcode}"))
+
+            _now = time.monotonic()
+            for index, worker in enumerate(self._workers):
+                if worker is not None and worker.task_id is not None and self.timeout \
+                        and _now - worker.started > self.timeout:
+                    self._replace(index, TimeoutError(f"no answer within {self.timeout} seconds"))
+
+    def close(self) -> None:
+        """
+        Stops the workers and fails every prompt that is still queued or running.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup_writer.send(None)
+        self._scheduler.join(timeout=5)
+        for worker in self._workers:
+            if worker is None:
+                continue
+            try:
+                worker.connection.send(None)
+            except (OSError, ValueError):
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.connection.close()
+        for _task_id in list(self._tasks):
+            self._finish(_task_id, error=RuntimeError("the language model pool was closed"))
+
+
+class PooledLLM(LLM):
+    """
+    LangChain LLM that completes prompts on an LLMWorkerPool, so it can be used by `qa_chain` like the
+    in-process GPT4All model while concurrent calls run on different workers. A call waits at most
+    `result_timeout` seconds for its prompt to be queued and generated.
+    """
+    pool: Any
+    result_timeout: float = 600
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        future = self.pool.submit(prompt, stop=stop, on_token=run_manager.on_llm_new_token if run_manager else None)
+        try:
+            return future.result(timeout=self.result_timeout or None)
+        except TimeoutError:
+            raise TimeoutError(f"no answer from the language model pool within {self.result_timeout} seconds")
+
+
+def gpt4all_pool_llm(logger: Log = None) -> PooledLLM:
+    """
+    Creates a GPT4All worker pool from the config file and wraps it as a LangChain LLM.
+
+    The pool has `llm_worker_count` workers of `llm_worker_threads` threads each, and a worker is restarted
+    when a prompt takes longer than `llm_worker_timeout` seconds. A generation fails if its prompt is not
+    answered within `llm_request_timeout` seconds, queueing included.
+
+    Args:
+        logger: A logger object for logging messages. Defaults to None.
+
+    Returns:
+        PooledLLM: The pooled model, whose pool is closed with `llm.pool.close()`.
+    """
+    _config = _config_.PGConfigSingleton()
+    return PooledLLM(pool=LLMWorkerPool(int(_config.config.get("llm_worker_count") or 1),
+                                        int(_config.config.get("llm_worker_threads") or 8),
+                                        timeout=float(_config.config.get("llm_worker_timeout") or 0),
+                                        logger=logger),
+                     result_timeout=float(_config.config.get("llm_request_timeout") or 600))
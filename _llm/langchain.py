@@ -1,17 +1,44 @@
 import os
-from langchain.chains import RetrievalQA
-from langchain.llms import OpenAI, GPT4All
+from queue import Queue
+from typing import Any, TYPE_CHECKING
+from langchain.callbacks.base import BaseCallbackHandler
 from _config import _config as _config_
 
+if TYPE_CHECKING:
+    from langchain.llms import GPT4All
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    """
+    Callback handler that puts every generated token on a queue, followed by `DONE` once generation ends.
+    """
+    DONE = object()
+
+    def __init__(self, tokens: Queue):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.put(token)
+
+
+def gpt4all_llm() -> "GPT4All":
+    from langchain.llms import GPT4All
 
-def qa_chain(retriever):
     _config = _config_.PGConfigSingleton()
     _location = _config.config.get("model_location")
     _location = os.path.expanduser(_location) if _location.startswith("~") else _location
+    return GPT4All(model=_location,
+                   n_threads=_config.config.get("retrieval_qa_thread_count"),
+                   streaming=True
+                   )
+
+
+def qa_chain(retriever, llm=None):
+    from langchain.chains import RetrievalQA
+
+    _config = _config_.PGConfigSingleton()
     return RetrievalQA.from_chain_type(
         retriever=retriever,
-        llm=GPT4All(model=_location,
-                    n_threads=_config.config.get("retrieval_qa_thread_count")
-                    ),
+        llm=llm or gpt4all_llm(),
         chain_type=_config.config.get("retrieval_qa_type")
     )
@@ -0,0 +1,291 @@
+import os
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger as Log
+from typing import Any, Dict, List, Tuple, Optional, Union
+from _config import _config as _config_
+from _common import _common as _common_
+from _common import _metrics as _metrics_
+from _vectordb import _metadata as _metadata_
+from _task.rag_engine import RagEngine
+
+_MAX_BODY_SIZE = 1 << 20
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 422: "Unprocessable Entity",
+            500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class IngestJobFailed(RuntimeError):
+    def __init__(self, job: Dict):
+        """
+        Raised by `RagServer.ingest` when the ingest job failed; the job, with its error, is kept as `job`.
+        """
+        super().__init__(f"ingest job {job['id']} failed: {job['error']}")
+        self.job = job
+
+
+class RagServer:
+    def __init__(self, engine: RagEngine = None, logger: Log = None):
+        """
+        An asyncio HTTP front-end serving questions and ingest requests from a single warm RagEngine.
+
+        Incoming questions are put on a bounded queue. A batcher takes up to `server_batch_size` of them,
+        waiting at most `server_batch_wait_ms` for a batch to fill, embeds them in one call, answers those
+        close enough to a cached question from the answer cache, retrieves the rest in one call, and hands
+        them to the language model: a single in-process model generating with
+        `retrieval_qa_thread_count` threads, or, if `llm_worker_count` is set, that many worker processes
+        generating in parallel. A full queue is answered with 503 and a question not answered within
+        `server_request_timeout` seconds with 504. Files are ingested by the engine's background job queue,
+        so questions are answered from the last published index version while a file is being ingested, and
+        an ingest job that fails is answered with 422 and its error.
+
+        Endpoints:
+            POST /query   {"query": "...", "filter": {...}}   -> {"answer": "...", "sources": [...]}
+            POST /ingest  {"filepath": "...", "tags": [...]}  -> {"added": n, "removed": n, "kept": n, "job": id}
+            POST /ingest  {"filepath": "...", "wait": false}  -> the queued job, {"id": id, "state": "queued", ...}
+            GET  /jobs                          -> the most recent ingest jobs, newest first
+            GET  /jobs/<id>                     -> {"id": id, "state": "...", "progress": {...}, "result": {...}}
+            GET  /health                        -> {"status": "ok", "queued": n, "answer_cache": {...}}
+            GET  /metrics                       -> per-stage timings in the Prometheus text format
+
+        Args:
+            engine: The engine used to answer questions. Defaults to a new RagEngine.
+            logger: A logger object for logging messages. Defaults to None.
+        """
+        _config = _config_.PGConfigSingleton()
+        self.engine = engine or RagEngine(logger=logger)
+        self.logger = logger
+        self.batch_size = int(_config.config.get("server_batch_size") or 32)
+        self.batch_wait = float(_config.config.get("server_batch_wait_ms") or 10) / 1000
+        self.request_timeout = float(_config.config.get("server_request_timeout") or 120)
+        self._queue = asyncio.Queue(maxsize=int(_config.config.get("server_queue_size") or 256))
+        self._retrieval_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-retrieval")
+        self._llm_executor = ThreadPoolExecutor(max_workers=max(int(_config.config.get("llm_worker_count") or 0), 1),
+                                                thread_name_prefix="rag-llm")
+        # ingest requests mostly wait for their job, which the engine's job queue runs one at a time
+        self._ingest_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-ingest")
+
+    async def serve(self, host: str, port: int) -> None:
+        """
+        Serves requests until cancelled.
+
+        Args:
+            host: The interface to listen on.
+            port: The port to listen on.
+        """
+        batcher = asyncio.create_task(self._batcher())
+        server = await asyncio.start_server(self._handle, host, port)
+        _common_.info_logger(f"serving on {host}:{port}", logger=self.logger)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            for executor in (self._retrieval_executor, self._llm_executor, self._ingest_executor):
+                executor.shutdown(wait=False, cancel_futures=True)
+            self.engine.close()
+
+    async def query(self, query: str, filter: Optional[Dict] = None) -> Dict:
+        """
+        Queues a question and waits for its answer, unless the exact same question is in the answer cache.
+
+        Near-duplicates of cached questions are answered by the batcher once the question is embedded.
+
+        Args:
+            query: The query or question for which an answer is sought.
+            filter: A metadata filter restricting the retrieved chunks, see `RagEngine.retrieve`. Filtered
+                questions bypass the answer cache. Defaults to None.
+
+        Returns:
+            Dict: The answer and its source chunks.
+
+        Raises:
+            ValueError: If the filter is malformed.
+            asyncio.QueueFull: If the request queue is full.
+            asyncio.TimeoutError: If the question was not answered within the request timeout.
+        """
+        if filter:
+            # a malformed filter is rejected as a bad request before it is queued
+            _metadata_.compile_filter(filter, "metadata")
+        answer = None if filter else self.engine.lookup(query)
+        if answer is not None:
+            return {"answer": answer, "sources": [], "cached": True}
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((query, filter or None, future))
+        return await asyncio.wait_for(future, self.request_timeout)
+
+    async def ingest(self, filepath: str, tags: Optional[List[str]] = None, wait: bool = True) -> Dict:
+        """
+        Queues a file or directory to be ingested, see `RagEngine.submit`.
+
+        Args:
+            filepath: The path of the file or directory to be ingested.
+            tags: The tags stored with the chunks. Defaults to None, `ingest_tags` from the config file.
+            wait: Whether to wait for the job to be done. Defaults to True.
+
+        Returns:
+            Dict: The ingest counts of the job once done, or the queued job if not waiting.
+
+        Raises:
+            ValueError: If the path does not exist.
+            IngestJobFailed: If the job failed.
+        """
+        if not os.path.exists(filepath):
+            raise ValueError(f"cannot ingest {filepath}: no such file or directory")
+        job = await asyncio.get_running_loop().run_in_executor(self._ingest_executor, self.engine.submit,
+                                                               filepath, tags, wait)
+        if not wait:
+            return job
+        if job["state"] == "failed":
+            raise IngestJobFailed(job)
+        return {**job["result"], "job": job["id"]}
+
+    async def _batcher(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            _deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), max(_deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            # questions with the same filter are retrieved together in one call
+            _groups = {}
+            for query, filter, future in batch:
+                if not future.done():
+                    _groups.setdefault(json.dumps(filter, sort_keys=True), (filter, []))[1].append((query, future))
+            for filter, group in _groups.values():
+                try:
+                    retrieved = await loop.run_in_executor(self._retrieval_executor, self._retrieve,
+                                                           [query for query, _ in group], filter)
+                except Exception as err:
+                    for _, future in group:
+                        future.done() or future.set_exception(err)
+                    continue
+                version, retrieved = retrieved
+                for (query, future), (answer, documents, vector) in zip(group, retrieved):
+                    if answer is not None:
+                        future.done() or future.set_result({"answer": answer, "sources": [], "cached": True})
+                    else:
+                        asyncio.create_task(self._generate(query, documents, future, vector, version,
+                                                           cache=not filter))
+
+    def _retrieve(self, queries: List[str], filter: Optional[Dict]) -> Tuple[Any, List[Tuple]]:
+        # the batch is embedded once, and the vectors serve both the answer cache and the search; the index
+        # version the documents were retrieved from is returned with them, for caching their answers
+        with _metrics_.span("embedding", items=len(queries)):
+            vectors = self.engine.embedding.embed_documents(list(queries))
+        answers = [None if filter else self.engine.lookup(query, vector) for query, vector in zip(queries, vectors)]
+        _misses = [i for i, answer in enumerate(answers) if answer is None]
+        documents, version = self.engine.search([vectors[i] for i in _misses], filter) if _misses else ([], None)
+        documents = dict(zip(_misses, documents))
+        return version, [(answers[i], documents.get(i, []), vectors[i]) for i in range(len(queries))]
+
+    async def _generate(self, query: str, documents: List, future: asyncio.Future,
+                        vector: Optional[List[float]] = None, version: Optional[Any] = None,
+                        cache: bool = True) -> None:
+        if future.done():
+            return
+        try:
+            answer = await asyncio.get_running_loop().run_in_executor(self._llm_executor, self._generate_if_pending,
+                                                                      query, documents, future)
+        except Exception as err:
+            future.done() or future.set_exception(err)
+        else:
+            if answer is None:
+                return
+            if cache:
+                self.engine.remember(query, answer, vector, version)
+            future.done() or future.set_result(
+                {"answer": answer,
+                 "sources": [{"page_content": document.page_content, "metadata": document.metadata}
+                             for document in documents]})
+
+    def _generate_if_pending(self, query: str, documents: List, future: asyncio.Future) -> Optional[str]:
+        # requests that timed out while waiting for the model are skipped instead of generated
+        return None if future.done() else self.engine.generate(query, documents)
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Union[Dict, List, str]]:
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok",
+                         "queued": self._queue.qsize(),
+                         "answer_cache": self.engine.answer_cache.stats() if self.engine.answer_cache else {}}
+        if method == "GET" and path == "/metrics":
+            return 200, _metrics_.to_prometheus()
+        if method == "POST" and path == "/query":
+            try:
+                _request = json.loads(body)
+                return 200, await self.query(_request["query"], _request.get("filter"))
+            except asyncio.QueueFull:
+                return 503, {"error": "request queue is full"}
+            except asyncio.TimeoutError:
+                return 504, {"error": f"no answer within {self.request_timeout} seconds"}
+        if method == "POST" and path == "/ingest":
+            _request = json.loads(body)
+            try:
+                return 200, await self.ingest(_request["filepath"], _request.get("tags"), _request.get("wait", True))
+            except IngestJobFailed as err:
+                return 422, {"error": err.job["error"], "job": err.job["id"]}
+        if method == "GET" and path == "/jobs":
+            return 200, self.engine.jobs.jobs()
+        if method == "GET" and path.startswith("/jobs/"):
+            job = self.engine.jobs.get(int(path[len("/jobs/"):]))
+            return (200, job) if job else (404, {"error": f"job {path[len('/jobs/'):]} not found"})
+        return 404, {"error": f"{method} {path} not found"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            _length = int(headers.get("content-length") or 0)
+            if _length > _MAX_BODY_SIZE:
+                status, payload = 413, {"error": f"request body larger than {_MAX_BODY_SIZE} bytes"}
+            else:
+                status, payload = await self._route(method, path, await reader.readexactly(_length))
+        except (ValueError, KeyError, asyncio.IncompleteReadError) as err:
+            status, payload = 400, {"error": f"bad request: {err}"}
+        except Exception as err:
+            _common_.error_logger("RagServer", err, logger=self.logger, mode="error", ignore_flag=True)
+            status, payload = 500, {"error": str(err)}
+
+        if isinstance(payload, str):
+            _body, _content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            _body, _content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                     f"Content-Type: {_content_type}\r\n"
+                     f"Content-Length: {len(_body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + _body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+@_common_.exception_handler
+def serve(host: str = "", port: int = 0, logger: Log = None) -> None:
+    """
+    Runs the RAG HTTP server until interrupted.
+
+    Args:
+        host: The interface to listen on. Defaults to `server_host` from the config file, or 127.0.0.1.
+        port: The port to listen on. Defaults to `server_port` from the config file, or 8080.
+        logger: A logger object for logging messages. Defaults to None.
+
+    """
+    _config = _config_.PGConfigSingleton()
+    host = host or _config.config.get("server_host") or "127.0.0.1"
+    port = port or int(_config.config.get("server_port") or 8080)
+
+    async def _serve():
+        await RagServer(logger=logger).serve(host, port)
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        _common_.info_logger("server stopped", logger=logger)
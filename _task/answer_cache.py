@@ -0,0 +1,149 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any
+import numpy as np
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split()).rstrip(" ?!.")
+
+
+class AnswerCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, similarity_threshold: float = 0.95):
+        """
+        A two-tier cache of generated answers.
+
+        The exact tier is keyed by the normalized query text and k. The semantic tier returns the answer of a
+        cached query whose embedding has a cosine similarity of at least `similarity_threshold` with the new
+        query's embedding. Both tiers hold at most `max_entries` answers, evict the least recently used one
+        first and expire answers after `ttl` seconds. All answers are dropped when the index version passed
+        to `get` or `put` changes, since ingestion may have changed what the right answer is.
+
+        Args:
+            max_entries: The maximum number of answers per tier. Defaults to 1024.
+            ttl: The number of seconds an answer stays valid, 0 for no expiry. Defaults to 3600.
+            similarity_threshold: The minimum cosine similarity for a semantic hit, 0 to disable the
+                semantic tier. Defaults to 0.95.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._version = None
+        self._exact = OrderedDict()
+        self._semantic = OrderedDict()
+        self._matrix, self._matrix_keys = None, []
+
+    def get(self, query: str, k: int, version: Any, vector: Optional[List[float]] = None) -> Optional[str]:
+        """
+        Looks up the answer of a query, first by exact normalized text, then by embedding similarity.
+
+        Args:
+            query: The query or question.
+            k: The number of retrieved chunks the answer was generated from.
+            version: The current index version.
+            vector: The query embedding, required for the semantic tier. Defaults to None.
+
+        Returns:
+            Optional[str]: The cached answer, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            self._check_version(version)
+            _key = (normalize_query(query), k)
+            answer = self._touch(self._exact, _key, now)
+            if answer is not None:
+                self.exact_hits += 1
+                return answer
+
+            if vector is not None and self.similarity_threshold > 0 and self._semantic:
+                _semantic_key = self._nearest(vector, k)
+                answer = self._touch(self._semantic, _semantic_key, now) if _semantic_key else None
+                if answer is not None:
+                    self.semantic_hits += 1
+                    return answer
+            self.misses += 1
+            return None
+
+    def put(self, query: str, k: int, version: Any, answer: str, vector: Optional[List[float]] = None) -> None:
+        """
+        Stores the answer of a query in the exact tier and, if its embedding is given, in the semantic tier.
+
+        Args:
+            query: The query or question.
+            k: The number of retrieved chunks the answer was generated from.
+            version: The index version the answer was generated against.
+            answer: The generated answer.
+            vector: The query embedding. Defaults to None.
+        """
+        _expires = time.time() + self.ttl if self.ttl > 0 else float("inf")
+        with self._lock:
+            self._check_version(version)
+            _key = (normalize_query(query), k)
+            self._insert(self._exact, _key, (answer, _expires))
+            if vector is not None and self.similarity_threshold > 0:
+                _vector = np.asarray(vector, dtype=np.float32)
+                self._insert(self._semantic, _key, (answer, _expires, _vector / max(np.linalg.norm(_vector), 1e-12)))
+                self._matrix = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._exact.clear()
+            self._semantic.clear()
+            self._matrix = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the cache counters.
+
+        Returns:
+            Dict: The exact and semantic hits, misses, hit rate and number of cached answers.
+        """
+        _total = self.exact_hits + self.semantic_hits + self.misses
+        return {"exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / _total if _total else 0.0,
+                "entries": len(self._exact)}
+
+    def _check_version(self, version: Any) -> None:
+        if version != self._version:
+            self._exact.clear()
+            self._semantic.clear()
+            self._matrix = None
+            self._version = version
+
+    def _touch(self, entries: OrderedDict, key, now: float) -> Optional[str]:
+        _entry = entries.get(key)
+        if _entry is None:
+            return None
+        if _entry[1] < now:
+            del entries[key]
+            if entries is self._semantic:
+                self._matrix = None
+            return None
+        entries.move_to_end(key)
+        return _entry[0]
+
+    def _insert(self, entries: OrderedDict, key, value) -> None:
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def _nearest(self, vector: List[float], k: int):
+        if self._matrix is None:
+            self._matrix_keys = list(self._semantic.keys())
+            self._matrix = np.stack([_entry[2] for _entry in self._semantic.values()])
+        _vector = np.asarray(vector, dtype=np.float32)
+        _similarities = self._matrix @ (_vector / max(np.linalg.norm(_vector), 1e-12))
+        for _i in np.argsort(-_similarities):
+            if _similarities[_i] < self.similarity_threshold:
+                return None
+            if self._matrix_keys[_i][1] == k:
+                return self._matrix_keys[_i]
+        return None
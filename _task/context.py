@@ -0,0 +1,152 @@
+from typing import List, Optional, Set
+from _config import _config as _config_
+
+_CHARS_PER_TOKEN = 4
+_MIN_OVERLAP = 20
+_SHINGLE_SIZE = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of language model tokens of a text, at about four characters per token for English.
+    """
+    return -(-len(text) // _CHARS_PER_TOKEN)
+
+
+def _overlap(head: str, tail: str) -> int:
+    # length of the longest suffix of `head` that is a prefix of `tail`
+    _probe = tail[:_MIN_OVERLAP]
+    if len(_probe) < _MIN_OVERLAP:
+        return 0
+    position = head.find(_probe, max(len(head) - len(tail), 0))
+    while position != -1:
+        if tail.startswith(head[position:]):
+            return len(head) - position
+        position = head.find(_probe, position + 1)
+    return 0
+
+
+def _merge(head: str, tail: str) -> Optional[str]:
+    if tail in head:
+        return head
+    if head in tail:
+        return tail
+    _length = _overlap(head, tail)
+    return head + tail[_length:] if _length else None
+
+
+def merge_overlapping(documents: List) -> List:
+    """
+    Merges chunks of the same source whose texts overlap, as neighbouring chunks do by `chunk_overlap`
+    characters, into one chunk that holds the overlapping text only once.
+
+    A merged chunk takes the rank of its best ranked part, so the result keeps the retrieval order.
+
+    Args:
+        documents: The retrieved documents, most similar first.
+
+    Returns:
+        List: The merged documents, most similar first.
+    """
+    merged = []
+    for rank, document in enumerate(documents):
+        _rank, text, _metadata = rank, document.page_content, document.metadata
+        _source = _metadata.get("source")
+        i = 0
+        while i < len(merged):
+            _other_rank, _other_text, _other_metadata = merged[i]
+            _text = None
+            if _other_metadata.get("source") == _source:
+                _text = _merge(_other_text, text) or _merge(text, _other_text)
+            if _text is None:
+                i += 1
+                continue
+            # the merged text may now overlap chunks that were checked before, so start over
+            del merged[i]
+            _rank, text, _metadata = min(_rank, _other_rank), _text, \
+                _metadata if _rank < _other_rank else _other_metadata
+            i = 0
+        merged.append((_rank, text, _metadata))
+    return [type(documents[0])(page_content=text, metadata=dict(metadata))
+            for _, text, metadata in sorted(merged, key=lambda entry: entry[0])]
+
+
+def _shingles(text: str) -> Set:
+    words = text.lower().split()
+    return {tuple(words[i: i + _SHINGLE_SIZE]) for i in range(max(len(words) - _SHINGLE_SIZE + 1, 1))}
+
+
+def drop_near_duplicates(documents: List, similarity: float = 0.9) -> List:
+    """
+    Drops documents of which at least a `similarity` fraction of word 3-grams also occur in a better ranked
+    document, e.g. the same paragraph ingested from two files, or a chunk already covered by a merged one.
+
+    Args:
+        documents: The documents, most similar first.
+        similarity: The minimum fraction of shared word 3-grams of near-duplicates. Defaults to 0.9.
+
+    Returns:
+        List: The documents that are not near-duplicates, most similar first.
+    """
+    kept, _kept_shingles = [], []
+    for document in documents:
+        _shingle = _shingles(document.page_content)
+        if all(len(_shingle & _other) < similarity * len(_shingle) for _other in _kept_shingles):
+            kept.append(document)
+            _kept_shingles.append(_shingle)
+    return kept
+
+
+def pack(documents: List, token_budget: int) -> List:
+    """
+    Keeps the best ranked documents whose estimated tokens fit in `token_budget`, skipping the ones that do not
+    fit so smaller lower ranked ones can still use the remaining budget. If not even the best document fits,
+    it is cut at the budget.
+
+    Args:
+        documents: The documents, most similar first.
+        token_budget: The maximum estimated number of context tokens, 0 for no limit.
+
+    Returns:
+        List: The packed documents, most similar first.
+    """
+    if token_budget <= 0:
+        return list(documents)
+    packed, _remaining = [], token_budget
+    for document in documents:
+        _tokens = estimate_tokens(document.page_content)
+        if _tokens <= _remaining:
+            packed.append(document)
+            _remaining -= _tokens
+    if not packed and documents:
+        _text = documents[0].page_content[:token_budget * _CHARS_PER_TOKEN]
+        _text = _text.rsplit(" ", 1)[0] if " " in _text else _text
+        packed.append(type(documents[0])(page_content=_text, metadata=dict(documents[0].metadata)))
+    return packed
+
+
+def assemble_context(documents: List, token_budget: int = None, similarity: float = None) -> List:
+    """
+    Turns retrieved chunks into the context passed to the "stuff" chain: overlapping chunks of the same source
+    are merged, near-duplicates are dropped and the best remaining chunks are packed into a token budget, so
+    the language model does not spend prompt evaluation time on repeated text.
+
+    Args:
+        documents: The retrieved documents, most similar first.
+        token_budget: The maximum estimated number of context tokens, 0 for no limit. Defaults to
+            `context_token_budget` from the config file, or 0.
+        similarity: The minimum fraction of shared word 3-grams of near-duplicates, 0 to keep them. Defaults to
+            `context_dedup_similarity` from the config file, or 0.
+
+    Returns:
+        List: The context documents, most similar first.
+    """
+    _config = _config_.PGConfigSingleton()
+    if token_budget is None:
+        token_budget = int(_config.config.get("context_token_budget") or 0)
+    if similarity is None:
+        similarity = float(_config.config.get("context_dedup_similarity") or 0)
+    documents = merge_overlapping(documents)
+    if similarity > 0:
+        documents = drop_near_duplicates(documents, similarity)
+    return pack(documents, token_budget)
@@ -1,9 +1,37 @@
-from _embedding import gpt4all_embedding
-from _vectordb import sqllite
+import asyncio
+from typing import List, Dict, Iterator, AsyncIterator
 from _config import _config as _config_
 from _common import _common as _common_
-from _data import _data_load
-from _llm import langchain
+from _task.rag_engine import RagEngine
+
+_engine = None
+
+
+def get_engine() -> RagEngine:
+    """
+    Returns the process-wide RagEngine used by `run`, creating it on first use.
+
+    Returns:
+        RagEngine: The shared engine.
+
+    """
+    global _engine
+    if _engine is None:
+        _engine = RagEngine()
+    return _engine
+
+
+def close() -> None:
+    """
+    Releases the models and the database connection held by the shared engine.
+    """
+    if _engine is not None:
+        _engine.close()
+
+
+def _ingest(filepath: str) -> None:
+    # a background ingest job, waited for unless `ingest_in_background` is set
+    get_engine().submit(filepath, wait=not _config_.PGConfigSingleton().config.get("ingest_in_background"))
 
 
 @_common_.exception_handler
@@ -14,34 +42,81 @@ def run(query: str, filepath: str = "") -> str:
     This function configures and initiates a retrieval-based QA system. It either loads text data
     from a given file or uses an existing database, and then sets up a retriever model using embeddings
     generated by the `gpt4all_embedding` function. The QA process is performed using a combination of
-    the retriever and a language model (like GPT-4).
+    the retriever and a language model (like GPT-4). The models and the database connection are kept
+    warm in a shared RagEngine, so only the first call pays for loading them.
 
     Args:
         query (str): The query or question for which an answer is sought.
-        filepath (str, optional): The path to a file containing text data. If provided, the text data is
-            loaded and used in the retrieval process. Defaults to an empty string, in which case an existing
+        filepath (str, optional): The path to a file containing text data. If provided, the file is ingested
+            incrementally into the vector database by a background ingest job; unchanged files are skipped.
+            With `ingest_in_background` set the question is answered right away from the last published index
+            version, otherwise once the job is done. Defaults to an empty string, in which case an existing
             database is used.
 
     Returns:
         str: The answer generated by the retrieval-based QA system.
 
     """
-    _config = _config_.PGConfigSingleton()
+    return get_engine().ask(query, filepath)
 
-    if filepath:
-        texts = _data_load.load_document(filepath)
-        _retriever = sqllite.get_vector_db(gpt4all_embedding.gpt4all_embedding(),
-                                           texts=texts).as_retriever(search_kwargs={"k": _config.config.get("model_knn_cnt")})
-    else:
-        _retriever = sqllite.get_vector_db(gpt4all_embedding.gpt4all_embedding()).as_retriever(search_kwargs={"k": _config.config.get("model_knn_cnt")})
 
-    _qa = langchain.qa_chain(_retriever)
-    return _qa.run(query)
+@_common_.exception_handler
+def run_many(queries: List[str], filepath: str = None, concurrency: int = 0) -> List[str]:
+    """
+    Executes the retrieval-based QA process for a list of queries against the same corpus.
 
+    All queries are embedded in one batched call and retrieved in one pass over the vector database,
+    after which the answers are generated with configurable concurrency.
 
+    Args:
+        queries (List[str]): The queries or questions for which answers are sought.
+        filepath (str, optional): The path to a file to be ingested before answering. Defaults to None,
+            in which case an existing database is used.
+        concurrency (int, optional): The number of concurrent generations. Defaults to `run_many_concurrency`
+            from the config file.
 
+    Returns:
+        List[str]: The answers, in the order of the queries.
 
+    """
+    return get_engine().ask_many(queries, filepath or "", concurrency=concurrency)
 
 
+def run_stream(query: str, filepath: str = "") -> Iterator[Dict]:
+    """
+    Executes the retrieval-based QA process, yielding the answer as it is generated.
+
+    The retrieved source chunks are yielded first as a `{"type": "sources", "documents": [...]}` event,
+    followed by one `{"type": "token", "text": ...}` event per token produced by the language model.
+
+    Args:
+        query (str): The query or question for which an answer is sought.
+        filepath (str, optional): The path to a file to be ingested before answering. Defaults to an empty
+            string, in which case an existing database is used.
+
+    Returns:
+        Iterator[Dict]: The sources event followed by the token events.
+
+    """
+    if filepath:
+        _ingest(filepath)
+    yield from get_engine().stream(query)
 
 
+async def arun_stream(query: str, filepath: str = "") -> AsyncIterator[Dict]:
+    """
+    Asynchronous variant of `run_stream`, which does not block the event loop while retrieving or generating.
+
+    Args:
+        query (str): The query or question for which an answer is sought.
+        filepath (str, optional): The path to a file to be ingested before answering. Defaults to an empty
+            string, in which case an existing database is used.
+
+    Returns:
+        AsyncIterator[Dict]: The sources event followed by the token events.
+
+    """
+    if filepath:
+        await asyncio.get_running_loop().run_in_executor(None, _ingest, filepath)
+    async for event in get_engine().astream(query):
+        yield event
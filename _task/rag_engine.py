@@ -0,0 +1,451 @@
+import asyncio
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger as Log
+from queue import Queue
+from typing import Any, Dict, List, Iterator, AsyncIterator, Optional, Tuple
+from _embedding import gpt4all_embedding
+from _vectordb import _vectordb as _vectordb_
+from _vectordb import _manifest as _manifest_
+from _config import _config as _config_
+from _common import _common as _common_
+from _common import _metrics as _metrics_
+from _data import _data_ingest
+from _data import _data_jobs
+from _task.answer_cache import AnswerCache
+from _task import context as _context_
+
+
+class RagEngine:
+    def __init__(self, logger: Log = None, collection: str = ""):
+        """
+        A long-lived retrieval-augmented QA session.
+
+        The embedding model, the vector database connection and the GPT4All model are created lazily on
+        first use and then reused by every call to `ask`, so only the first question pays for loading them.
+        If `llm_worker_count` is set, the model runs in a pool of worker processes instead, so concurrent
+        generations from `ask_many` or the server run in parallel; the in-process model is not thread-safe,
+        so without a pool generations run one at a time.
+        Files given to `ask` are ingested by a background job queue, see `jobs`, and every search is served
+        from the last index version it published.
+        The engine can be used as a context manager, in which case `close` is called on exit.
+
+        Args:
+            logger: A logger object for logging messages. Defaults to None.
+            collection: The vector database collection to be queried, see `get_vector_db`. Defaults to "".
+        """
+        self.logger = logger
+        self.collection = collection
+        self._lock = threading.RLock()
+        self._generation_lock = threading.Lock()
+        self._embedding = None
+        self._vector_db = None
+        self._llm = None
+        self._chain = None
+        self._answer_cache = None
+        self._jobs = None
+
+    @property
+    def embedding(self):
+        with self._lock:
+            if self._embedding is None:
+                self._embedding = gpt4all_embedding.gpt4all_embedding()
+            return self._embedding
+
+    @property
+    def vector_db(self):
+        with self._lock:
+            if self._vector_db is None:
+                self._vector_db = _vectordb_.get_vector_db(self.embedding, collection=self.collection)
+            return self._vector_db
+
+    @property
+    def llm(self):
+        with self._lock:
+            if self._llm is None:
+                _common_.info_logger("loading the language model", logger=self.logger)
+                if int(_config_.PGConfigSingleton().config.get("llm_worker_count") or 0) > 0:
+                    from _llm import _pool as _pool_
+                    self._llm = _pool_.gpt4all_pool_llm(logger=self.logger)
+                else:
+                    from _llm import langchain
+                    self._llm = langchain.gpt4all_llm()
+            return self._llm
+
+    @property
+    def chain(self):
+        with self._lock:
+            if self._chain is None:
+                from _llm import langchain
+                _config = _config_.PGConfigSingleton()
+                self._chain = langchain.qa_chain(
+                    self.vector_db.as_retriever(search_kwargs={"k": _config.config.get("model_knn_cnt")}),
+                    llm=self.llm)
+            return self._chain
+
+    @property
+    def jobs(self) -> _data_jobs.IngestJobQueue:
+        with self._lock:
+            if self._jobs is None:
+                self._jobs = _data_jobs.IngestJobQueue(self.vector_db, self.embedding, logger=self.logger)
+            return self._jobs
+
+    @property
+    def answer_cache(self) -> Optional[AnswerCache]:
+        with self._lock:
+            _config = _config_.PGConfigSingleton()
+            if self._answer_cache is None and _config.config.get("answer_cache_enabled"):
+                self._answer_cache = AnswerCache(
+                    max_entries=int(_config.config.get("answer_cache_max_entries") or 1024),
+                    ttl=float(_config.config.get("answer_cache_ttl") or 0),
+                    similarity_threshold=float(_config.config.get("answer_cache_similarity") or 0))
+            return self._answer_cache
+
+    def index_version(self) -> Any:
+        return (_manifest_.manifest_version(_manifest_.manifest_location(self.vector_db)),
+                self._jobs.version if self._jobs is not None else 0)
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[Dict]:
+        # the watermark and excluded ids that keep searches to the published index version, see IngestJobQueue
+        with self._jobs.snapshot() if self._jobs is not None else nullcontext({}) as snapshot:
+            yield snapshot
+
+    def _generating(self):
+        # the in-process GPT4All model must not generate from several threads at once, pooled workers can
+        if int(_config_.PGConfigSingleton().config.get("llm_worker_count") or 0) > 0:
+            return nullcontext()
+        return self._generation_lock
+
+    def search(self, vectors: List[List[float]], filter: Optional[Dict] = None) -> Tuple[List[List], Any]:
+        """
+        Retrieves the `model_knn_cnt` most similar chunks for already embedded queries.
+
+        The index version is read in the same snapshot as the search, so an answer generated from the
+        documents can be cached under the version they were retrieved from, see `remember`, even if an
+        ingest job publishes a new one meanwhile.
+
+        Args:
+            vectors: The query embeddings.
+            filter: A metadata filter applied inside the search, see `retrieve`. Defaults to None.
+
+        Returns:
+            Tuple: For each query, in order, the retrieved documents, most similar first, and the index version.
+        """
+        _config = _config_.PGConfigSingleton()
+        with self._snapshot() as snapshot:
+            return (self.vector_db.similarity_search_by_vectors(vectors, k=_config.config.get("model_knn_cnt"),
+                                                                filter=filter, **snapshot),
+                    self.index_version())
+
+    def lookup(self, query: str, vector: Optional[List[float]] = None) -> Optional[str]:
+        """
+        Looks up a cached answer for a query against the current index version.
+
+        Args:
+            query: The query or question.
+            vector: The query embedding, used for near-duplicate matches. Defaults to None, in which case
+                only the exact tier is checked.
+
+        Returns:
+            Optional[str]: The cached answer, or None if there is none or the cache is disabled.
+        """
+        if self.answer_cache is None:
+            return None
+        _config = _config_.PGConfigSingleton()
+        return self.answer_cache.get(query, _config.config.get("model_knn_cnt"), self.index_version(),
+                                     vector=vector)
+
+    def remember(self, query: str, answer: str, vector: Optional[List[float]] = None,
+                 version: Optional[Any] = None) -> None:
+        """
+        Caches an answer to a query.
+
+        Args:
+            query: The query or question.
+            answer: The answer.
+            vector: The query embedding, for near-duplicate matches. Defaults to None.
+            version: The index version the answer's documents were retrieved from, see `search`. Defaults to
+                None, the current index version.
+        """
+        if self.answer_cache is not None:
+            _config = _config_.PGConfigSingleton()
+            self.answer_cache.put(query, _config.config.get("model_knn_cnt"),
+                                  self.index_version() if version is None else version, answer, vector=vector)
+
+    def ingest(self, filepath: str, tags: Optional[List[str]] = None) -> Dict:
+        """
+        Ingests a file incrementally into the engine's vector database, in the calling thread. Searches
+        running meanwhile may see the file partially ingested; use `submit` to avoid that.
+
+        Args:
+            filepath: The path of the file to be ingested.
+            tags: The tags stored with the file's chunks. Defaults to `ingest_tags` from the config file.
+
+        Returns:
+            Dict: The number of chunks added, removed and kept for the file.
+        """
+        return _data_ingest.ingest_file(self.vector_db, filepath, logger=self.logger, tags=tags)
+
+    def ingest_directory(self, dirpath: str, tags: Optional[List[str]] = None) -> Dict:
+        """
+        Ingests every file of a directory tree incrementally into the engine's vector database.
+
+        Args:
+            dirpath: The path of the directory to be ingested.
+            tags: The tags stored with the chunks. Defaults to `ingest_tags` from the config file.
+
+        Returns:
+            Dict: The number of files seen, skipped, failed and deleted, and the number of chunks added and
+            removed.
+        """
+        return _data_ingest.ingest_directory(self.vector_db, self.embedding, dirpath, logger=self.logger, tags=tags)
+
+    def prune(self, dirpath: str = "") -> int:
+        """
+        Removes the chunks of ingested files that no longer exist on disk from the engine's vector database.
+
+        Args:
+            dirpath: Only files under this directory are considered. Defaults to "", all ingested files.
+
+        Returns:
+            int: The number of chunks removed.
+        """
+        return _data_ingest.prune_deleted(self.vector_db, logger=self.logger, dirpath=dirpath)
+
+    def submit(self, path: str, tags: Optional[List[str]] = None, wait: bool = False) -> Dict:
+        """
+        Queues a file or directory to be ingested in the background, see `jobs`. Searches keep seeing the
+        previous index version until the job is done.
+
+        Args:
+            path: The path of the file or directory to be ingested.
+            tags: The tags stored with the chunks. Defaults to `ingest_tags` from the config file.
+            wait: Whether to wait for the job to be done or failed. Defaults to False.
+
+        Returns:
+            Dict: The job, with its id, state, progress and, once done, its result and index version.
+        """
+        job_id = self.jobs.submit(path, tags)
+        return self.jobs.wait(job_id) if wait else self.jobs.get(job_id)
+
+    def retrieve(self, query: str, filter: Optional[Dict] = None) -> List:
+        """
+        Retrieves the `model_knn_cnt` chunks most similar to a query.
+
+        Args:
+            query: The query or question.
+            filter: A metadata filter applied inside the search, e.g. `{"source": {"$in": [...]}}`, see
+                `_vectordb._metadata.compile_filter`. Defaults to None.
+
+        Returns:
+            List: The retrieved documents, most similar first.
+        """
+        with _metrics_.span("embedding", items=1):
+            vector = self.embedding.embed_query(query)
+        return self.search([vector], filter=filter)[0][0]
+
+    def retrieve_many(self, queries: List[str], filter: Optional[Dict] = None) -> List[List]:
+        """
+        Retrieves the `model_knn_cnt` most similar chunks for each of a list of queries.
+
+        All queries are embedded in a single batched call and searched in one pass over the vector database.
+
+        Args:
+            queries: The queries or questions.
+            filter: A metadata filter applied inside the search, see `retrieve`. Defaults to None.
+
+        Returns:
+            List: For each query, in order, the retrieved documents, most similar first.
+        """
+        with _metrics_.span("embedding", items=len(queries)):
+            vectors = self.embedding.embed_documents(list(queries))
+        return self.search(vectors, filter=filter)[0]
+
+    @_metrics_.timed("generation")
+    def generate(self, query: str, documents: List) -> str:
+        """
+        Generates an answer to a query from already retrieved documents.
+
+        The documents are first assembled into the context with `_task.context.assemble_context`, which
+        merges overlapping chunks, drops near-duplicates and packs them into `context_token_budget`.
+
+        Args:
+            query: The query or question.
+            documents: The retrieved documents used as context.
+
+        Returns:
+            str: The generated answer.
+        """
+        with _metrics_.span("context_assembly", items=len(documents)):
+            documents = _context_.assemble_context(documents)
+        with self._generating():
+            return self.chain.combine_documents_chain.run(input_documents=documents, question=query)
+
+    def stream(self, query: str) -> Iterator[Dict]:
+        """
+        Answers a question, yielding the answer token by token as the language model produces it.
+
+        The retrieved chunks are yielded first as `{"type": "sources", "documents": [...]}`, followed by
+        one `{"type": "token", "text": ...}` event per generated token. Generation runs in a background
+        thread, so the first token is available as soon as the model produces it.
+
+        Args:
+            query: The query or question for which an answer is sought.
+
+        Returns:
+            Iterator[Dict]: The sources event followed by the token events.
+        """
+        documents = self.retrieve(query)
+        yield {"type": "sources", "documents": documents}
+
+        from _llm import langchain
+        tokens = Queue()
+        handler = langchain.TokenQueueHandler(tokens)
+
+        def _generate():
+            try:
+                with self._generating():
+                    self.chain.combine_documents_chain.run(input_documents=_context_.assemble_context(documents),
+                                                           question=query,
+                                                           callbacks=[handler])
+            except Exception as err:
+                tokens.put(err)
+            finally:
+                tokens.put(handler.DONE)
+
+        threading.Thread(target=_generate, daemon=True).start()
+        while (token := tokens.get()) is not handler.DONE:
+            if isinstance(token, Exception):
+                raise token
+            yield {"type": "token", "text": token}
+
+    async def astream(self, query: str) -> AsyncIterator[Dict]:
+        """
+        Asynchronous variant of `stream`, which retrieves and generates without blocking the event loop.
+
+        Args:
+            query: The query or question for which an answer is sought.
+
+        Returns:
+            AsyncIterator[Dict]: The sources event followed by the token events.
+        """
+        loop, events, done = asyncio.get_running_loop(), asyncio.Queue(), object()
+
+        def _produce():
+            try:
+                for event in self.stream(query):
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+            except Exception as err:
+                loop.call_soon_threadsafe(events.put_nowait, err)
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, done)
+
+        loop.run_in_executor(None, _produce)
+        while (event := await events.get()) is not done:
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    def _ingest_before_answering(self, filepath: str, background: Optional[bool]) -> None:
+        if background is None:
+            background = bool(_config_.PGConfigSingleton().config.get("ingest_in_background"))
+        self.submit(filepath, wait=not background)
+
+    def ask(self, query: str, filepath: str = "", filter: Optional[Dict] = None,
+            background: Optional[bool] = None) -> str:
+        """
+        Answers a question using the engine's warm embedding model, vector database and language model.
+
+        If `answer_cache_enabled` is set, the answer cache is checked first, by exact query text and then by
+        query embedding similarity, and a generated answer is cached until the index changes. Filtered
+        questions bypass the cache.
+
+        Args:
+            query: The query or question for which an answer is sought.
+            filepath: The path to a file to be ingested before answering, as a job of `jobs`. Defaults to an
+                empty string, in which case the existing database is used.
+            filter: A metadata filter restricting the retrieved chunks, see `retrieve`. Defaults to None.
+            background: Whether to answer right away from the current index version instead of waiting for
+                the file's ingest job. Defaults to `ingest_in_background` from the config file.
+
+        Returns:
+            str: The answer generated by the retrieval-based QA system.
+        """
+        if filepath:
+            self._ingest_before_answering(filepath, background)
+        if self.answer_cache is None or filter:
+            return self.generate(query, self.retrieve(query, filter=filter))
+
+        with _metrics_.span("embedding", items=1):
+            vector = self.embedding.embed_query(query)
+        answer = self.lookup(query, vector)
+        if answer is None:
+            documents, version = self.search([vector])
+            answer = self.generate(query, documents[0])
+            self.remember(query, answer, vector, version)
+        return answer
+
+    def ask_many(self, queries: List[str], filepath: str = "", concurrency: int = 0,
+                 background: Optional[bool] = None) -> List[str]:
+        """
+        Answers a list of questions against the same corpus.
+
+        All questions are embedded in one batch and checked against the answer cache; retrieval for the
+        remaining questions is done up front in one pass, then their answers are generated with up to
+        `concurrency` generations running at the same time. Without `llm_worker_count` the in-process model
+        generates one answer at a time whatever the concurrency.
+
+        Args:
+            queries: The queries or questions for which answers are sought.
+            filepath: The path to a file to be ingested before answering. Defaults to an empty string,
+                in which case the existing database is used.
+            concurrency: The number of concurrent generations. Defaults to `run_many_concurrency` or
+                `llm_worker_count` from the config file, whichever is larger, or 1 if neither is set.
+            background: Whether to answer right away instead of waiting for the file's ingest job, see `ask`.
+                Defaults to `ingest_in_background` from the config file.
+
+        Returns:
+            List[str]: The answers, in the order of the queries.
+        """
+        if filepath:
+            self._ingest_before_answering(filepath, background)
+        if not queries:
+            return []
+        _config = _config_.PGConfigSingleton()
+        concurrency = concurrency or max(int(_config.config.get("run_many_concurrency") or 1),
+                                         int(_config.config.get("llm_worker_count") or 0))
+        with _metrics_.span("embedding", items=len(queries)):
+            vectors = self.embedding.embed_documents(list(queries))
+        answers = [self.lookup(query, vector) for query, vector in zip(queries, vectors)]
+        _misses = [i for i, answer in enumerate(answers) if answer is None]
+        documents, version = self.search([vectors[i] for i in _misses])
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for i, answer in zip(_misses, executor.map(self.generate, [queries[i] for i in _misses], documents)):
+                answers[i] = answer
+                self.remember(queries[i], answer, vectors[i], version)
+        return answers
+
+    def close(self) -> None:
+        """
+        Releases the language model, the vector database connection and the embedding model, once the
+        running ingest job, if any, is done. The engine can be used again afterwards, in which case they are
+        loaded again.
+        """
+        with self._lock:
+            if self._jobs is not None:
+                self._jobs.close()
+            if self._vector_db is not None:
+                self._vector_db.close()
+            if hasattr(self._embedding, "close"):
+                self._embedding.close()
+            if hasattr(self._llm, "pool"):
+                self._llm.pool.close()
+            self._embedding, self._vector_db, self._llm, self._chain, self._jobs = None, None, None, None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
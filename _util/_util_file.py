@@ -1,10 +1,10 @@
 import csv
 import os
 import json
+from itertools import islice
 from pathlib import Path
 import yaml
-from typing import List, Dict, Tuple, Union, Any
-import pandas as pd
+from typing import List, Dict, Tuple, Union, Any, Iterator, Iterable
 from _common import _common as _common_
 
 
@@ -270,9 +270,149 @@ def csv_to_json(filepath: str) -> Union[List, Dict]:
         depends on the structure of the JSON.
 
     """
+    import pandas as pd
+
     return json_loads(pd.read_csv(filepath).to_json(orient="records"))
 
 
+def _batched(records: Iterable[Dict], batch_size: int) -> Iterator[List[Dict]]:
+    records = iter(records)
+    while batch := list(islice(records, batch_size)):
+        yield batch
+
+
+def iter_csv(filepath: str, batch_size: int = 1000, encoding: str = "utf-8") -> Iterator[List[Dict]]:
+    """
+    Streams the rows of a CSV file as dictionaries, in batches.
+
+    Unlike `csv_to_json`, the file is read row by row with the csv module, so only one batch of rows is
+    held in memory at a time. Values are kept as strings, keyed by the header row.
+
+    Args:
+        filepath: The path of the CSV file.
+        batch_size: The number of rows per batch. Defaults to 1000.
+        encoding: The encoding of the file. Defaults to utf-8.
+
+    Returns:
+        Iterator[List[Dict]]: The batches of rows, in file order.
+
+    """
+    with open(filepath, newline="", encoding=encoding) as file:
+        yield from _batched(csv.DictReader(file), batch_size)
+
+
+def iter_jsonl(filepath: str, batch_size: int = 1000, encoding: str = "utf-8") -> Iterator[List[Dict]]:
+    """
+    Streams the records of a JSON Lines file, one JSON value per line, in batches.
+
+    Blank lines are skipped. Only one batch of records is held in memory at a time.
+
+    Args:
+        filepath: The path of the JSON Lines file.
+        batch_size: The number of records per batch. Defaults to 1000.
+        encoding: The encoding of the file. Defaults to utf-8.
+
+    Returns:
+        Iterator[List[Dict]]: The batches of records, in file order.
+
+    """
+    with open(filepath, encoding=encoding) as file:
+        yield from _batched((json.loads(line) for line in file if line.strip()), batch_size)
+
+
+def _iter_json_array(filepath: str, block_size: int, encoding: str) -> Iterator[Any]:
+    decoder, buffer, position = json.JSONDecoder(), "", 0
+    with open(filepath, encoding=encoding) as file:
+        def _fill() -> bool:
+            nonlocal buffer, position
+            block = file.read(block_size)
+            buffer, position = buffer[position:] + block, 0
+            return bool(block)
+
+        def _skip_whitespace() -> None:
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer) or not _fill():
+                    return
+
+        _skip_whitespace()
+        if buffer[position: position + 1] != "[":
+            raise ValueError(f"{filepath} is not a JSON array")
+        position += 1
+        while True:
+            _skip_whitespace()
+            if buffer[position: position + 1] == "]":
+                return
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as error:
+                # only a value cut by the end of the buffer continues in the next block: an unterminated string,
+                # or an error close enough to the end to be a cut literal (`nul`) or escape (`\u00`); anything
+                # else is malformed and is raised at once instead of reading the rest of the file
+                if (error.msg.startswith("Unterminated string") or len(buffer) - error.pos < 9) and _fill():
+                    continue
+                raise
+            if end == len(buffer) or not (buffer[end].isspace() or buffer[end] in ",]"):
+                # a value is only complete once followed by whitespace, ',' or ']', or at the end of the file;
+                # a number cut by the end of a block, like the `1.` or `1e+` of `1.25e+3`, continues in the next one
+                if len(buffer) - end <= 2 and _fill():
+                    continue
+                if end < len(buffer):
+                    raise ValueError(f"{filepath}: expected ',' or ']' at character {end} of the buffer")
+            position = end
+            yield value
+            _skip_whitespace()
+            if buffer[position: position + 1] == ",":
+                position += 1
+            elif buffer[position: position + 1] != "]":
+                raise ValueError(f"{filepath}: expected ',' or ']' at character {position} of the buffer")
+
+
+def iter_json_array(filepath: str, batch_size: int = 1000, block_size: int = 1 << 20,
+                    encoding: str = "utf-8") -> Iterator[List[Any]]:
+    """
+    Streams the elements of a JSON file holding a top-level array, in batches.
+
+    The file is read in blocks of `block_size` characters and each element is decoded from the buffer with
+    `json.JSONDecoder.raw_decode` as soon as it is complete, so memory use is bounded by the block size and
+    the batch, not the file size, as long as a single element is smaller than a block.
+
+    Args:
+        filepath: The path of the JSON file.
+        batch_size: The number of elements per batch. Defaults to 1000.
+        block_size: The number of characters read at a time. Defaults to 1 MiB.
+        encoding: The encoding of the file. Defaults to utf-8.
+
+    Returns:
+        Iterator[List[Any]]: The batches of array elements, in file order.
+
+    """
+    yield from _batched(_iter_json_array(filepath, block_size, encoding), batch_size)
+
+
+RECORD_FORMATS = {".csv": iter_csv, ".jsonl": iter_jsonl, ".ndjson": iter_jsonl, ".json": iter_json_array}
+
+
+def iter_records(filepath: str, batch_size: int = 1000) -> Iterator[List[Dict]]:
+    """
+    Streams the records of a CSV, JSON Lines or JSON array file in batches, chosen by the file extension.
+
+    Args:
+        filepath: The path of the file, ending in .csv, .jsonl, .ndjson or .json.
+        batch_size: The number of records per batch. Defaults to 1000.
+
+    Returns:
+        Iterator[List[Dict]]: The batches of records, in file order.
+
+    """
+    _extension = os.path.splitext(filepath)[1].lower()
+    if _extension not in RECORD_FORMATS:
+        raise ValueError(f"record format {_extension} not found, valid list is {list(RECORD_FORMATS)}")
+    return RECORD_FORMATS[_extension](filepath, batch_size=batch_size)
+
+
 @_common_.exception_handler
 def json_to_csv(filepath: str, data: Union[List, Dict], header: List = None) -> bool:
     """
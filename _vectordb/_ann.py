@@ -0,0 +1,179 @@
+import time
+from typing import List, Dict, Tuple
+import numpy as np
+
+_BLOCK = 16384
+_TRAIN_POINTS_PER_LIST = 256
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+class IVFIndex:
+    def __init__(self, centroids: np.ndarray, lists: List[np.ndarray] = None):
+        """
+        An inverted-file (IVF) approximate nearest-neighbour index over unit vectors.
+
+        The vectors are partitioned into `nlist` cells by spherical k-means. A query only scores the vectors
+        of the `nprobe` cells whose centroids are closest to it, so search cost grows with
+        nprobe / nlist of the corpus instead of all of it. The index only holds the centroids and the ids
+        in each cell; the vectors themselves are read from the store they were added from.
+
+        Args:
+            centroids: The (nlist, dim) unit centroids.
+            lists: The ids assigned to each cell. Defaults to empty cells.
+        """
+        self.centroids = centroids.astype(np.float32)
+        self.lists = lists or [np.zeros(0, dtype=np.int64) for _ in range(len(centroids))]
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def ntotal(self) -> int:
+        return int(sum(len(_ids) for _ids in self.lists))
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, nlist: int, iterations: int = 20, seed: int = 0) -> "IVFIndex":
+        """
+        Learns the cell centroids with spherical k-means on a sample of the vectors.
+
+        Args:
+            vectors: The (n, dim) unit vectors to learn from.
+            nlist: The number of cells. Capped at the number of vectors.
+            iterations: The number of k-means iterations. Defaults to 20.
+            seed: The random seed used for sampling and initialization. Defaults to 0.
+
+        Returns:
+            IVFIndex: An empty index with trained centroids.
+        """
+        rng = np.random.default_rng(seed)
+        nlist = max(1, min(nlist, len(vectors)))
+        _sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), nlist * _TRAIN_POINTS_PER_LIST),
+                                             replace=False))]
+        _sample = np.asarray(_sample, dtype=np.float32)
+        centroids = _sample[rng.choice(len(_sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            _assign = cls._nearest(centroids, _sample)
+            _sums = np.zeros_like(centroids)
+            np.add.at(_sums, _assign, _sample)
+            _empty = np.bincount(_assign, minlength=nlist) == 0
+            _sums[_empty] = _sample[rng.choice(len(_sample), int(_empty.sum()))]
+            centroids = _normalize(_sums)
+        return cls(centroids)
+
+    @staticmethod
+    def _nearest(centroids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        return np.concatenate([np.argmax(np.asarray(vectors[i: i + _BLOCK]) @ centroids.T, axis=1)
+                               for i in range(0, len(vectors), _BLOCK)]) if len(vectors) \
+            else np.zeros(0, dtype=np.int64)
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        """
+        Assigns vectors to their nearest cell.
+
+        Args:
+            ids: The ids of the vectors.
+            vectors: The (n, dim) unit vectors.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        _assign = self._nearest(self.centroids, vectors)
+        for _cell in np.unique(_assign):
+            self.lists[_cell] = np.concatenate([self.lists[_cell], ids[_assign == _cell]])
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """
+        Returns the ids in the `nprobe` cells closest to a unit query vector.
+        """
+        nprobe = max(1, min(nprobe, self.nlist))
+        _cells = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([self.lists[_cell] for _cell in _cells])
+
+    def save(self, filepath: str) -> None:
+        np.savez(filepath, centroids=self.centroids,
+                 ids=np.concatenate(self.lists) if self.lists else np.zeros(0, dtype=np.int64),
+                 sizes=np.asarray([len(_ids) for _ids in self.lists], dtype=np.int64))
+
+    @classmethod
+    def load(cls, filepath: str) -> "IVFIndex":
+        with np.load(filepath) as data:
+            _offsets = np.concatenate([[0], np.cumsum(data["sizes"])])
+            return cls(data["centroids"], [data["ids"][_offsets[i]: _offsets[i + 1]].copy()
+                                           for i in range(len(data["sizes"]))])
+
+
+def top_k(vectors: np.ndarray, query: np.ndarray, k: int, ids: np.ndarray = None,
+          deleted: np.ndarray = None) -> List[Tuple[int, float]]:
+    """
+    Exactly scores a unit query against a set of vectors and returns the k best as (id, cosine distance).
+
+    Args:
+        vectors: The (n, dim) unit vectors.
+        query: The unit query vector.
+        k: The number of results.
+        ids: The ids of the candidate vectors to be scored. Defaults to all vectors.
+        deleted: A boolean mask of deleted ids, which are never returned. Defaults to None.
+
+    Returns:
+        List: The (id, 1 - cosine similarity) of the k closest vectors, closest first.
+    """
+    if k <= 0:
+        return []
+    if ids is None:
+        # every vector: scored block by block straight from the memory map instead of gathering a copy
+        scores = np.concatenate([np.asarray(vectors[i: i + _BLOCK]) @ query for i in range(0, len(vectors), _BLOCK)]) \
+            if len(vectors) else np.zeros(0, dtype=np.float32)
+        ids = np.arange(len(scores))
+        if deleted is not None and len(ids):
+            _live = ~deleted[:len(ids)]
+            ids, scores = ids[_live], scores[_live]
+    else:
+        if deleted is not None and len(ids):
+            ids = ids[~deleted[ids]]
+        ids = np.sort(ids)
+        scores = np.asarray(vectors[ids]) @ query
+    if not len(ids):
+        return []
+    k = min(k, len(ids))
+    _top = np.argpartition(-scores, k - 1)[:k]
+    _top = _top[np.argsort(-scores[_top])]
+    return [(int(ids[_i]), 1.0 - float(scores[_i])) for _i in _top]
+
+
+def recall_report(store, queries: List[List[float]], k: int, nprobes: List[int] = (1, 2, 4, 8, 16, 32, 64)) \
+        -> List[Dict]:
+    """
+    Measures recall and latency of approximate search against exact search on a store with an IVF index.
+
+    Args:
+        store: A NumpyFlatVectorStore with a built index.
+        queries: The query embeddings to evaluate with.
+        k: The number of neighbours retrieved per query.
+        nprobes: The nprobe values to evaluate. Defaults to powers of two up to 64.
+
+    Returns:
+        List[Dict]: For exact search and each nprobe, the mean recall@k and the p50 and p99 latency in ms.
+    """
+    queries = _normalize(np.asarray(queries, dtype=np.float32))
+
+    def _run(nprobe: int) -> Tuple[List[set], List[float]]:
+        _results, _latencies = [], []
+        for query in queries:
+            _started = time.perf_counter()
+            _results.append({_id for _id, _ in store.search_ids(query, k, nprobe=nprobe)})
+            _latencies.append((time.perf_counter() - _started) * 1000)
+        return _results, _latencies
+
+    exact, latencies = _run(0)
+    report = [{"nprobe": "exact", "recall": 1.0,
+               "p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99))}]
+    for nprobe in nprobes:
+        _approximate, latencies = _run(nprobe)
+        report.append({"nprobe": nprobe,
+                       "recall": float(np.mean([len(_a & _e) / max(len(_e), 1)
+                                                for _a, _e in zip(_approximate, exact)])),
+                       "p50_ms": float(np.percentile(latencies, 50)),
+                       "p99_ms": float(np.percentile(latencies, 99))})
+    return report
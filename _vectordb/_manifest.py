@@ -0,0 +1,170 @@
+import os
+import hashlib
+from typing import Dict, List, Tuple
+from _config import _config as _config_
+from _common import _common as _common_
+from _util import _util_file as _util_file_
+
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+@_common_.exception_handler
+def manifest_location(vector_db=None) -> str:
+    """
+    Returns the location of the ingestion manifest, stored next to the vector database.
+
+    Args:
+        vector_db: The vector database, whose own `manifest_path` is used if it has one, as every store
+            opened from a file does, so each backend and collection keeps its own manifest. Defaults to None,
+            the manifest of the configured SQLite database.
+
+    Returns:
+        str: The path of the manifest file.
+
+    """
+    if getattr(vector_db, "manifest_path", ""):
+        return vector_db.manifest_path
+    _config = _config_.PGConfigSingleton()
+    return f"{_config.config.get('vector_db_default_location')}.manifest.json"
+
+
+@_common_.exception_handler
+def load_manifest(filepath: str = "") -> Dict:
+    """
+    Loads the ingestion manifest.
+
+    The manifest records, for every ingested file, its size, modification time, content hash and the
+    hash and row id of each of its chunks, together with a version number that is incremented each
+    time ingestion changes the vector database.
+
+    Args:
+        filepath: The path of the manifest file. Defaults to the location next to the vector database.
+
+    Returns:
+        Dict: The manifest, or an empty manifest if none has been written yet.
+
+    """
+    filepath = filepath or manifest_location()
+    if not _util_file_.is_file_exist(filepath) or _util_file_.is_file_empty(filepath):
+        return {"version": 0, "files": {}}
+    return _util_file_.json_load(filepath)
+
+
+@_common_.exception_handler
+def save_manifest(manifest: Dict, filepath: str = "") -> bool:
+    """
+    Writes the ingestion manifest atomically, so a crash never leaves a partially written manifest behind.
+
+    Args:
+        manifest: The manifest to be written.
+        filepath: The path of the manifest file. Defaults to the location next to the vector database.
+
+    Returns:
+        bool: True, indicating that the manifest was written.
+
+    """
+    filepath = filepath or manifest_location()
+    _util_file_.json_dump(f"{filepath}.tmp", manifest)
+    os.replace(f"{filepath}.tmp", filepath)
+    return True
+
+
+def manifest_version(filepath: str = "") -> int:
+    """
+    Returns a token that changes every time ingestion rewrites the manifest, i.e. whenever the index may
+    have changed. It is read from the manifest file's modification time, so checking it does not parse
+    the manifest.
+
+    Args:
+        filepath: The path of the manifest file. Defaults to the location next to the vector database.
+
+    Returns:
+        int: The index version token, 0 if nothing has been ingested yet.
+
+    """
+    try:
+        return os.stat(filepath or manifest_location()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+@_common_.exception_handler
+def file_hash(filepath: str) -> str:
+    """
+    Computes the sha256 hash of a file's content, reading it in fixed-size blocks.
+
+    Args:
+        filepath: The path of the file to be hashed.
+
+    Returns:
+        str: The hex digest of the file content.
+
+    """
+    _hash = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(_HASH_BLOCK_SIZE), b""):
+            _hash.update(block)
+    return _hash.hexdigest()
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def is_unchanged(entry: Dict, stat: os.stat_result) -> bool:
+    return bool(entry) and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime
+
+
+def chunk_rowids(entry: Dict) -> Dict[str, List[int]]:
+    """
+    Indexes the chunks recorded in a manifest entry by content hash.
+
+    Args:
+        entry: The manifest entry of a file, or an empty dict if the file has not been ingested yet.
+
+    Returns:
+        Dict: The row ids of the stored chunks, keyed by chunk hash.
+
+    """
+    _existing = {}
+    for _hash, _rowid in (entry or {}).get("chunks", []):
+        _existing.setdefault(_hash, []).append(_rowid)
+    return _existing
+
+
+def match_chunk(existing: Dict[str, List[int]], text: str) -> List:
+    """
+    Matches a chunk against the stored chunks of its file, consuming the stored row if there is one.
+
+    Args:
+        existing: The stored row ids keyed by chunk hash, as returned by `chunk_rowids`.
+        text: The chunk text.
+
+    Returns:
+        List: The [chunk hash, row id] of the chunk, where the row id is None for a new chunk.
+
+    """
+    _hash = chunk_hash(text)
+    return [_hash, existing[_hash].pop(0) if existing.get(_hash) else None]
+
+
+def diff_chunks(entry: Dict, texts: List[str]) -> Tuple[List[List], List[int], List[int]]:
+    """
+    Compares the chunks of a file against the chunks recorded in its manifest entry.
+
+    Chunks are matched by content hash, so chunks that did not change keep their existing rows.
+
+    Args:
+        entry: The manifest entry of the file, or an empty dict if the file has not been ingested yet.
+        texts: The current chunks of the file.
+
+    Returns:
+        Tuple: The [chunk hash, row id] list of the file where new chunks have a row id of None, the
+        positions of the new chunks within `texts`, and the row ids of the chunks that no longer exist.
+
+    """
+    _existing = chunk_rowids(entry)
+    chunks = [match_chunk(_existing, text) for text in texts]
+    return (chunks,
+            [position for position, (_, _rowid) in enumerate(chunks) if _rowid is None],
+            [_rowid for _rowids in _existing.values() for _rowid in _rowids])
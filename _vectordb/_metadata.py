@@ -0,0 +1,126 @@
+import json
+import sqlite3
+from typing import Any, Dict, List, Tuple
+
+_COMPARISONS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_OPERATORS = ["$eq", "$ne", "$in", "$nin", "$exists", *_COMPARISONS]
+_SCALARS = (str, int, float)
+_BACKFILL_BATCH = 10000
+
+
+def index_rows(ids: List[int], metadatas: List[Dict]) -> List[Tuple[int, str, Any]]:
+    """
+    Flattens chunk metadata into (id, key, value) rows of the metadata index.
+
+    Scalar values are indexed as they are and every scalar element of a list is indexed separately, so a
+    filter on a list field such as `tags` matches if any element matches. Other values are not indexed.
+
+    Args:
+        ids: The ids of the chunks.
+        metadatas: The metadata of each chunk.
+
+    Returns:
+        List: The index rows.
+    """
+    rows = []
+    for _id, metadata in zip(ids, metadatas):
+        for key, value in (metadata or {}).items():
+            if isinstance(value, (list, tuple)):
+                rows.extend((_id, key, element) for element in value if isinstance(element, _SCALARS))
+            elif isinstance(value, _SCALARS):
+                rows.append((_id, key, value))
+    return rows
+
+
+def create_index(connection: sqlite3.Connection, table: str, source: str, id_column: str = "id") -> None:
+    """
+    Creates the metadata index table of a chunk table, filling it from the chunks' JSON metadata the first
+    time, so stores created before the index existed can be filtered too.
+
+    The index has one (id, key, value) row per indexed metadata value, see `index_rows`, and a
+    (key, value, id) B-tree, so a filter condition is answered by an index range scan over the matching
+    chunks only.
+
+    Args:
+        connection: The connection to the database holding the chunk table.
+        table: The name of the index table.
+        source: The name of the chunk table, with a JSON `metadata` column.
+        id_column: The id column of the chunk table. Defaults to "id".
+    """
+    _exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (table,)).fetchone()
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER NOT NULL, key TEXT NOT NULL, value)")
+    connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_key_value ON {table} (key, value, id)")
+    connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_id ON {table} (id)")
+    if not _exists:
+        cursor = connection.execute(f"SELECT {id_column}, metadata FROM {source}")
+        while rows := cursor.fetchmany(_BACKFILL_BATCH):
+            connection.executemany(f"INSERT INTO {table} (id, key, value) VALUES (?, ?, ?)",
+                                   index_rows([_id for _id, _ in rows],
+                                              [json.loads(metadata or "{}") for _, metadata in rows]))
+    connection.commit()
+
+
+def _condition(table: str, id_column: str, key: str, operator: str, value: Any) -> Tuple[str, List]:
+    _matches = f"SELECT id FROM {table} WHERE key = ?"
+    if operator in ("$eq", "$ne"):
+        if not isinstance(value, _SCALARS):
+            raise ValueError(f"filter value of {key} must be a string or number, use $in to match several")
+        return f"{id_column} {'IN' if operator == '$eq' else 'NOT IN'} ({_matches} AND value = ?)", [key, value]
+    if operator in ("$in", "$nin"):
+        if not isinstance(value, (list, tuple)) or not all(isinstance(element, _SCALARS) for element in value):
+            raise ValueError(f"filter value of {key} {operator} must be a list of strings or numbers")
+        value = list(value)
+        return (f"{id_column} {'IN' if operator == '$in' else 'NOT IN'} "
+                f"({_matches} AND value IN ({','.join('?' * len(value))}))", [key, *value])
+    if operator in _COMPARISONS:
+        if not isinstance(value, _SCALARS):
+            raise ValueError(f"filter value of {key} {operator} must be a string or number")
+        # numbers and strings are only compared with their own kind, like MongoDB does
+        _types = "'integer', 'real'" if isinstance(value, (int, float)) else "'text'"
+        return (f"{id_column} IN ({_matches} AND value {_COMPARISONS[operator]} ? AND typeof(value) IN ({_types}))",
+                [key, value])
+    if operator == "$exists":
+        return f"{id_column} {'IN' if value else 'NOT IN'} ({_matches})", [key]
+    raise ValueError(f"filter operator {operator} not found, valid list is {_OPERATORS + ['$and', '$or']}")
+
+
+def compile_filter(filter: Dict, table: str, id_column: str = "id") -> Tuple[str, List]:
+    """
+    Compiles a MongoDB-style metadata filter into an SQL condition on a chunk table's id column.
+
+    `{"source": "a.txt"}` matches chunks whose `source` is "a.txt", `{"tags": {"$in": ["x", "y"]}}` chunks
+    tagged x or y, and `{"ingested_at": {"$gte": 1700000000}}` chunks ingested since then. The operators are
+    $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte and $exists; the conditions of a filter are combined with AND,
+    and `{"$and": [...]}` and `{"$or": [...]}` combine whole filters. Every condition is a subquery on the
+    metadata index, see `create_index`.
+
+    Args:
+        filter: The metadata filter.
+        table: The name of the metadata index table.
+        id_column: The id column of the chunk table the condition is applied to. Defaults to "id".
+
+    Returns:
+        Tuple: The SQL condition and its parameters.
+
+    Raises:
+        ValueError: If the filter is malformed.
+    """
+    if not isinstance(filter, dict):
+        raise ValueError(f"filter must be an object, not {type(filter).__name__}")
+    conditions, params = [], []
+    for key, condition in filter.items():
+        if key in ("$and", "$or"):
+            if not isinstance(condition, list):
+                raise ValueError(f"filter {key} must be a list of filters")
+            _compiled = [compile_filter(_filter, table, id_column) for _filter in condition]
+            _sql = f" {key[1:].upper()} ".join(f"({_condition_sql})" for _condition_sql, _ in _compiled)
+            conditions.append(_sql or ("1" if key == "$and" else "0"))
+            params.extend(param for _, _params in _compiled for param in _params)
+            continue
+        _operators = condition.items() if isinstance(condition, dict) else [("$eq", condition)]
+        for operator, value in _operators:
+            _sql, _params = _condition(table, id_column, key, operator, value)
+            conditions.append(_sql)
+            params.extend(_params)
+    return " AND ".join(conditions) or "1", params
@@ -0,0 +1,184 @@
+import time
+from typing import List, Dict
+import numpy as np
+from _config import _config as _config_
+
+_BLOCK = 16384
+_TRAIN_POINTS = 65536
+
+
+class ScalarQuantizer:
+    kind = "int8"
+
+    def __init__(self, low: np.ndarray, scale: np.ndarray):
+        """
+        Scalar quantizer storing every dimension of a vector in one byte.
+
+        Each dimension is mapped linearly from its trained [low, high] range onto 0..255, which makes the
+        codes 4x smaller than float32 vectors. Scores are computed without decoding the codes into a
+        full float matrix: q . (low + scale * c) = q . low + (q * scale) . c.
+
+        Args:
+            low: The per-dimension minimum.
+            scale: The per-dimension step between two code values.
+        """
+        self.low = low.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return len(self.low)
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, seed: int = 0) -> "ScalarQuantizer":
+        _sample = _sample_rows(vectors, seed)
+        low, high = _sample.min(axis=0), _sample.max(axis=0)
+        return cls(low, np.maximum(high - low, 1e-12) / 255)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((np.asarray(vectors) - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        _weighted, _offset = query * self.scale, float(query @ self.low)
+        return np.concatenate([np.asarray(codes[ids[i: i + _BLOCK]], dtype=np.float32) @ _weighted + _offset
+                               for i in range(0, len(ids), _BLOCK)])
+
+    def save(self, filepath: str) -> None:
+        np.savez(filepath, kind=self.kind, low=self.low, scale=self.scale)
+
+
+class ProductQuantizer:
+    kind = "pq"
+
+    def __init__(self, codebooks: np.ndarray):
+        """
+        Product quantizer storing a vector as one byte per subspace.
+
+        The vector is cut into `m` equal subspaces, and each subvector is replaced by the index of its nearest
+        of 256 centroids learned for that subspace, so a 384-dimension float32 vector with m=96 takes 96 bytes
+        instead of 1536. Scores are computed asymmetrically: the query is compared exactly against every
+        centroid once, and a vector's score is the sum of the looked-up subspace scores.
+
+        Args:
+            codebooks: The (m, 256, dim / m) subspace centroids.
+        """
+        self.codebooks = codebooks.astype(np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return len(self.codebooks)
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, m: int, iterations: int = 15, seed: int = 0) -> "ProductQuantizer":
+        _sample = _sample_rows(vectors, seed)
+        if _sample.shape[1] % m:
+            raise ValueError(f"pq_m {m} must divide the vector dimension {_sample.shape[1]}")
+        rng = np.random.default_rng(seed)
+        _subspaces = _sample.reshape(len(_sample), m, -1)
+        _ksub = min(256, len(_sample))
+        codebooks = np.zeros((m, 256, _subspaces.shape[2]), dtype=np.float32)
+        for j in range(m):
+            _points = _subspaces[:, j]
+            _centroids = _points[rng.choice(len(_points), _ksub, replace=False)].copy()
+            for _ in range(iterations):
+                _assign = _nearest_l2(_centroids, _points)
+                _counts = np.bincount(_assign, minlength=_ksub)
+                _sums = np.zeros_like(_centroids)
+                np.add.at(_sums, _assign, _points)
+                _filled = _counts > 0
+                _centroids[_filled] = _sums[_filled] / _counts[_filled, None]
+            codebooks[j, :_ksub], codebooks[j, _ksub:] = _centroids, _centroids[0]
+        return cls(codebooks)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        _subspaces = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.code_size, -1)
+        return np.stack([_nearest_l2(self.codebooks[j], _subspaces[:, j]) for j in range(self.code_size)],
+                        axis=1).astype(np.uint8)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        _table = np.einsum("jcd,jd->jc", self.codebooks, query.reshape(self.code_size, -1))
+        _subspaces = np.arange(self.code_size)
+        return np.concatenate([_table[_subspaces, np.asarray(codes[ids[i: i + _BLOCK]])].sum(axis=1)
+                               for i in range(0, len(ids), _BLOCK)])
+
+    def save(self, filepath: str) -> None:
+        np.savez(filepath, kind=self.kind, codebooks=self.codebooks)
+
+
+def _sample_rows(vectors: np.ndarray, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    if len(vectors) <= _TRAIN_POINTS:
+        return np.asarray(vectors, dtype=np.float32)
+    return np.asarray(vectors[np.sort(rng.choice(len(vectors), _TRAIN_POINTS, replace=False))], dtype=np.float32)
+
+
+def _nearest_l2(centroids: np.ndarray, points: np.ndarray) -> np.ndarray:
+    _norms = (centroids ** 2).sum(axis=1)
+    return np.concatenate([np.argmin(_norms - 2 * points[i: i + _BLOCK] @ centroids.T, axis=1)
+                           for i in range(0, len(points), _BLOCK)])
+
+
+def train(kind: str, vectors: np.ndarray, pq_m: int = 0):
+    """
+    Trains a quantizer of the given kind on a sample of the vectors.
+
+    Args:
+        kind: "int8" for scalar quantization or "pq" for product quantization.
+        vectors: The (n, dim) vectors to learn from.
+        pq_m: The number of product quantization subspaces. Defaults to dim / 4.
+
+    Returns:
+        The trained ScalarQuantizer or ProductQuantizer.
+    """
+    if kind == "int8":
+        return ScalarQuantizer.train(vectors)
+    if kind == "pq":
+        return ProductQuantizer.train(vectors, pq_m or vectors.shape[1] // 4)
+    raise ValueError(f"quantization {kind} not found, valid list is ['int8', 'pq']")
+
+
+def load(filepath: str):
+    with np.load(filepath) as data:
+        if str(data["kind"]) == "int8":
+            return ScalarQuantizer(data["low"], data["scale"])
+        return ProductQuantizer(data["codebooks"])
+
+
+def compare_quantization(store, queries: List[List[float]], k: int, tolerance: float = None) -> Dict:
+    """
+    Compares quantized search with exact float search on a NumpyFlatVectorStore.
+
+    Args:
+        store: A NumpyFlatVectorStore with a trained quantizer.
+        queries: The query embeddings to evaluate with.
+        k: The number of neighbours retrieved per query.
+        tolerance: The accepted loss of recall@k. Defaults to `quantization_recall_tolerance` from the config
+            file, or 0.05.
+
+    Returns:
+        Dict: The quantization kind, bytes per vector for floats and codes, the compression ratio,
+        the mean recall@k of quantized search, p50 latencies of both, and whether recall is within tolerance.
+    """
+    if tolerance is None:
+        tolerance = float(_config_.PGConfigSingleton().config.get("quantization_recall_tolerance") or 0.05)
+    queries = np.asarray(queries, dtype=np.float32)
+    queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    _recalls, _exact_ms, _quantized_ms = [], [], []
+    for query in queries:
+        _started = time.perf_counter()
+        _exact = {_id for _id, _ in store.search_ids(query, k, nprobe=0, quantized=False)}
+        _exact_ms.append((time.perf_counter() - _started) * 1000)
+        _started = time.perf_counter()
+        _quantized = {_id for _id, _ in store.search_ids(query, k, nprobe=0)}
+        _quantized_ms.append((time.perf_counter() - _started) * 1000)
+        _recalls.append(len(_exact & _quantized) / max(len(_exact), 1))
+
+    recall = float(np.mean(_recalls))
+    return {"quantization": store.quantizer.kind,
+            "float_bytes_per_vector": 4 * store.dim,
+            "code_bytes_per_vector": store.quantizer.code_size,
+            "compression": 4 * store.dim / store.quantizer.code_size,
+            "recall": recall,
+            "exact_p50_ms": float(np.percentile(_exact_ms, 50)),
+            "quantized_p50_ms": float(np.percentile(_quantized_ms, 50)),
+            "within_tolerance": recall >= 1.0 - tolerance}
@@ -0,0 +1,75 @@
+import os
+from _config import _config as _config_
+from _common import _common as _common_
+
+
+def _open_backend(embedding, texts=None, location: str = ""):
+    _config = _config_.PGConfigSingleton()
+    _backend = _config.config.get("vector_db_backend") or "sqlite"
+    if _backend == "numpy":
+        from _vectordb import numpy_flat
+        return numpy_flat.get_vector_db(embedding, texts=texts, location=location)
+    if _backend == "sqlite":
+        from _vectordb import sqllite
+        return sqllite.get_vector_db(embedding, texts=texts, location=location)
+    raise ValueError(f"vector_db_backend {_backend} not found, valid list is ['sqlite', 'numpy']")
+
+
+def collection_location(collection: str = "") -> str:
+    """
+    Returns the path prefix of a sharded collection's files, next to the configured vector database.
+
+    Args:
+        collection: The collection name. Defaults to "default".
+
+    Returns:
+        str: The path prefix, to which `.shard{i}` and `.manifest.json` are appended.
+
+    """
+    _config = _config_.PGConfigSingleton()
+    if (_config.config.get("vector_db_backend") or "sqlite") == "numpy":
+        _base = os.path.expanduser(_config.config.get("vector_db_numpy_location"))
+    else:
+        _base = os.path.splitext(_config.config.get("vector_db_default_location"))[0]
+    return f"{_base}.{collection or 'default'}"
+
+
+@_common_.exception_handler
+def get_vector_db(embedding, texts=None, collection: str = ""):
+    """
+    Opens the vector database backend selected by `vector_db_backend` in the config file.
+
+    The supported backends are `sqlite` (SQLite with the sqlite-vss extension, the default) and `numpy`
+    (a memory-mapped flat NumPy store). All backends expose the same langchain VectorStore surface,
+    including `as_retriever(search_kwargs={"k": ...})`, plus `add_embeddings`, `delete`,
+    `similarity_search_by_vectors` and `close`.
+
+    With `vector_db_shards` above 1, or a named collection, the collection is a ShardedVectorStore over
+    that many backend stores, each in its own file, with its own ingestion manifest. The number of shards
+    of a collection must not change once it has been ingested into.
+
+    Args:
+        embedding: The embedding model used to embed texts and queries.
+        texts: An optional list of texts to be added to the database. Defaults to None.
+        collection: The collection name. Defaults to `vector_db_collection`, or the unsharded database.
+
+    Returns:
+        VectorStore: The vector database.
+
+    """
+    _config = _config_.PGConfigSingleton()
+    collection = collection or _config.config.get("vector_db_collection") or ""
+    _shards = int(_config.config.get("vector_db_shards") or 1)
+    if _shards <= 1 and not collection:
+        return _open_backend(embedding, texts=texts)
+
+    from _vectordb import sharded
+    _location = collection_location(collection)
+    _extension = "" if (_config.config.get("vector_db_backend") or "sqlite") == "numpy" else ".db"
+    vector_db = sharded.ShardedVectorStore(
+        [_open_backend(embedding, location=f"{_location}.shard{i}{_extension}") for i in range(max(_shards, 1))],
+        embedding, routing=_config.config.get("vector_db_shard_routing") or "source",
+        manifest_path=f"{_location}.manifest.json")
+    if texts:
+        vector_db.add_texts(texts)
+    return vector_db
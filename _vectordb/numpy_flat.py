@@ -0,0 +1,447 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import List, Optional, Any, Iterable, Tuple, Type
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores.base import VectorStore
+from _config import _config as _config_
+from _common import _common as _common_
+from _common import _metrics as _metrics_
+from _util import _util_directory as _util_directory_
+from _vectordb import _ann as _ann_
+from _vectordb import _quantization as _quantization_
+from _vectordb import _metadata as _metadata_
+
+_QUERY_BLOCK = 64
+
+
+def _excluded(deleted: np.ndarray, exclude: Optional[Iterable[int]]) -> np.ndarray:
+    # the deleted flags with the excluded ids flagged too, on a copy so the store's own flags are untouched
+    if not exclude:
+        return deleted
+    _ids = np.fromiter(exclude, dtype=np.int64)
+    deleted = np.array(deleted, dtype=bool)
+    deleted[_ids[(_ids >= 0) & (_ids < len(deleted))]] = True
+    return deleted
+
+
+class NumpyFlatVectorStore(VectorStore):
+    def __init__(self, location: str, embedding: Embeddings, ann: str = "", nlist: int = 1024, nprobe: int = 16,
+                 min_train_size: int = 0, quantization: str = "", pq_m: int = 0, oversample: int = 4):
+        """
+        A flat vector store keeping float32 unit vectors in a memory-mapped file.
+
+        Vectors are appended as raw float32 rows to `<location>.f32` and searched by exact cosine similarity
+        with a matrix-vector product and `argpartition`. The chunk texts, metadata and deletion flags live in
+        a sidecar SQLite file `<location>.sqlite`, whose row id is the row of the chunk in the vector file.
+        Opening the store maps the vector file instead of reading it, so cold start is immediate and worker
+        processes opening the same store share its pages through the OS page cache.
+
+        With `ann="ivf"`, an IVF index (`<location>.ivf.npz`) is built once the store holds `min_train_size`
+        vectors and is kept up to date as vectors are appended; searches then only score the vectors in the
+        `nprobe` closest of its `nlist` cells. `nprobe` can be overridden per search, and 0 forces exact search.
+
+        With `quantization` set to "int8" or "pq", a quantizer (`<location>.quantizer.npz`) is trained at the
+        same size threshold and every vector is also stored as a compressed code in `<location>.codes`.
+        Searches then score the codes, keep the `k * oversample` best candidates and re-score only those
+        exactly against the float vectors, so the float file is only paged in for a handful of rows.
+
+        Files are ingested into the store against its own manifest, `<location>.manifest.json`.
+
+        Metadata values are indexed in the sidecar, and a search given a `filter` (see
+        `_metadata.compile_filter`) first looks up the matching rows there and then only scores those, so a
+        selective filter makes the search cheaper. Filtered searches do not use the IVF index.
+
+        Ids only grow, so a search given a `watermark` (see `watermark`) only sees the rows that existed
+        when it was taken, by searching a prefix of the vector file. Rows about to be deleted are hidden from
+        a search by passing their ids as `exclude`.
+
+        Args:
+            location: The path prefix of the vector file and its sidecar.
+            embedding: The embedding model used to embed texts and queries.
+            ann: The approximate index to maintain, "ivf" or "" for exact search only. Defaults to "".
+            nlist: The number of IVF cells. Defaults to 1024.
+            nprobe: The default number of cells probed per query. Defaults to 16.
+            min_train_size: The number of vectors at which the index and quantizer are trained.
+                Defaults to 39 * nlist.
+            quantization: The code type, "int8", "pq" or "" for none. Defaults to "".
+            pq_m: The number of product quantization subspaces. Defaults to dim / 4.
+            oversample: The candidate multiplier for exact re-scoring. Defaults to 4.
+        """
+        self.location = location
+        self.manifest_path = f"{location}.manifest.json"
+        self._embedding = embedding
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(f"{location}.sqlite", check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, text TEXT, metadata TEXT, "
+            "deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._connection.execute("CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT)")
+        self._connection.commit()
+        _metadata_.create_index(self._connection, "chunk_metadata", "chunks")
+        _dim = self._connection.execute("SELECT value FROM store_info WHERE key = 'dim'").fetchone()
+        self.dim = int(_dim[0]) if _dim else 0
+        self._deleted = np.zeros(0, dtype=bool)
+        self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self._truncate(self._committed())
+        self._remap()
+        _ids = [_id for _id, in self._connection.execute("SELECT id FROM chunks WHERE deleted = 1")]
+        self._deleted[[_id for _id in _ids if _id < len(self._deleted)]] = True
+
+        self.ann, self.nlist, self.nprobe = ann, nlist, nprobe
+        self.min_train_size = min_train_size or 39 * nlist
+        self.quantization, self.pq_m, self.oversample = quantization, pq_m, oversample
+        self.quantizer, self._codes = None, np.zeros((0, 0), dtype=np.uint8)
+        if self.quantization in ("int8", "pq") and os.path.exists(f"{location}.quantizer.npz"):
+            self.quantizer = _quantization_.load(f"{location}.quantizer.npz")
+            self._remap_codes()
+            if len(self._codes) < len(self._vectors):
+                self._append_codes(self._vectors[len(self._codes):])
+
+        self.index = None
+        if self.ann == "ivf" and os.path.exists(f"{location}.ivf.npz"):
+            self.index = _ann_.IVFIndex.load(f"{location}.ivf.npz")
+            _indexed = self.index.ntotal
+            self.index.add(np.arange(_indexed, len(self._vectors)), self._vectors[_indexed:])
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    def _committed(self) -> int:
+        # the number of vector rows with a committed chunk row, the sidecar being the source of truth
+        return self._connection.execute("SELECT coalesce(max(id) + 1, 0) FROM chunks").fetchone()[0]
+
+    def _truncate(self, rows: int) -> None:
+        # drops the vectors appended after the last committed chunk by a failed or interrupted insert, so the
+        # next append starts at a row boundary; the dropped rows were never memory mapped
+        _path = f"{self.location}.f32"
+        if os.path.exists(_path) and os.path.getsize(_path) > rows * 4 * self.dim:
+            os.truncate(_path, rows * 4 * self.dim)
+
+    def _remap(self) -> None:
+        _path = f"{self.location}.f32"
+        _rows = os.path.getsize(_path) // (4 * self.dim) if self.dim and os.path.exists(_path) else 0
+        self._vectors = np.memmap(_path, dtype=np.float32, mode="r", shape=(_rows, self.dim)) if _rows \
+            else np.zeros((0, self.dim), dtype=np.float32)
+        _deleted = np.zeros(_rows, dtype=bool)
+        _deleted[:len(self._deleted)] = self._deleted[:_rows]
+        self._deleted = _deleted
+
+    def _remap_codes(self) -> None:
+        _path, _size = f"{self.location}.codes", self.quantizer.code_size
+        _rows = os.path.getsize(_path) // _size if os.path.exists(_path) else 0
+        self._codes = np.memmap(_path, dtype=np.uint8, mode="r", shape=(_rows, _size)) if _rows \
+            else np.zeros((0, _size), dtype=np.uint8)
+
+    def _append_codes(self, vectors: np.ndarray) -> None:
+        with open(f"{self.location}.codes", "ab") as file:
+            for i in range(0, len(vectors), 65536):
+                file.write(self.quantizer.encode(vectors[i: i + 65536]).tobytes())
+        self._remap_codes()
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[int]:
+        texts = list(texts)
+        with _metrics_.span("embedding", items=len(texts)):
+            embeddings = self._embedding.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas)
+
+    @_metrics_.timed("vector_insert", items=len)
+    def add_embeddings(self, texts: List[str], embeddings: List[List[float]],
+                       metadatas: Optional[List[dict]] = None) -> List[int]:
+        """
+        Appends already embedded texts to the store.
+
+        Args:
+            texts: The texts to be inserted.
+            embeddings: The embedding of each text.
+            metadatas: The optional metadata of each text. Defaults to None.
+
+        Returns:
+            List[int]: The ids (vector rows) of the inserted texts, in order.
+        """
+        if not texts:
+            return []
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        metadatas = metadatas or [{} for _ in texts]
+        with self._lock:
+            _new = not self.dim
+            if _new:
+                self.dim = vectors.shape[1]
+                self._connection.execute("INSERT INTO store_info (key, value) VALUES ('dim', ?)", (str(self.dim),))
+            _start = self._committed()
+            _ids = list(range(_start, _start + len(texts)))
+            try:
+                self._truncate(_start)
+                with open(f"{self.location}.f32", "ab") as file:
+                    file.write(vectors.tobytes())
+                self._connection.executemany(
+                    "INSERT INTO chunks (id, text, metadata) VALUES (?, ?, ?)",
+                    [(_id, text, json.dumps(metadata)) for _id, text, metadata in zip(_ids, texts, metadatas)]
+                )
+                self._connection.executemany("INSERT INTO chunk_metadata (id, key, value) VALUES (?, ?, ?)",
+                                             _metadata_.index_rows(_ids, metadatas))
+                self._connection.commit()
+            except BaseException:
+                # the vectors are only kept along with their chunk rows
+                self._connection.rollback()
+                self._truncate(_start)
+                if _new:
+                    self.dim = 0
+                raise
+            self._remap()
+            if self.index is not None:
+                self.index.add(np.asarray(_ids), vectors)
+            elif self.ann == "ivf" and len(self._vectors) >= self.min_train_size:
+                self.build_index()
+            if self.quantizer is not None:
+                self._append_codes(vectors)
+            elif self.quantization in ("int8", "pq") and len(self._vectors) >= self.min_train_size:
+                self.train_quantizer()
+        return _ids
+
+    def train_quantizer(self) -> None:
+        """
+        Trains the quantizer on a sample of the stored vectors, encodes all of them and saves it.
+        """
+        with self._lock:
+            self.quantizer = _quantization_.train(self.quantization, self._vectors, pq_m=self.pq_m)
+            self.quantizer.save(f"{self.location}.quantizer.npz")
+            if os.path.exists(f"{self.location}.codes"):
+                os.remove(f"{self.location}.codes")
+            self._append_codes(self._vectors)
+
+    def build_index(self, nlist: int = 0) -> None:
+        """
+        Trains the IVF index on the stored vectors, assigns all of them to it and saves it.
+
+        Args:
+            nlist: The number of cells. Defaults to the store's `nlist`.
+        """
+        with self._lock:
+            self.index = _ann_.IVFIndex.train(self._vectors, nlist or self.nlist)
+            self.index.add(np.arange(len(self._vectors)), self._vectors)
+            self.index.save(f"{self.location}.ivf.npz")
+
+    def delete(self, ids: Optional[List[int]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._lock:
+            self._connection.executemany("UPDATE chunks SET deleted = 1 WHERE id = ?", [(_id,) for _id in ids])
+            self._connection.commit()
+            self._deleted[[_id for _id in ids if _id < len(self._deleted)]] = True
+        return True
+
+    def watermark(self) -> int:
+        """
+        Returns the highest id in the store, -1 if it is empty. Searches given it as `watermark` ignore every
+        row appended after it was taken.
+        """
+        with self._lock:
+            return len(self._vectors) - 1
+
+    def filter_ids(self, filter: Optional[dict]) -> Optional[np.ndarray]:
+        """
+        Returns the sorted ids of the live chunks whose metadata matches a filter, or None without a filter.
+        """
+        if not filter:
+            return None
+        _condition, _params = _metadata_.compile_filter(filter, "chunk_metadata")
+        with self._lock:
+            return np.fromiter((_id for _id, in self._connection.execute(
+                f"SELECT id FROM chunks WHERE deleted = 0 AND {_condition} ORDER BY id", _params)), dtype=np.int64)
+
+    def search_ids(self, query: np.ndarray, k: int, nprobe: Optional[int] = None,
+                   quantized: bool = True, ids: Optional[np.ndarray] = None,
+                   watermark: Optional[int] = None, exclude: Optional[Iterable[int]] = None) -> List[Tuple[int, float]]:
+        """
+        Returns the ids and cosine distances of the k vectors closest to a unit query vector.
+
+        Args:
+            query: The unit query vector.
+            k: The number of results.
+            nprobe: The number of IVF cells to probe, 0 for exact search. Defaults to the store's `nprobe`.
+            quantized: Whether to pre-select candidates on the quantized codes, if a quantizer is trained.
+                Defaults to True.
+            ids: The sorted ids the search is restricted to, e.g. those of `filter_ids`, in which case the
+                IVF index is not used. Defaults to None.
+            watermark: The highest id the search sees, see `watermark`. Defaults to None, all ids.
+            exclude: Ids the search skips as if deleted. Defaults to None.
+
+        Returns:
+            List: The (id, 1 - cosine similarity) of the k closest vectors, closest first.
+        """
+        with self._lock:
+            vectors, deleted, index = self._vectors, self._deleted, self.index
+            quantizer, codes = self.quantizer, self._codes
+        if watermark is not None:
+            vectors, deleted, codes = vectors[:watermark + 1], deleted[:watermark + 1], codes[:watermark + 1]
+        deleted = _excluded(deleted, exclude)
+        nprobe = self.nprobe if nprobe is None else nprobe
+        if ids is None and index is not None and nprobe and nprobe < index.nlist:
+            ids = index.candidates(query, nprobe)
+        if ids is not None:
+            ids = ids[ids < len(vectors)]
+
+        if quantized and quantizer is not None and len(codes):
+            ids = np.arange(len(codes)) if ids is None else np.sort(ids[ids < len(codes)])
+            ids = ids[~deleted[ids]]
+            if len(ids) > k * self.oversample:
+                _scores = quantizer.scores(codes, query, ids)
+                ids = ids[np.argpartition(-_scores, k * self.oversample - 1)[:k * self.oversample]]
+        return _ann_.top_k(vectors, query, k, ids=ids, deleted=deleted)
+
+    def _top_k(self, queries: np.ndarray, k: int, nprobe: Optional[int] = None, filter: Optional[dict] = None,
+               watermark: Optional[int] = None,
+               exclude: Optional[Iterable[int]] = None) -> List[List[Tuple[int, float]]]:
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        ids = self.filter_ids(filter)
+        if self.quantizer is not None or \
+                (ids is None and self.index is not None and (self.nprobe if nprobe is None else nprobe)):
+            return [self.search_ids(query, k, nprobe=nprobe, ids=ids, watermark=watermark, exclude=exclude)
+                    for query in queries]
+
+        with self._lock:
+            vectors, deleted = self._vectors, self._deleted
+        if watermark is not None:
+            # a prefix of the memory map, so hiding the rows appended since costs nothing
+            vectors, deleted = vectors[:watermark + 1], deleted[:watermark + 1]
+        deleted = _excluded(deleted, exclude)
+        if ids is not None:
+            # pre-filtered: only the rows matching the filter are gathered and scored
+            ids = ids[ids < len(vectors)]
+            if exclude:
+                ids = ids[~deleted[ids]]
+            vectors = np.asarray(vectors[ids])
+        if not len(vectors):
+            return [[] for _ in queries]
+        k = min(k, len(vectors))
+        results = []
+        for i in range(0, len(queries), _QUERY_BLOCK):
+            scores = queries[i: i + _QUERY_BLOCK] @ vectors.T
+            if ids is None:
+                scores[:, deleted] = -np.inf
+            _top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for _scores, _rows in zip(scores, _top):
+                _rows = _rows[np.argsort(-_scores[_rows])]
+                results.append([(int(_row if ids is None else ids[_row]), 1.0 - float(_scores[_row]))
+                                for _row in _rows if _scores[_row] > -np.inf])
+        return results
+
+    def _documents(self, hits: List[Tuple[int, float]]) -> List[Tuple[Document, float]]:
+        if not hits:
+            return []
+        with self._lock:
+            rows = {_id: (text, metadata) for _id, text, metadata in self._connection.execute(
+                f"SELECT id, text, metadata FROM chunks WHERE id IN ({','.join('?' * len(hits))})",
+                [_id for _id, _ in hits])}
+        # a vector row without a chunk row, from an insert that failed, is not a document
+        return [(Document(page_content=rows[_id][0], metadata=json.loads(rows[_id][1]) or {}), distance)
+                for _id, distance in hits if _id in rows]
+
+    @_metrics_.timed("vector_search", items=lambda _: 1)
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        """
+        Returns the k chunks closest to an embedding, with their cosine distance (1 - cosine similarity).
+        The search can be restricted with a metadata `filter`, see `_metadata.compile_filter`, to the rows
+        that existed at a `watermark`, see `watermark`, and can skip the ids in `exclude`.
+        """
+        return self._documents(self._top_k(np.asarray([embedding], dtype=np.float32), k,
+                                           nprobe=kwargs.get("nprobe"), filter=kwargs.get("filter"),
+                                           watermark=kwargs.get("watermark"), exclude=kwargs.get("exclude"))[0])
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search_by_vectors(self, embeddings: List[List[float]], k: int = 4, **kwargs: Any) -> List[List]:
+        """
+        Searches several already embedded queries at once with a single matrix product per block of queries.
+
+        Args:
+            embeddings: The query embeddings.
+            k: The number of documents to return per query. Defaults to 4.
+
+        Returns:
+            List: For each query embedding, in order, the k most similar documents.
+        """
+        return [[document for document, _ in hits]
+                for hits in self.similarity_search_with_score_by_vectors(embeddings, k=k, **kwargs)]
+
+    @_metrics_.timed("vector_search", items=len)
+    def similarity_search_with_score_by_vectors(self, embeddings: List[List[float]], k: int = 4,
+                                                **kwargs: Any) -> List[List[Tuple[Document, float]]]:
+        """
+        Like `similarity_search_by_vectors`, returning (document, cosine distance) pairs, closest first.
+        """
+        return [self._documents(hits)
+                for hits in self._top_k(np.asarray(embeddings, dtype=np.float32), k, nprobe=kwargs.get("nprobe"),
+                                        filter=kwargs.get("filter"), watermark=kwargs.get("watermark"),
+                                        exclude=kwargs.get("exclude"))]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            if self.index is not None:
+                self.index.save(f"{self.location}.ivf.npz")
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self._codes = np.zeros((0, 0), dtype=np.uint8)
+            self._connection.close()
+
+    @classmethod
+    def from_texts(cls: Type["NumpyFlatVectorStore"], texts: List[str], embedding: Embeddings,
+                   metadatas: Optional[List[dict]] = None, location: str = "vectors",
+                   **kwargs: Any) -> "NumpyFlatVectorStore":
+        store = cls(location=location, embedding=embedding)
+        store.add_texts(texts, metadatas=metadatas)
+        return store
+
+
+@_common_.exception_handler
+def get_vector_db(embedding, texts=None, location: str = "") -> NumpyFlatVectorStore:
+    """
+    Opens the configured memory-mapped NumPy vector store, creating it if needed.
+
+    The store files are created with the path prefix `vector_db_numpy_location`. Existing rows are kept;
+    if texts are given they are appended to the store. Setting `vector_db_ann: ivf` maintains an IVF index,
+    tuned with `ann_nlist`, `ann_nprobe` and `ann_min_train_size`, and `vector_db_quantization: int8` or `pq`
+    stores compressed codes searched with `quantization_oversample` candidates per result before re-scoring.
+
+    Args:
+        embedding: The embedding model used to embed texts and queries.
+        texts: An optional list of texts to be added to the store. Defaults to None.
+        location: The path prefix of the store files. Defaults to `vector_db_numpy_location`.
+
+    Returns:
+        NumpyFlatVectorStore: The vector store.
+
+    """
+    _config = _config_.PGConfigSingleton()
+    _location = os.path.expanduser(location or _config.config.get("vector_db_numpy_location"))
+    _util_directory_.create_directory(os.path.dirname(_location))
+
+    vector_db = NumpyFlatVectorStore(location=_location,
+                                     embedding=embedding,
+                                     ann=_config.config.get("vector_db_ann") or "",
+                                     nlist=int(_config.config.get("ann_nlist") or 1024),
+                                     nprobe=int(_config.config.get("ann_nprobe") or 16),
+                                     min_train_size=int(_config.config.get("ann_min_train_size") or 0),
+                                     quantization=_config.config.get("vector_db_quantization") or "",
+                                     pq_m=int(_config.config.get("pq_m") or 0),
+                                     oversample=int(_config.config.get("quantization_oversample") or 4))
+    if texts:
+        vector_db.add_texts(texts)
+    return vector_db
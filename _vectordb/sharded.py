@@ -0,0 +1,159 @@
+import heapq
+import zlib
+from itertools import islice
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Any, Iterable, Iterator, Tuple, Type
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores.base import VectorStore
+from _common import _metrics as _metrics_
+
+
+class ShardedVectorStore(VectorStore):
+    def __init__(self, shards: List[VectorStore], embedding: Embeddings, routing: str = "source",
+                 manifest_path: str = ""):
+        """
+        A collection whose chunks are spread over several vector stores, each in its own database file.
+
+        Inserts are routed to one shard per chunk, by the crc32 of the chunk's `source` metadata with
+        `routing="source"`, which keeps all chunks of a file together, or of the chunk text with
+        `routing="hash"`, which spreads them evenly. Every shard has its own write lock, so batches routed to
+        different shards are written in parallel. A search is sent to all shards in parallel threads, each
+        returns its own top k, and the results are merged with a heap into the global top k by distance.
+
+        Ids returned by `add_embeddings` are global: `shard_id * number_of_shards + shard`. The number of
+        shards of a collection must therefore not change once it holds chunks. The `watermark` of the
+        collection is the list of its shards' watermarks, and a search given one passes each shard its own;
+        the global ids a search is given as `exclude` are likewise passed to their shards.
+
+        Args:
+            shards: The shard stores, all supporting `add_embeddings`, `delete`,
+                `similarity_search_with_score_by_vector(s)` and `close`.
+            embedding: The embedding model used to embed texts and queries.
+            routing: "source" or "hash". Defaults to "source".
+            manifest_path: The ingestion manifest of the collection. Defaults to "", the default manifest.
+        """
+        if routing not in ("source", "hash"):
+            raise ValueError(f"shard routing {routing} not found, valid list is ['source', 'hash']")
+        self.shards = shards
+        self.routing = routing
+        self.manifest_path = manifest_path
+        self._embedding = embedding
+        self._executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="vector-shard")
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def shard_of(self, text: str, metadata: Optional[dict] = None) -> int:
+        _key = (metadata or {}).get("source") if self.routing == "source" else None
+        return zlib.crc32(str(_key if _key is not None else text).encode("utf-8")) % len(self.shards)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[int]:
+        texts = list(texts)
+        with _metrics_.span("embedding", items=len(texts)):
+            embeddings = self._embedding.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas)
+
+    def add_embeddings(self, texts: List[str], embeddings: List[List[float]],
+                       metadatas: Optional[List[dict]] = None) -> List[int]:
+        """
+        Routes already embedded texts to their shards and inserts them, one batch per shard in parallel.
+
+        Returns:
+            List[int]: The global ids of the inserted texts, in order.
+        """
+        metadatas = metadatas or [{} for _ in texts]
+        _positions = [[] for _ in self.shards]
+        for i, (text, metadata) in enumerate(zip(texts, metadatas)):
+            _positions[self.shard_of(text, metadata)].append(i)
+
+        def _insert(shard: int) -> List[int]:
+            _batch = _positions[shard]
+            return self.shards[shard].add_embeddings([texts[i] for i in _batch], [embeddings[i] for i in _batch],
+                                                     [metadatas[i] for i in _batch]) if _batch else []
+
+        ids = [0] * len(texts)
+        for shard, _ids in enumerate(self._executor.map(_insert, range(len(self.shards)))):
+            for i, _id in zip(_positions[shard], _ids):
+                ids[i] = _id * len(self.shards) + shard
+        return ids
+
+    def delete(self, ids: Optional[List[int]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        _ids = [[] for _ in self.shards]
+        for _id in ids:
+            _ids[_id % len(self.shards)].append(_id // len(self.shards))
+        for shard, shard_ids in enumerate(_ids):
+            if shard_ids:
+                self.shards[shard].delete(shard_ids)
+        return True
+
+    def watermark(self) -> List[int]:
+        return [shard.watermark() for shard in self.shards]
+
+    @contextmanager
+    def hold_readers(self) -> Iterator[None]:
+        with ExitStack() as stack:
+            for shard in self.shards:
+                if hasattr(shard, "hold_readers"):
+                    stack.enter_context(shard.hold_readers())
+            yield
+
+    def similarity_search_with_score_by_vectors(self, embeddings: List[List[float]], k: int = 4,
+                                                **kwargs: Any) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches all shards in parallel for several already embedded queries and merges their results.
+
+        Args:
+            embeddings: The query embeddings.
+            k: The number of documents to return per query. Defaults to 4.
+
+        Returns:
+            List: For each query embedding, in order, the k (document, distance) pairs closest over all
+            shards, closest first.
+        """
+        _watermarks = kwargs.pop("watermark", None) or [None] * len(self.shards)
+        _excludes = [set() for _ in self.shards]
+        for _id in kwargs.pop("exclude", None) or ():
+            _excludes[_id % len(self.shards)].add(_id // len(self.shards))
+        _shard_results = list(self._executor.map(
+            lambda shard, watermark, exclude: shard.similarity_search_with_score_by_vectors(
+                embeddings, k=k, watermark=watermark, exclude=exclude, **kwargs),
+            self.shards, _watermarks, _excludes))
+        # every shard's hits are put closest first, which the merge relies on
+        return [list(islice(heapq.merge(*[sorted(_results[i], key=lambda hit: hit[1]) for _results in _shard_results],
+                                        key=lambda hit: hit[1]), k))
+                for i in range(len(embeddings))]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vectors([embedding], k=k, **kwargs)[0]
+
+    def similarity_search_by_vectors(self, embeddings: List[List[float]], k: int = 4, **kwargs: Any) -> List[List]:
+        return [[document for document, _ in hits]
+                for hits in self.similarity_search_with_score_by_vectors(embeddings, k=k, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+        self._executor.shutdown(wait=False)
+
+    @classmethod
+    def from_texts(cls: Type["ShardedVectorStore"], texts: List[str], embedding: Embeddings,
+                   metadatas: Optional[List[dict]] = None, shards: List[VectorStore] = None,
+                   **kwargs: Any) -> "ShardedVectorStore":
+        store = cls(shards=shards, embedding=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas)
+        return store
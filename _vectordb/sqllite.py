@@ -1,18 +1,386 @@
 import os
+import json
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from urllib.parse import quote
+from typing import List, Optional, Any, ContextManager, Iterable, Iterator, Tuple
+import numpy as np
+from langchain.schema import Document
 from langchain.vectorstores import SQLiteVSS
 from _config import _config as _config_
 from _common import _common as _common_
+from _common import _metrics as _metrics_
 from _util import _util_directory as _util_directory_
+from _vectordb import _metadata as _metadata_
+
+
+class _ReaderPool:
+    def __init__(self, db_file: str, size: int):
+        """
+        A pool of read-only connections, so searches run concurrently with each other and with a writer.
+
+        The vss0 virtual table keeps its index in memory per connection, so an idle connection is reopened
+        when `PRAGMA data_version` shows that another connection committed since it was last used, which
+        means reloading sqlite-vss and the vss0 index. While the pool is held (see `hold`), commits do not
+        make connections stale: every connection is reopened once when the hold starts and once when it
+        ends, not after every batch a long ingest commits.
+
+        Args:
+            db_file: The database file.
+            size: The maximum number of open read-only connections.
+        """
+        self.db_file = db_file
+        self._idle = queue.LifoQueue()
+        self._available = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._generation, self._holds = 0, 0
+
+    @staticmethod
+    def _data_version(connection: sqlite3.Connection) -> int:
+        return connection.execute("PRAGMA data_version").fetchone()[0]
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        """
+        Keeps idle connections in use across commits, for writes that searches do not need to see until the
+        hold ends, like those of an ingest job whose searches are restricted to a watermark.
+        """
+        with self._lock:
+            self._holds += 1
+            self._generation += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._holds -= 1
+                self._generation += 1
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with self._available:
+            try:
+                connection, version, generation = self._idle.get_nowait()
+                if generation != self._generation or (not self._holds and self._data_version(connection) != version):
+                    connection.close()
+                    connection = PGSQLiteVSS.create_connection(self.db_file, read_only=True)
+            except queue.Empty:
+                connection = PGSQLiteVSS.create_connection(self.db_file, read_only=True)
+            version, generation = self._data_version(connection), self._generation
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self._idle.put((connection, version, generation))
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait()[0].close()
+            except queue.Empty:
+                return
+
+
+class PGSQLiteVSS(SQLiteVSS):
+    """
+    SQLiteVSS with support for deleting rows, so ingestion can replace the chunks of a changed file in place.
+
+    The database runs in WAL mode. Writes are serialized by a lock on the write connection, each batch in a
+    single transaction, while embedding happens outside of it so a long ingest does not hold up queries
+    while the model is encoding. With `readers` set, searches run on a pool of read-only connections and
+    see the last committed batch without waiting for the writer, or, while they are held with
+    `hold_readers`, the rows committed before the hold started.
+
+    Metadata values are indexed in `<table>_metadata`. A search given a `filter` (see
+    `_metadata.compile_filter`) that matches at most `filter_scan_fraction` of the rows selects them through
+    that index and ranks only those by exact squared L2 distance, the metric vss0 reports. A broader filter
+    searches the vss0 index instead and keeps the matching candidates, fetching more of them in rounds
+    until k match.
+
+    Row ids only grow, so a search given a `watermark` (see `watermark`) only returns rows that existed when
+    it was taken; vss0 cannot pre-filter, so the rows added since are dropped from its candidates and more
+    candidates are fetched in rounds, like for a broad filter. Rows about to be deleted are hidden from a
+    search by passing their ids as `exclude`.
+    """
+
+    def __init__(self, *args: Any, readers: int = 0, filter_scan_fraction: float = 0.05, **kwargs: Any):
+        self._lock = threading.RLock()
+        self._filter_scan_fraction = filter_scan_fraction
+        super().__init__(*args, **kwargs)
+        _db_file = kwargs.get("db_file", "")
+        self.manifest_path = f"{_db_file}.manifest.json" if _db_file not in ("", ":memory:") else ""
+        self._readers = _ReaderPool(_db_file, readers) if readers > 0 and _db_file not in ("", ":memory:") else None
+
+    @staticmethod
+    def create_connection(db_file: str, read_only: bool = False) -> sqlite3.Connection:
+        """
+        Opens a connection with the sqlite-vss extension and the pragmas of the config file.
+
+        The write connection switches the database to WAL mode, so readers are not blocked by a write
+        transaction, with `vector_db_sqlite_synchronous` durability. Every connection gets a page cache of
+        `vector_db_sqlite_cache_size` (negative values are KiB) and memory-maps up to
+        `vector_db_sqlite_mmap_size` bytes of the file.
+
+        Args:
+            db_file: The database file.
+            read_only: Whether to open the file read-only. Defaults to False.
+
+        Returns:
+            sqlite3.Connection: The connection.
+        """
+        import sqlite_vss
+
+        _config = _config_.PGConfigSingleton()
+        if read_only:
+            connection = sqlite3.connect(f"file:{quote(os.path.abspath(db_file))}?mode=ro", uri=True,
+                                         check_same_thread=False)
+        else:
+            connection = sqlite3.connect(db_file, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={_config.config.get('vector_db_sqlite_synchronous') or 'NORMAL'}")
+        connection.execute(f"PRAGMA cache_size={int(_config.config.get('vector_db_sqlite_cache_size') or -2000)}")
+        connection.execute(f"PRAGMA mmap_size={int(_config.config.get('vector_db_sqlite_mmap_size') or 0)}")
+        connection.row_factory = sqlite3.Row
+        connection.enable_load_extension(True)
+        sqlite_vss.load(connection)
+        connection.enable_load_extension(False)
+        return connection
+
+    def create_table_if_not_exists(self) -> None:
+        super().create_table_if_not_exists()
+        _metadata_.create_index(self._connection, f"{self._table}_metadata", self._table, id_column="rowid")
+
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        if self._readers is None:
+            with self._lock:
+                yield self._connection
+        else:
+            with self._readers.connection() as connection:
+                yield connection
+
+    def hold_readers(self) -> ContextManager[None]:
+        """
+        Keeps the read-only connections of searches from being reopened after every commit until the
+        returned context exits, see `_ReaderPool.hold`.
+        """
+        return self._readers.hold() if self._readers is not None else nullcontext()
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[int]:
+        texts = list(texts)
+        with _metrics_.span("embedding", items=len(texts)):
+            embeddings = self._embedding.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas)
+
+    @_metrics_.timed("vector_insert", items=len)
+    def add_embeddings(self, texts: List[str], embeddings: List[List[float]],
+                       metadatas: Optional[List[dict]] = None) -> List[int]:
+        """
+        Inserts already embedded texts.
+
+        Args:
+            texts: The texts to be inserted.
+            embeddings: The embedding of each text.
+            metadatas: The optional metadata of each text. Defaults to None.
+
+        Returns:
+            List[int]: The row ids of the inserted texts, in order.
+        """
+        metadatas = metadatas or [{} for _ in texts]
+        _rows = [(text, json.dumps(metadata), json.dumps(embedding))
+                 for text, metadata, embedding in zip(texts, metadatas, embeddings)]
+        # one write transaction per batch: the rows, their vss0 index entries added by the trigger and the
+        # row id lookup are committed together, with a single WAL sync
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            max_id = self._connection.execute(f"SELECT max(rowid) AS rowid FROM {self._table}").fetchone()["rowid"]
+            self._connection.executemany(
+                f"INSERT INTO {self._table}(text, metadata, text_embedding) VALUES (?,?,?)", _rows)
+            _ids = [row["rowid"] for row in self._connection.execute(
+                f"SELECT rowid FROM {self._table} WHERE rowid > ? ORDER BY rowid", (max_id or 0,))]
+            self._connection.executemany(f"INSERT INTO {self._table}_metadata (id, key, value) VALUES (?, ?, ?)",
+                                         _metadata_.index_rows(_ids, metadatas))
+            return _ids
+
+    def watermark(self) -> int:
+        """
+        Returns the highest row id in the table, 0 if it is empty. Searches given it as `watermark` ignore
+        every row inserted after it was taken.
+        """
+        with self._read() as connection:
+            return connection.execute(f"SELECT coalesce(max(rowid), 0) FROM {self._table}").fetchone()[0]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List:
+        return self.similarity_search_with_score_by_vectors([embedding], k=k, **kwargs)[0]
+
+    # the SQLiteVSS versions drop their keyword arguments, which carry the search filter
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def delete(self, ids: Optional[List[int]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        _placeholders = ",".join("?" * len(ids))
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute(f"DELETE FROM {self._table} WHERE rowid IN ({_placeholders})", list(ids))
+            self._connection.execute(f"DELETE FROM vss_{self._table} WHERE rowid IN ({_placeholders})", list(ids))
+            self._connection.execute(f"DELETE FROM {self._table}_metadata WHERE id IN ({_placeholders})", list(ids))
+        return True
+
+    def similarity_search_by_vectors(self, embeddings: List[List[float]], k: int = 4, **kwargs: Any) -> List[List]:
+        """
+        Runs the similarity search for several already embedded queries on a single cursor, reusing
+        one prepared statement for all of them.
+
+        Args:
+            embeddings: The query embeddings.
+            k: The number of documents to return per query. Defaults to 4.
+
+        Returns:
+            List: For each query embedding, in order, the k most similar documents.
+        """
+        return [[document for document, _ in hits]
+                for hits in self.similarity_search_with_score_by_vectors(embeddings, k=k, **kwargs)]
+
+    @_metrics_.timed("vector_search", items=len)
+    def similarity_search_with_score_by_vectors(self, embeddings: List[List[float]], k: int = 4,
+                                                **kwargs: Any) -> List[List]:
+        """
+        Like `similarity_search_by_vectors`, returning (document, distance) pairs, closest first.
+        The search can be restricted with a metadata `filter`, see `_metadata.compile_filter`, to the rows
+        that existed at a `watermark`, see `watermark`, and can skip the row ids in `exclude`.
+        """
+        watermark, exclude = kwargs.get("watermark"), kwargs.get("exclude")
+        if kwargs.get("filter"):
+            return self._filtered_search(embeddings, k, kwargs["filter"], watermark, exclude)
+        results = []
+        with self._read() as connection:
+            cursor = connection.cursor()
+            if watermark is not None or exclude:
+                _rows = connection.execute(f"SELECT coalesce(max(rowid), 0) FROM {self._table}").fetchone()[0]
+                _conditions, _params = self._visible(watermark if watermark is not None and _rows > watermark
+                                                     else None, exclude)
+                if _conditions:
+                    return [self._vss_search(cursor, embedding, k, " AND ".join(_conditions), _params, _rows)
+                            for embedding in embeddings]
+            for embedding in embeddings:
+                cursor.execute(
+                    f"SELECT text, metadata, distance FROM {self._table} e "
+                    f"INNER JOIN vss_{self._table} v ON v.rowid = e.rowid "
+                    f"WHERE vss_search(v.text_embedding, vss_search_params(?, ?)) "
+                    f"ORDER BY distance LIMIT ?",
+                    (json.dumps(embedding), k, k)
+                )
+                results.append([(Document(page_content=row["text"], metadata=json.loads(row["metadata"]) or {}),
+                                 row["distance"]) for row in cursor.fetchall()])
+        return results
+
+    @staticmethod
+    def _visible(watermark: Optional[int], exclude: Optional[Iterable[int]]) -> Tuple[List[str], List]:
+        # the conditions keeping a search to the rows that existed at the watermark and are not excluded
+        _conditions, _params = [], []
+        if watermark is not None:
+            _conditions.append("e.rowid <= ?")
+            _params.append(watermark)
+        if exclude:
+            _conditions.append("e.rowid NOT IN (SELECT value FROM json_each(?))")
+            _params.append(json.dumps(sorted(exclude)))
+        return _conditions, _params
+
+    def _filtered_search(self, embeddings: List[List[float]], k: int, filter: dict, watermark: Optional[int] = None,
+                         exclude: Optional[Iterable[int]] = None) -> List[List[Tuple[Document, float]]]:
+        _condition, _params = _metadata_.compile_filter(filter, f"{self._table}_metadata", id_column="e.rowid")
+        _conditions, _visible_params = self._visible(watermark, exclude)
+        _condition, _params = " AND ".join([*_conditions, _condition]), [*_visible_params, *_params]
+        with self._read() as connection:
+            _rows = connection.execute(f"SELECT coalesce(max(rowid), 0) FROM {self._table}").fetchone()[0]
+            _limit = int(_rows * self._filter_scan_fraction)
+            # counting stops past the limit, so a broad filter is not counted in full
+            if connection.execute(f"SELECT count(*) FROM (SELECT 1 FROM {self._table} e WHERE {_condition} LIMIT ?)",
+                                  [*_params, _limit + 1]).fetchone()[0] > _limit:
+                cursor = connection.cursor()
+                return [self._vss_search(cursor, embedding, k, _condition, _params, _rows) for embedding in embeddings]
+            rows = connection.execute(f"SELECT text, metadata, text_embedding FROM {self._table} e "
+                                      f"WHERE {_condition}", _params).fetchall()
+        if not rows:
+            return [[] for _ in embeddings]
+        vectors = np.asarray([json.loads(row["text_embedding"]) for row in rows], dtype=np.float32)
+        queries = np.asarray(embeddings, dtype=np.float32)
+        distances = (queries ** 2).sum(axis=1, keepdims=True) - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)
+        k = min(k, len(rows))
+        results = []
+        for _distances in distances:
+            _top = np.argpartition(_distances, k - 1)[:k]
+            results.append([(Document(page_content=rows[i]["text"], metadata=json.loads(rows[i]["metadata"]) or {}),
+                             float(_distances[i])) for i in _top[np.argsort(_distances[_top])]])
+        return results
+
+    def _vss_search(self, cursor: sqlite3.Cursor, embedding: List[float], k: int, condition: str, params: List,
+                    rows: int) -> List[Tuple[Document, float]]:
+        # vss0 cannot pre-filter: it returns the `fetch` nearest rows and the condition is applied to those, so
+        # while fewer than k of them pass, the search is repeated with four times as many, up to every row
+        fetch = 4 * k
+        while True:
+            cursor.execute(
+                f"SELECT text, metadata, distance FROM {self._table} e "
+                f"INNER JOIN vss_{self._table} v ON v.rowid = e.rowid "
+                f"WHERE vss_search(v.text_embedding, vss_search_params(?, ?)) AND {condition} "
+                f"ORDER BY distance LIMIT ?",
+                (json.dumps(embedding), fetch, *params, k)
+            )
+            hits = cursor.fetchall()
+            if len(hits) >= k or fetch >= rows:
+                return [(Document(page_content=row["text"], metadata=json.loads(row["metadata"]) or {}),
+                         row["distance"]) for row in hits]
+            fetch *= 4
+
+    def close(self) -> None:
+        if self._readers is not None:
+            self._readers.close()
+        with self._lock:
+            self._connection.close()
 
 
 @_common_.exception_handler
-def get_vector_db(embedding, texts=None) -> SQLiteVSS:
+def get_vector_db(embedding, texts=None, location: str = "") -> PGSQLiteVSS:
+    """
+    Opens the configured SQLite vector database, creating its tables if needed.
+
+    The database is opened at `vector_db_default_location` using the table `vector_db_default_table`.
+    Existing rows are kept; if texts are given they are appended to the table. Searches use a pool of up to
+    `vector_db_sqlite_readers` read-only connections, 0 to search on the write connection. Filtered searches
+    rank the matching rows exactly if they are at most `vector_db_sqlite_filter_scan_fraction` of the table.
+
+    Args:
+        embedding: The embedding model used to embed texts and queries.
+        texts: An optional list of texts to be added to the database. Defaults to None.
+        location: The database file. Defaults to `vector_db_default_location`.
+
+    Returns:
+        PGSQLiteVSS: The vector database.
+
+    """
     _config = _config_.PGConfigSingleton()
-    _util_directory_.create_directory(os.path.dirname(_config.config.get("vector_db_default_location")))
-
-    return SQLiteVSS.from_texts(
-        texts=texts,
-        embedding=embedding,
-        table=_config.config.get("vector_db_default_table"),
-        db_file=_config.config.get("vector_db_default_location")
-)
+    _location = location or _config.config.get("vector_db_default_location")
+    _util_directory_.create_directory(os.path.dirname(_location))
+
+    vector_db = PGSQLiteVSS(table=_config.config.get("vector_db_default_table"),
+                            connection=PGSQLiteVSS.create_connection(_location),
+                            embedding=embedding,
+                            db_file=_location,
+                            readers=int(_config.config.get("vector_db_sqlite_readers") or 0),
+                            filter_scan_fraction=float(_config.config.get("vector_db_sqlite_filter_scan_fraction")
+                                                       or 0.05))
+    if texts:
+        vector_db.add_texts(texts)
+    return vector_db
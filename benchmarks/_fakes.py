@@ -0,0 +1,84 @@
+import math
+import time
+import zlib
+import contextlib
+from typing import List, Optional, Any, Iterator
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+from _config import _config as _config_
+from _embedding import gpt4all_embedding
+from _llm import langchain
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic stand-in for the MiniLM embedding model.
+
+    Every word is hashed to a signed unit in one of `size` dimensions (feature hashing), so texts sharing
+    words get similar vectors and the same text always gets the same vector, at a tiny fraction of the
+    cost of the real model.
+    """
+
+    def __init__(self, size: int = 384):
+        self.size = size
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * self.size
+        for word in text.lower().split():
+            _hash = zlib.crc32(word.encode("utf-8"))
+            vector[_hash % self.size] += 1.0 if _hash & 0x80000000 else -1.0
+        _norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / _norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class FakeLLM(LLM):
+    """
+    Deterministic stand-in for the GPT4All model, streaming a fixed answer token by token.
+    """
+    answer: str = "This is a synthetic answer produced by the benchmark language model."
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        for token in self.answer.split(" "):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            if run_manager:
+                run_manager.on_llm_new_token(f"{token} ")
+        return self.answer
+
+
+@contextlib.contextmanager
+def patched(workdir: str, backend: str = "numpy", token_delay: float = 0.0) -> Iterator[None]:
+    """
+    Swaps the embedding model and the language model for the fakes and points the vector database,
+    manifest and caches at a scratch directory, restoring everything on exit.
+
+    Args:
+        workdir: The scratch directory for the vector database and manifest.
+        backend: The vector database backend to benchmark. Defaults to "numpy".
+        token_delay: The seconds the fake language model sleeps per token. Defaults to 0.
+
+    """
+    _config = _config_.PGConfigSingleton()
+    _saved_config = dict(_config.config)
+    _saved_embedding, _saved_llm = gpt4all_embedding.gpt4all_embedding, langchain.gpt4all_llm
+    _config.config.update({"vector_db_backend": backend,
+                           "vector_db_default_location": f"{workdir}/vss.db",
+                           "vector_db_numpy_location": f"{workdir}/flat",
+                           "embedding_cache_location": "",
+                           "answer_cache_enabled": False})
+    gpt4all_embedding.gpt4all_embedding = lambda cache=True: FakeEmbeddings()
+    langchain.gpt4all_llm = lambda: FakeLLM(token_delay=token_delay)
+    try:
+        yield
+    finally:
+        gpt4all_embedding.gpt4all_embedding, langchain.gpt4all_llm = _saved_embedding, _saved_llm
+        _config.config.clear()
+        _config.config.update(_saved_config)
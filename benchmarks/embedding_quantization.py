@@ -0,0 +1,27 @@
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run_benchmarks import synthetic_corpus
+from _data import _data_load
+from _embedding import _quantized as _quantized_
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reports the cosine agreement and speed of the int8 quantized "
+                                                 "embedding model against the fp32 model.")
+    parser.add_argument("--filepath", default="", help="document sampled for chunks, a synthetic one if not set")
+    parser.add_argument("--sample", type=int, default=512, help="number of chunks compared")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the sample")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        filepath = args.filepath or synthetic_corpus(workdir, 1, 1024, args.seed)[0]
+        chunks = _data_load.load_document(filepath)
+    texts = random.Random(args.seed).sample(chunks, min(args.sample, len(chunks)))
+    print(json.dumps(_quantized_.check_quantization(texts), indent=2))
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from typing import List, Dict
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that take seconds to import and must only be loaded once a model or a CSV file is actually needed
+HEAVY_MODULES = ("torch", "transformers", "sentence_transformers", "langchain", "langchain_core",
+                 "langchain_community", "pandas", "gpt4all")
+
+MODULES = ("_config._config", "_vectordb._vectordb", "_vectordb._manifest", "_task.question_answering",
+           "_server._server")
+
+_PROBE = """
+import sys, json, time
+_started = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - _started,
+                  "heavy": sorted(name for name in {heavy!r} if name in sys.modules)}}))
+"""
+
+
+def _measure_module(module: str, repeat: int) -> Dict:
+    runs = [json.loads(subprocess.run([sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                      capture_output=True, text=True, cwd=_ROOT, check=True).stdout)
+            for _ in range(repeat)]
+    return {"target": f"import {module}", "seconds": min(run["seconds"] for run in runs), "heavy": runs[0]["heavy"]}
+
+
+def _measure_command(args: List[str], repeat: int) -> Dict:
+    _seconds = []
+    for _ in range(repeat):
+        _started = time.perf_counter()
+        subprocess.run([sys.executable] + args, capture_output=True, cwd=_ROOT, check=True)
+        _seconds.append(time.perf_counter() - _started)
+    return {"target": " ".join(["python"] + args), "seconds": min(_seconds), "heavy": []}
+
+
+def check(budget: float = 1.0, repeat: int = 3) -> Dict:
+    """
+    Measures the import time of the lightweight entry points, each in a fresh interpreter.
+
+    Args:
+        budget: The maximum seconds any entry point may take. Defaults to 1.0.
+        repeat: The number of runs per entry point, of which the fastest is kept. Defaults to 3.
+
+    Returns:
+        Dict: The measurement of every entry point, the budget, and whether all of them are within the budget
+        and load none of the heavy modules.
+    """
+    results = [_measure_module(module, repeat) for module in MODULES]
+    results.append(_measure_command(["main.py", "--help"], repeat))
+    for result in results:
+        result["ok"] = result["seconds"] <= budget and not result["heavy"]
+    return {"budget_seconds": budget, "ok": all(result["ok"] for result in results), "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that the CLI and the config-only import paths start "
+                                                 "within a time budget without loading torch, langchain or pandas.")
+    parser.add_argument("--budget", type=float, default=1.0, help="maximum seconds per entry point")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per entry point, the fastest is kept")
+    args = parser.parse_args()
+
+    report = check(args.budget, args.repeat)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["ok"] else 1)
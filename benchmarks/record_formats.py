@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _util import _util_file as _util_file_
+
+_NUMBERS = ["0", "-0", "7", "-12", "1.25", "-0.5", "3e5", "2.5E-3", "1e+10", "123456789.987654321"]
+
+
+def _random_value(rng: random.Random, depth: int = 0):
+    _kind = rng.random()
+    if _kind < 0.4 or depth > 2:
+        return json.loads(rng.choice(_NUMBERS))
+    if _kind < 0.6:
+        return rng.choice(["", "a b", "x" * rng.randint(1, 20), "quote \" and ] and , inside", "é中"])
+    if _kind < 0.7:
+        return rng.choice([True, False, None])
+    if _kind < 0.85:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {f"k{i}": _random_value(rng, depth + 1) for i in range(rng.randint(0, 4))}
+
+
+def json_array(cases: int, max_block_size: int, seed: int = 0) -> dict:
+    """
+    Compares `_util_file.iter_json_array` with `json.load` on random arrays read in tiny blocks, so values
+    are cut at every position, including inside numbers like `1.` | `25`.
+
+    Returns:
+        dict: The number of cases and mismatches, and the first mismatching case if any.
+    """
+    rng, mismatches, example = random.Random(seed), 0, None
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "records.json")
+        for _ in range(cases):
+            values = [_random_value(rng) for _ in range(rng.randint(0, 12))]
+            with open(filepath, "w", encoding="utf-8") as file:
+                json.dump(values, file, ensure_ascii=False, indent=rng.choice([None, 1]))
+            for block_size in range(1, max_block_size + 1):
+                try:
+                    records = [record for batch in _util_file_.iter_json_array(filepath, batch_size=3,
+                                                                                block_size=block_size)
+                               for record in batch]
+                except ValueError as err:
+                    records = repr(err)
+                if records != values:
+                    mismatches += 1
+                    example = example or {"values": values, "block_size": block_size, "records": records}
+    return {"cases": cases, "mismatches": mismatches, "example": example}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that JSON array corpora are streamed record by record "
+                                                 "exactly as json.load reads them, whatever the block size.")
+    parser.add_argument("--cases", type=int, default=300, help="number of random arrays")
+    parser.add_argument("--max-block-size", type=int, default=16, help="largest block size tried, from 1 up")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    report = {"json_array": json_array(args.cases, args.max_block_size, args.seed)}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(0 if not report["json_array"]["mismatches"] else 1)
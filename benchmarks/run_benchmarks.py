@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+import platform
+import tempfile
+import subprocess
+from typing import List, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from benchmarks import _fakes
+from _common import _metrics as _metrics_
+from _data import _data_load
+from _task.rag_engine import RagEngine
+
+
+def synthetic_corpus(dirpath: str, documents: int, document_kb: int, seed: int = 0) -> List[str]:
+    """
+    Writes a reproducible corpus of plain-text documents made of random words, sentences and paragraphs.
+
+    Args:
+        dirpath: The directory the documents are written to.
+        documents: The number of documents.
+        document_kb: The approximate size of each document in KB.
+        seed: The random seed. Defaults to 0.
+
+    Returns:
+        List[str]: The paths of the written documents.
+    """
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10)))
+                  for _ in range(5000)]
+    filepaths = []
+    for i in range(documents):
+        paragraphs, _size = [], 0
+        while _size < document_kb * 1024:
+            paragraph = " ".join(" ".join(rng.choices(vocabulary, k=rng.randint(5, 25))).capitalize() + "."
+                                 for _ in range(rng.randint(2, 8)))
+            paragraphs.append(paragraph)
+            _size += len(paragraph) + 2
+        filepath = os.path.join(dirpath, f"document_{i:05d}.txt")
+        with open(filepath, "w", encoding="utf-8") as file:
+            file.write("\n\n".join(paragraphs))
+        filepaths.append(filepath)
+    return filepaths
+
+
+def _percentiles(latencies: List[float]) -> Dict[str, float]:
+    return {"p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "mean_ms": float(np.mean(latencies))}
+
+
+def _timed(func, *args) -> float:
+    _started = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - _started) * 1000
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(documents: int = 20, document_kb: int = 64, queries: int = 200, backend: str = "numpy",
+        batch_size: int = 256, token_delay: float = 0.0, seed: int = 0) -> Dict:
+    """
+    Runs the benchmark suite against the fake embedding model and language model.
+
+    Args:
+        documents: The number of synthetic documents. Defaults to 20.
+        document_kb: The approximate size of each document in KB. Defaults to 64.
+        queries: The number of queries timed for retrieval and end-to-end answering. Defaults to 200.
+        backend: The vector database backend, "numpy" or "sqlite". Defaults to "numpy".
+        batch_size: The number of chunks per insert. Defaults to 256.
+        token_delay: The seconds the fake language model sleeps per token. Defaults to 0.
+        seed: The random seed of the corpus and queries. Defaults to 0.
+
+    Returns:
+        Dict: The parameters and the results of every stage.
+    """
+    report = {"parameters": {"documents": documents, "document_kb": document_kb, "queries": queries,
+                             "backend": backend, "batch_size": batch_size, "token_delay": token_delay,
+                             "seed": seed},
+              "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                              "revision": _git_revision(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")}}
+    _metrics_.enable()
+    _metrics_.reset()
+    with tempfile.TemporaryDirectory() as workdir, _fakes.patched(workdir, backend, token_delay):
+        corpus = os.path.join(workdir, "corpus")
+        os.makedirs(corpus)
+        filepaths = synthetic_corpus(corpus, documents, document_kb, seed)
+
+        _started = time.perf_counter()
+        chunks = [(filepath, chunk) for filepath in filepaths for chunk in _data_load.load_document(filepath)]
+        _elapsed = time.perf_counter() - _started
+        report["load_document"] = {"chunks": len(chunks),
+                                   "megabytes": sum(os.path.getsize(_f) for _f in filepaths) / (1 << 20),
+                                   "seconds": _elapsed,
+                                   "chunks_per_sec": len(chunks) / _elapsed}
+
+        with RagEngine() as engine:
+            vectors = engine.embedding.embed_documents([chunk for _, chunk in chunks])
+            _started = time.perf_counter()
+            for i in range(0, len(chunks), batch_size):
+                engine.vector_db.add_embeddings([chunk for _, chunk in chunks[i: i + batch_size]],
+                                                vectors[i: i + batch_size],
+                                                [{"source": filepath} for filepath, _ in chunks[i: i + batch_size]])
+            _elapsed = time.perf_counter() - _started
+            report["insert"] = {"chunks": len(chunks), "seconds": _elapsed, "chunks_per_sec": len(chunks) / _elapsed}
+
+            rng = random.Random(seed + 1)
+            _queries = [" ".join(rng.choice(chunks)[1].split()[:8]) + "?" for _ in range(queries)]
+            report["retrieval"] = _percentiles([_timed(engine.retrieve, query) for query in _queries])
+            _generation = _percentiles([_timed(engine.generate, query, []) for query in _queries])
+            _end_to_end = _percentiles([_timed(engine.ask, query) for query in _queries])
+            report["end_to_end"] = dict(_end_to_end, overhead_p50_ms=_end_to_end["p50_ms"] - _generation["p50_ms"])
+    report["stages"] = {stage: {_key: _value for _key, _value in metrics.items() if _key != "buckets"}
+                        for stage, metrics in _metrics_.snapshot().items()}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmarks of the RAG pipeline "
+                                                 "with a deterministic fake embedding model and language model.")
+    parser.add_argument("--documents", type=int, default=20, help="number of synthetic documents")
+    parser.add_argument("--document-kb", type=int, default=64, help="approximate size of each document in KB")
+    parser.add_argument("--queries", type=int, default=200, help="number of timed queries")
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "sqlite"], help="vector database backend")
+    parser.add_argument("--batch-size", type=int, default=256, help="number of chunks per insert")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds the fake model sleeps per token")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the corpus and queries")
+    parser.add_argument("--output", default="", help="file the JSON report is written to, stdout if not set")
+    args = parser.parse_args()
+
+    # progress messages go to stderr so that stdout only carries the report
+    with contextlib.redirect_stdout(sys.stderr):
+        result = json.dumps(run(args.documents, args.document_kb, args.queries, args.backend, args.batch_size,
+                                args.token_delay, args.seed), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as _file:
+            _file.write(result + "\n")
+    else:
+        print(result)
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from _data import _data_split as _data_split_
+
+_PIECES = ["a", "bb", "ccc", " ", "\n", "\n\n", "  ", "\t", " \n", "\n \n"]
+
+
+def _random_text(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(_PIECES) if rng.random() < 0.7 else "x" * rng.randint(1, 80) for _ in range(length))
+
+
+def _corpus_text(rng: random.Random, words: int, paragraph: float, line: float) -> str:
+    return " ".join(f"w{rng.randint(0, 9999)}" + ("\n\n" if rng.random() < paragraph else
+                                                 "\n" if rng.random() < line else "") for _ in range(words))
+
+
+def equivalence(cases: int, seed: int = 0) -> dict:
+    """
+    Compares `_data_split.split_text` with RecursiveCharacterTextSplitter on random texts and settings.
+
+    Returns:
+        dict: The number of cases and mismatches, and the first mismatching case if any.
+    """
+    rng, mismatches, example = random.Random(seed), 0, None
+    for _ in range(cases):
+        text = _random_text(rng, rng.randint(0, 600))
+        chunk_size = rng.randint(5, 200)
+        chunk_overlap = rng.randint(0, chunk_size)
+        if RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text) \
+                != _data_split_.split_text(text, chunk_size, chunk_overlap):
+            mismatches += 1
+            example = example or {"text": text, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+    return {"cases": cases, "mismatches": mismatches, "example": example}
+
+
+def throughput(words: int, seed: int = 0) -> list:
+    """
+    Measures the splitting throughput of both splitters on texts of different structure.
+
+    Returns:
+        list: For each text shape, its size, whether both splitters agree, and the MB/s of both.
+    """
+    rng, report = random.Random(seed), []
+    for shape, paragraph, line in (("paragraphs", 0.02, 0.05), ("long paragraphs", 0.002, 0.0),
+                                   ("lines", 0.0, 0.03), ("no breaks", 0.0, 0.0)):
+        text = _corpus_text(rng, words, paragraph, line)
+        _started = time.perf_counter()
+        expected = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=80).split_text(text)
+        _langchain = time.perf_counter() - _started
+        _started = time.perf_counter()
+        chunks = _data_split_.split_text(text, 1000, 80)
+        _offsets = time.perf_counter() - _started
+        report.append({"text": shape, "megabytes": len(text) / (1 << 20), "chunks": len(chunks),
+                       "equal": chunks == expected,
+                       "langchain_mb_per_sec": len(text) / (1 << 20) / _langchain,
+                       "offsets_mb_per_sec": len(text) / (1 << 20) / _offsets})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that the in-repo splitter produces the same chunks as "
+                                                 "RecursiveCharacterTextSplitter and compares their throughput.")
+    parser.add_argument("--cases", type=int, default=2000, help="number of random equivalence cases")
+    parser.add_argument("--words", type=int, default=400000, help="number of words of the throughput texts")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    # RecursiveCharacterTextSplitter warns about every chunk longer than chunk_size
+    logging.disable(logging.WARNING)
+    report = {"equivalence": equivalence(args.cases, args.seed), "throughput": throughput(args.words, args.seed)}
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if not report["equivalence"]["mismatches"] and all(_r["equal"] for _r in report["throughput"]) else 1)
@@ -1,3 +1,4 @@
+import argparse
 from _task import question_answering as qa
 
 
@@ -6,5 +7,17 @@ def main(query: str, filepath: str) -> str:
 
 
 if __name__ == "__main__":
-    main(query="what is Question-answering (Q&A)?", filepath="/docs/question_answering.txt")
+    parser = argparse.ArgumentParser(description="Retrieval-augmented question answering over uploaded documents.")
+    parser.add_argument("query", nargs="?", default="what is Question-answering (Q&A)?")
+    parser.add_argument("--filepath", default="/docs/question_answering.txt",
+                        help="file to ingest before answering")
+    parser.add_argument("--serve", action="store_true", help="run the HTTP server instead of answering once")
+    parser.add_argument("--host", default="", help="interface the server listens on")
+    parser.add_argument("--port", type=int, default=0, help="port the server listens on")
+    args = parser.parse_args()
 
+    if args.serve:
+        from _server import _server as _server_
+        _server_.serve(args.host, args.port)
+    else:
+        print(main(query=args.query, filepath=args.filepath))